@@ -0,0 +1,250 @@
+"""Admission control for calls to a slow or failing backend.
+
+An AdmissionGate lets a bounded number of calls run at once, queues a few
+more for a short time, and rejects the rest straight away. A CircuitBreaker
+stops calls entirely for a while after repeated failures. Either way the
+caller gets an Overloaded error right away instead of a worker thread stuck
+waiting on the backend. AsyncAdmissionGate does the same for coroutines.
+"""
+import asyncio
+import contextlib
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator
+
+
+class Overloaded(Exception):
+    """Raised when a call is shed, with the number of seconds the client
+    should wait before retrying.
+    """
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures, rejecting calls
+    for reset_timeout seconds. After that it lets a single trial call
+    through: success closes it again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.state = "closed"
+
+    def allow(self) -> bool:
+        """Returns True if a call may go ahead.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self._reset_timeout:
+                    return False
+                self.state = "half_open"
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def rejecting(self) -> bool:
+        """Returns True if allow() would certainly return False right now.
+        Unlike allow(), this never starts a trial call.
+        """
+        with self._lock:
+            if self.state == "open":
+                return time.monotonic() - self._opened_at < self._reset_timeout
+            return self.state == "half_open" and self._trial_running
+
+    def retry_after(self) -> int:
+        """Returns the number of seconds until the breaker will try again.
+        """
+        remaining = self._reset_timeout - (time.monotonic() - self._opened_at)
+        return max(1, int(remaining + 0.999))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            self.state = "closed"
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or self._failures >= self._failure_threshold:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+class AdmissionGate:
+    """Bounded concurrency with a short wait queue, in front of a breaker.
+
+    Args:
+        max_concurrent: maximum number of calls running at once
+        max_waiting: maximum number of calls waiting for a slot; any more are
+                     rejected immediately
+        wait_timeout: seconds a call may wait for a slot before it's rejected
+        breaker: CircuitBreaker that records the outcome of each call
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_waiting: int,
+        wait_timeout: float,
+        breaker: CircuitBreaker,
+    ) -> None:
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._max_waiting = max_waiting
+        self._wait_timeout = wait_timeout
+        self._breaker = breaker
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    @contextlib.contextmanager
+    def admit(self) -> Iterator[None]:
+        """Context manager around one backend call.
+
+        Raises:
+            Overloaded: the breaker is open, the wait queue is full, or no
+            slot freed up within wait_timeout.
+        """
+        # fail fast without queueing while the breaker is open
+        if self._breaker.rejecting():
+            self._reject()
+            raise Overloaded("Backend is failing", self._breaker.retry_after())
+
+        with self._lock:
+            queue_full = self.waiting >= self._max_waiting
+            if queue_full:
+                self.rejected += 1
+            else:
+                self.waiting += 1
+        if queue_full:
+            raise Overloaded("Too many calls waiting", 1)
+
+        acquired = self._slots.acquire(timeout=self._wait_timeout)
+        with self._lock:
+            self.waiting -= 1
+        if not acquired:
+            self._reject()
+            raise Overloaded("Timed out waiting for a slot", 1)
+
+        if not self._breaker.allow():
+            self._slots.release()
+            self._reject()
+            raise Overloaded("Backend is failing", self._breaker.retry_after())
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        except Exception:
+            self._breaker.record_failure()
+            raise
+        else:
+            self._breaker.record_success()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, object]:
+        """Returns the in-flight, waiting and rejected counts and the breaker
+        state.
+        """
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "breaker": self._breaker.state,
+        }
+
+    def _reject(self) -> None:
+        with self._lock:
+            self.rejected += 1
+
+
+class AsyncAdmissionGate:
+    """AdmissionGate for coroutines on one event loop: the same limits and
+    breaker, with an asyncio.Semaphore for the slots, so a call waiting for
+    a slot doesn't hold a thread.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_waiting: int,
+        wait_timeout: float,
+        breaker: CircuitBreaker,
+    ) -> None:
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._max_waiting = max_waiting
+        self._wait_timeout = wait_timeout
+        self._breaker = breaker
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Async context manager around one backend call.
+
+        Raises:
+            Overloaded: the breaker is open, the wait queue is full, or no
+            slot freed up within wait_timeout.
+        """
+        if self._breaker.rejecting():
+            self.rejected += 1
+            raise Overloaded("Backend is failing", self._breaker.retry_after())
+        if self.waiting >= self._max_waiting:
+            self.rejected += 1
+            raise Overloaded("Too many calls waiting", 1)
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded("Timed out waiting for a slot", 1) from None
+        finally:
+            self.waiting -= 1
+
+        if not self._breaker.allow():
+            self._slots.release()
+            self.rejected += 1
+            raise Overloaded("Backend is failing", self._breaker.retry_after())
+
+        self.in_flight += 1
+        try:
+            yield
+        except (Exception, asyncio.CancelledError):
+            # a cancelled call may have been the half-open trial, which must
+            # end with an outcome or the breaker would never close again
+            self._breaker.record_failure()
+            raise
+        else:
+            self._breaker.record_success()
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, object]:
+        """Returns the in-flight, waiting and rejected counts and the breaker
+        state.
+        """
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "breaker": self._breaker.state,
+        }
@@ -0,0 +1,485 @@
+"""Samoyed captcha API, asyncio version.
+
+Serves the same routes with the same JSON as main.py, but database access,
+image downloads and AutoML predictions don't block a thread while they wait,
+so one process can hold thousands of requests in flight.
+
+Usage:
+    hypercorn --bind 0.0.0.0:8080 aio_main:app
+
+The pure helpers, caches, thumbnail catalog and captcha pool are shared with
+main.py; only the I/O is different. Token mode (CAPTCHA_TOKEN_SECRET) and
+write-behind saves (WRITE_BEHIND_ENABLED) are only available in main.py.
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import os
+import platform
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg  # type: ignore
+import httpx  # type: ignore
+from quart import Quart, jsonify, request, Response  # type: ignore
+
+# main's background work (warm-up and its steps) serves main's own app; only
+# its helpers, caches, catalog and pool are used here
+os.environ["DEFER_BACKGROUND_START"] = "1"
+
+import main  # noqa: E402  pylint: disable=wrong-import-position
+from admission import AsyncAdmissionGate, CircuitBreaker, Overloaded
+from image_fetcher import ImageFetchError
+from inference import ModelUnavailable
+from mosaic import render_mosaic
+from preprocess import content_hash, downscale
+
+from config import (DB_USER, DB_PWD, DB_NAME, CSQL_CONNECTION, PROJECT_ID,
+                    COMPUTE_REGION, MODEL_ID)
+
+# Token mode and write-behind saves exist only in main.py; serving without
+# them would silently change what is stored, so refuse to start instead.
+if main.CAPTCHA_TOKEN_SECRET or main.WRITE_BEHIND_ENABLED:
+    raise ValueError(
+        "aio_main doesn't support CAPTCHA_TOKEN_SECRET or WRITE_BEHIND_ENABLED;"
+        " unset them or serve main:app"
+    )
+
+app = Quart(__name__)
+
+# created in startup(), on the serving event loop
+DB_POOL: Optional[asyncpg.pool.Pool] = None
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+PREDICTION_CLIENT: Any = None
+
+# url -> task loading its prediction, so concurrent misses coalesce
+_PREDICTIONS_IN_FLIGHT: Dict[str, asyncio.Future] = {}
+
+# Gate in front of AutoML, with main.MODEL_GATE's limits: when the model
+# slows down, extra calls get a 503 instead of queueing without limit.
+MODEL_GATE = AsyncAdmissionGate(
+    max_concurrent=main.PREDICT_MAX_CONCURRENT,
+    max_waiting=main.PREDICT_MAX_WAITING,
+    wait_timeout=main.PREDICT_WAIT_TIMEOUT,
+    breaker=CircuitBreaker(main.PREDICT_BREAKER_FAILURES, main.PREDICT_BREAKER_RESET),
+)
+
+
+def captcha_match(alias: str, captcha_id: str, first: int) -> Tuple[str, List[Any]]:
+    """Same as main.captcha_match(), with asyncpg placeholders numbered from
+    first.
+    """
+    created_at = main.captcha_created_at(captcha_id)
+    if created_at is None:
+        return f"{alias}.captcha_id = ${first}", [captcha_id]
+    return (
+        f"{alias}.captcha_id = ${first} AND {alias}.created_at = ${first + 1}",
+        [captcha_id, created_at],
+    )
+
+
+def insert_responses(condition: str) -> str:
+    """Same statement as main.insert_responses(), with asyncpg placeholders:
+    $1 is submitted_at, $2-$10 are the successes for image_no 1-9, and
+    condition's placeholders start at $11.
+    """
+    return main.counting_responses(
+        "INSERT INTO responses (captcha_id, public_url, label, success, submitted_at)"
+        " SELECT t.captcha_id, t.public_url, t.label, r.success, $1"
+        " FROM thumbnail t JOIN (VALUES"
+        + ", ".join(
+            f" ({image_no}, ${image_no + 1}::boolean)" for image_no in range(1, 10)
+        )
+        + ") AS r (image_no, success) ON r.image_no = t.image_no"
+        f" WHERE {condition}"
+    )
+
+
+@app.before_serving
+async def startup() -> None:
+    """Opens the database pool and HTTP/gRPC clients, and loads the catalog.
+    """
+    global DB_POOL, HTTP_CLIENT, PREDICTION_CLIENT
+    from google.cloud import automl_v1beta1 as automl  # type: ignore
+
+    if platform.system() == "Windows":
+        host = "127.0.0.1"  # Cloud SQL proxy, as in util.cloudsql_postgres()
+    else:
+        host = f"/cloudsql/{CSQL_CONNECTION}"
+    DB_POOL = await asyncpg.create_pool(
+        host=host, user=DB_USER, password=DB_PWD, database=DB_NAME, max_size=50
+    )
+    HTTP_CLIENT = httpx.AsyncClient(
+        timeout=main.IMAGE_FETCH_TIMEOUT,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    PREDICTION_CLIENT = automl.PredictionServiceAsyncClient()
+
+    # listing the bucket blocks, so do the first load off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, main.THUMBNAILS.refresh)
+
+
+@app.after_serving
+async def shutdown() -> None:
+    await HTTP_CLIENT.aclose()
+    await DB_POOL.close()
+
+
+def cors(resp: Response) -> Response:
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+@app.route("/", methods=["GET"])
+@app.route("/captcha", methods=["GET"])
+async def captcha_api() -> Any:
+    """Route handler for the API; see main.captcha_api().
+    """
+    data = main.CAPTCHA_POOL.get() if main.CAPTCHA_POOL else None
+    if data is None:
+        data = main.build_captcha()
+        await save_captcha(data)
+    return cors(jsonify(data))
+
+
+async def save_captcha(data: dict) -> None:
+    """Saves a captcha and its 9 thumbnails in one transaction.
+    """
+    created_at = main.captcha_created_at(data["captcha_id"]) or datetime.datetime.utcnow()
+    async with DB_POOL.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "INSERT INTO captcha (created_at, label, captcha_id) VALUES ($1, $2, $3)",
+                created_at,
+                data["label"],
+                data["captcha_id"],
+            )
+            await conn.executemany(
+                "INSERT INTO thumbnail (public_url, image_no, captcha_id, label, created_at)"
+                " VALUES ($1, $2, $3, $4, $5)",
+                [
+                    (
+                        data[f"image{image_no}"]["url"],
+                        image_no,
+                        data["captcha_id"],
+                        main.url_to_label(data[f"image{image_no}"]["url"]),
+                        created_at,
+                    )
+                    for image_no in range(1, 10)
+                ],
+            )
+
+
+@app.route("/captcha/<captcha_id>/mosaic", methods=["GET"])
+async def captcha_mosaic(captcha_id: str) -> Any:
+    """Route handler for the API; see main.captcha_mosaic().
+
+    Shares main.py's caches; rendering runs in a worker thread, since
+    decoding and encoding JPEGs would block the event loop.
+    """
+    urls = main.CAPTCHA_URL_CACHE.peek(captcha_id)
+    if urls is None:
+        condition, params = captcha_match("thumbnail", captcha_id, 1)
+        async with DB_POOL.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT public_url FROM thumbnail WHERE {condition} ORDER BY image_no",
+                *params,
+            )
+        if len(rows) != 9:
+            return cors(Response("Unknown captcha.", status=404))
+        urls = [row["public_url"] for row in rows]
+        main.CAPTCHA_URL_CACHE.put(captcha_id, urls)
+
+    etag = main.mosaic_etag(urls)
+    if request.if_none_match.contains(etag):
+        resp = Response("", status=304)
+    else:
+        mosaic = main.MOSAIC_CACHE.get(etag)
+        if mosaic is None:
+            try:
+                images = await asyncio.gather(*(fetch_thumbnail(url) for url in urls))
+            except (ImageFetchError, httpx.HTTPError):
+                return cors(Response("Couldn't fetch the captcha's images.", status=502))
+            mosaic = await asyncio.get_running_loop().run_in_executor(
+                None, render_mosaic, images, main.MOSAIC_TILE_SIZE, main.MOSAIC_QUALITY
+            )
+            main.MOSAIC_CACHE.put(etag, mosaic)
+        resp = Response(mosaic, mimetype="image/jpeg")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={main.MOSAIC_MAX_AGE}, immutable"
+    return cors(resp)
+
+
+async def fetch_thumbnail(url: str) -> bytes:
+    """Returns the bytes of a thumbnail, from main.THUMBNAIL_IMAGE_CACHE if
+    possible.
+    """
+    content = main.THUMBNAIL_IMAGE_CACHE.get(url)
+    if content is None:
+        content = await fetch_image(url)
+        main.THUMBNAIL_IMAGE_CACHE.put(url, content)
+    return content
+
+
+@app.route("/response/<captcha_id>", methods=["POST"])
+async def response_handler(captcha_id: str) -> Any:
+    """Save a user's response to the captcha; see main.response_handler().
+    """
+    data = await request.get_json(force=True)
+    successes = [bool(data[f"image{image_no}"]) for image_no in range(1, 10)]
+
+    submitted_at = datetime.datetime.utcnow()
+    async with DB_POOL.acquire() as conn:
+        async with conn.transaction():
+            condition, params = captcha_match("captcha", captcha_id, 2)
+            claimed = await conn.fetchval(
+                "UPDATE captcha SET submitted_at = $1"
+                f" WHERE {condition} AND submitted_at IS NULL"
+                " RETURNING 1",
+                submitted_at,
+                *params,
+            )
+            if claimed:
+                condition, params = captcha_match("t", captcha_id, 11)
+                await conn.execute(
+                    insert_responses(condition), submitted_at, *successes, *params
+                )
+        if claimed:
+            status = 200
+        else:
+            condition, params = captcha_match("captcha", captcha_id, 1)
+            exists = await conn.fetchval(f"SELECT 1 FROM captcha WHERE {condition}", *params)
+            status = 409 if exists else 404
+
+    return cors(Response("", status=status))
+
+
+@app.route("/predict", methods=["POST"])
+async def return_prediction() -> Any:
+    """Route handler for the API; see main.return_prediction().
+    """
+    url = (await request.get_json(force=True)).get("url")
+    result = await get_prediction(url)
+
+    resp = cors(jsonify(result))
+    resp.headers["Access-Control-Allow-Methods"] = "POST"
+    return resp
+
+
+async def get_prediction(url: str) -> dict:
+    """Returns the prediction for url from the cache, the database or the
+    model, in that order. Concurrent misses for the same url share one load.
+
+    The load runs as its own task, so a caller that goes away (e.g. a client
+    that disconnects and cancels its request) doesn't cancel it for the
+    others waiting on it.
+    """
+    cached = main.PREDICTION_CACHE.peek(url)
+    if cached:
+        return cached
+
+    task = _PREDICTIONS_IN_FLIGHT.get(url)
+    if task is None:
+        task = _PREDICTIONS_IN_FLIGHT[url] = asyncio.ensure_future(load_prediction(url))
+        task.add_done_callback(lambda done: prediction_loaded(url, done))
+    return await asyncio.shield(task)
+
+
+def prediction_loaded(url: str, task: asyncio.Future) -> None:
+    """Caches a finished load of url's prediction and forgets the task.
+    """
+    del _PREDICTIONS_IN_FLIGHT[url]
+    # retrieving the exception keeps asyncio from logging it as unhandled
+    # when every caller has gone away
+    if not task.cancelled() and task.exception() is None:
+        main.PREDICTION_CACHE.put(url, task.result())
+
+
+async def load_prediction(url: str) -> dict:
+    """Reads the prediction for url from the database, or gets it from the
+    model and saves it.
+    """
+    async with DB_POOL.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT jamie, alice FROM predictions"
+            " WHERE public_url = $1"
+            " OR content_hash = (SELECT content_hash FROM image_hashes WHERE public_url = $1)"
+            " LIMIT 1",
+            url,
+        )
+    if row is not None:
+        return {"url": url, "jamie": row["jamie"], "alice": row["alice"]}
+
+    result = await get_prediction_from_api(url)
+    async with DB_POOL.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                main.counting_predictions(
+                    "INSERT INTO predictions (label, public_url, jamie, alice, content_hash)"
+                    " VALUES ($1, $2, $3, $4, $5)"
+                    " ON CONFLICT DO NOTHING"
+                ),
+                main.url_to_label(url),
+                url,
+                result["jamie"],
+                result["alice"],
+                result["content_hash"],
+            )
+            await conn.execute(
+                "INSERT INTO image_hashes (public_url, content_hash) VALUES ($1, $2)"
+                " ON CONFLICT (public_url) DO NOTHING",
+                url,
+                result["content_hash"],
+            )
+    return main.prediction_fields(result)
+
+
+async def fetch_image(url: str) -> bytes:
+    """Downloads an image, with the same size limit as main.IMAGE_FETCHER.
+    """
+    chunks = []
+    received = 0
+    async with HTTP_CLIENT.stream("GET", url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            if received > main.IMAGE_MAX_BYTES:
+                raise ImageFetchError(f"Image is larger than {main.IMAGE_MAX_BYTES} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def get_prediction_from_api(url: str) -> dict:
+    """Gets a prediction from the model; see main.get_prediction_from_api().
+
+    Raises:
+        Overloaded: the AutoML call was shed by MODEL_GATE.
+    """
+    img_bytes = await fetch_image(url)
+    digest = content_hash(img_bytes)
+
+    async with DB_POOL.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT jamie, alice FROM predictions WHERE content_hash = $1", digest
+        )
+    if row is not None:
+        main.count_prediction("dedup_hits")
+        return {"url": url, "jamie": row["jamie"], "alice": row["alice"], "content_hash": digest}
+
+    main.count_prediction("model_calls")
+    if main.LOCAL_INFERENCE:
+        # the local model batches concurrent requests in its own thread;
+        # wait for the batch in a worker thread
+        scores = (
+            await asyncio.get_running_loop().run_in_executor(
+                None, main.MODEL_BACKEND.predict, [img_bytes]
+            )
+        )[0]
+        return {
+            "url": url,
+            "jamie": scores["jamie"],
+            "alice": scores["alice"],
+            "content_hash": digest,
+        }
+
+    # decoding and resizing is CPU work, so keep it off the event loop
+    img_bytes = await asyncio.get_running_loop().run_in_executor(
+        None, downscale, img_bytes, main.MODEL_INPUT_SIZE, main.MODEL_INPUT_QUALITY
+    )
+
+    model_full_id = (
+        f"projects/{PROJECT_ID}/locations/{COMPUTE_REGION}/models/{MODEL_ID}"
+    )
+    async with MODEL_GATE.admit():
+        response = await PREDICTION_CLIENT.predict(
+            request={
+                "name": model_full_id,
+                "payload": {"image": {"image_bytes": img_bytes}},
+                "params": {"score_threshold": "0.0"},
+            },
+            timeout=main.PREDICT_TIMEOUT,
+        )
+    result = {label.display_name: label.classification.score for label in response.payload}
+
+    return {
+        "url": url,
+        "jamie": result["jamie"],
+        "alice": result["alice"],
+        "content_hash": digest,
+    }
+
+
+@app.route("/confusion", methods=["GET"])
+async def get_confusion_counts() -> Any:
+    """Route handler for the API; see main.get_confusion_counts().
+    """
+    cached = main.CONFUSION_CACHE.peek("counts")
+    if cached is None:
+        async with DB_POOL.acquire() as conn:
+            rows = await conn.fetch(main.SELECT_CONFUSION_COUNTS)
+        cached = main.confusion_counts_dict(rows)
+        main.CONFUSION_CACHE.put("counts", cached)
+    etag = main.matrix_etag(cached)
+
+    if request.if_none_match.contains(etag):
+        resp = Response("", status=304)
+    else:
+        resp = jsonify(cached)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={int(main.CONFUSION_CACHE_TTL)}"
+    return cors(resp)
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics() -> Any:
+    """Route handler for Prometheus; see main.get_metrics(). Database pool
+    stats are those of main.py's engines, which this app doesn't use.
+    """
+    stats = main.component_stats()
+    stats["model_gate"] = MODEL_GATE.stats()
+    stats["asyncpg_pool"] = {"size": DB_POOL.get_size(), "idle": DB_POOL.get_idle_size()}
+    return Response(main.METRICS.render(stats), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/matrix", methods=["GET"])
+async def get_confusion_matrix() -> Any:
+    """Route handler for the API; see main.get_confusion_matrix().
+
+    The matrix is cached for hours, so the rare AutoML call on a miss is run
+    in a worker thread instead of being rewritten for asyncio.
+    """
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, main.MATRIX_CACHE.get, MODEL_ID
+    )
+    etag = main.matrix_etag(result)
+
+    if request.if_none_match.contains(etag):
+        resp = Response("", status=304)
+    else:
+        resp = jsonify(result)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={int(main.MATRIX_CACHE_TTL)}"
+    return cors(resp)
+
+
+@app.errorhandler(Overloaded)
+async def overloaded(e: Overloaded) -> Any:
+    # A model call was shed; see main.overloaded().
+    resp = Response("The prediction service is overloaded.", status=503)
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return cors(resp)
+
+
+@app.errorhandler(ModelUnavailable)
+async def model_unavailable(e: ModelUnavailable) -> Any:
+    # see main.model_unavailable()
+    resp = Response("The prediction model is unavailable.", status=503)
+    resp.headers["Retry-After"] = "5"
+    return cors(resp)
+
+
+@app.errorhandler(concurrent.futures.TimeoutError)
+async def timed_out(e: Exception) -> Any:
+    # see main.timed_out()
+    resp = Response("The prediction service timed out.", status=503)
+    resp.headers["Retry-After"] = "1"
+    return cors(resp)
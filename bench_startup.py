@@ -0,0 +1,53 @@
+"""Startup-time benchmark for the API.
+
+Measures, in fresh interpreters, how long it takes to import main (what an
+App Engine instance pays before it can serve its first request), and how
+long it takes when the Google Cloud clients are also created up front, as
+they were when main.py built them at import time.
+
+Usage:
+    python bench_startup.py [--runs N]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import List
+
+LAZY = "import main"
+EAGER = (
+    "import main, clients;"
+    " clients.storage_client(); clients.automl_client(); clients.prediction_client()"
+)
+
+
+def time_runs(code: str, runs: int) -> List[float]:
+    """Returns the wall-clock seconds for each run of code in a new interpreter.
+    """
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark API startup time.")
+    parser.add_argument("--runs", type=int, default=10, help="interpreters per case")
+    args = parser.parse_args()
+
+    results = {
+        "lazy clients": time_runs(LAZY, args.runs),
+        "eager clients": time_runs(EAGER, args.runs),
+    }
+    for name, timings in results.items():
+        print(
+            f"{name:>14}: median {statistics.median(timings) * 1000:7.1f} ms,"
+            f" min {min(timings) * 1000:7.1f} ms over {len(timings)} runs"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""In-process read-through cache with TTL, LRU eviction and single-flight loads.
+"""
+import collections
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class _Flight:
+    """A load in progress, which concurrent callers for the same key wait on.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+def _copy_error(error: BaseException) -> BaseException:
+    """Returns a new exception with the same type, args and attributes as
+    error, without its traceback.
+
+    A remembered failure is raised again as a copy, chained from the
+    original: raising the cached instance itself would grow its traceback on
+    every hit, and share one object between threads raising it at once.
+    """
+    copy = type(error).__new__(type(error), *error.args)  # type: ignore
+    copy.__dict__.update(getattr(error, "__dict__", {}))
+    return copy
+
+
+class ReadThroughCache:
+    """Bounded LRU cache that calls a loader function on a miss.
+
+    Args:
+        loader: callable that takes a key and returns its value
+        maxsize: maximum number of entries kept; least recently used entries
+                 are evicted first
+        ttl: number of seconds a loaded value is kept
+        negative_ttl: number of seconds to remember that a load returned None
+                      or raised, so a bad key doesn't hit the loader on
+                      every request
+        uncached_errors: exception types that are never remembered, because
+                         they say nothing about the key (e.g. load shedding)
+
+    Concurrent misses for the same key are coalesced: the first caller runs
+    the loader and the others wait for its result, so the loader runs once
+    per key no matter how many requests arrive together.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[Hashable], Any],
+        maxsize: int = 10000,
+        ttl: float = 3600.0,
+        negative_ttl: float = 30.0,
+        uncached_errors: Tuple[type, ...] = (),
+    ) -> None:
+        self._loader = loader
+        self._uncached_errors = uncached_errors
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, value, error)
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+
+    def get(self, key: Hashable, loader: Optional[Callable[[Hashable], Any]] = None) -> Any:
+        """Returns the value for key, loading it if it isn't cached.
+
+        Args:
+            key: the key to look up
+            loader: called instead of the cache's loader if this call ends
+                    up loading the key (e.g. a batch that saves its new
+                    values together); concurrent gets for the key still
+                    share one load, whichever loader runs it
+
+        Raises:
+            Whatever the loader raised, if the last load of this key failed
+            within negative_ttl seconds (a copy, chained from the original).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value, error = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    if error is not None or value is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    if error is not None:
+                        raise _copy_error(error) from error
+                    return value
+                del self._entries[key]
+
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise _copy_error(flight.error) from flight.error
+            return flight.value
+
+        try:
+            flight.value = (loader or self._loader)(key)
+        except Exception as error:  # pylint: disable=broad-except
+            flight.error = error
+        with self._lock:
+            del self._flights[key]
+            negative = flight.error is not None or flight.value is None
+            ttl = self._negative_ttl if negative else self._ttl
+            if isinstance(flight.error, self._uncached_errors):
+                ttl = 0
+            if ttl > 0:
+                self._store(key, (time.monotonic() + ttl, flight.value, flight.error))
+        flight.done.set()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def peek(self, key: Hashable) -> Any:
+        """Returns the cached value for key, or None if it isn't cached (or
+        is cached as a failure). Never calls the loader.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic() or entry[2] is not None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Stores a value that was loaded some other way.
+        """
+        with self._lock:
+            self._store(key, (time.monotonic() + self._ttl, value, None))
+
+    def put_if_absent(self, key: Hashable, value: Any) -> bool:
+        """Stores value unless key already has an unexpired value.
+
+        Returns:
+            True if value was stored, False if key was already cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self._store(key, (time.monotonic() + self._ttl, value, None))
+            return True
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Removes key from the cache, or every entry if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the cache size and the hit/miss/coalesced counters.
+        """
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "coalesced": self.coalesced,
+        }
+
+    def _store(self, key: Hashable, entry: tuple) -> None:
+        """Adds an entry, evicting the least recently used ones if needed.
+        Must be called with the lock held.
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
@@ -0,0 +1,132 @@
+"""Pool of pre-generated captchas, filled by a background producer.
+
+Building a captcha means picking images and persisting it, so the producer
+does that ahead of time in batches and /captcha just pops a ready one.
+"""
+import logging
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+class CaptchaPool:
+    """Bounded queue of captchas that have already been saved to the database.
+
+    Args:
+        build: callable that returns a new captcha dict (not yet saved)
+        persist: callable that saves a list of captcha dicts in bulk
+        low_watermark: the producer refills when the queue drops below this
+        high_watermark: the producer fills the queue up to this size
+        batch_size: maximum number of captchas persisted per bulk insert
+
+    The producer sleeps while the queue is at or above low_watermark, then
+    tops it up to high_watermark, so inserts happen in bursts of batch_size
+    rather than once per request.
+    """
+
+    def __init__(
+        self,
+        build: Callable[[], Dict],
+        persist: Callable[[List[Dict]], None],
+        low_watermark: int = 50,
+        high_watermark: int = 200,
+        batch_size: int = 50,
+    ) -> None:
+        if not 0 < low_watermark < high_watermark:
+            raise ValueError("low_watermark must be less than high_watermark")
+        self._build = build
+        self._persist = persist
+        self._low_watermark = low_watermark
+        self._high_watermark = high_watermark
+        self._batch_size = batch_size
+        self._queue: queue.Queue = queue.Queue(maxsize=high_watermark)
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.served = 0
+        self.misses = 0
+        self.produced = 0
+
+    def start(self) -> None:
+        """Starts the producer thread, if it isn't already running.
+        """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._produce, name="captcha-pool", daemon=True
+            )
+            self._thread.start()
+
+    def get(self) -> Optional[Dict]:
+        """Returns a pre-generated captcha, or None if the pool is empty.
+
+        Never blocks; if the pool is empty, the caller should build a captcha
+        itself.
+        """
+        self.start()
+        try:
+            captcha = self._queue.get_nowait()
+        except queue.Empty:
+            self.misses += 1
+            captcha = None
+        else:
+            self.served += 1
+        if self._queue.qsize() < self._low_watermark:
+            self._wakeup.set()
+        return captcha
+
+    def clear(self) -> None:
+        """Discards the queued captchas and forgets the producer thread.
+
+        Used after a fork, so that pre-forked workers don't all hand out the
+        same captchas they inherited from the parent.
+        """
+        with self._lock:
+            self._queue = queue.Queue(maxsize=self._high_watermark)
+            self._thread = None
+
+    def depth(self) -> int:
+        """Returns the number of captchas currently in the pool.
+        """
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the queue depth and the served/missed/produced counters.
+        """
+        return {
+            "depth": self.depth(),
+            "low_watermark": self._low_watermark,
+            "high_watermark": self._high_watermark,
+            "served": self.served,
+            "misses": self.misses,
+            "produced": self.produced,
+        }
+
+    def _produce(self) -> None:
+        """Producer loop: top up the queue whenever it drops below the low
+        watermark.
+        """
+        while True:
+            try:
+                if self._queue.qsize() < self._low_watermark:
+                    self._fill()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("captcha pool producer failed")
+            self._wakeup.wait(timeout=5.0)
+            self._wakeup.clear()
+
+    def _fill(self) -> None:
+        """Builds and persists captchas until the queue is at high_watermark.
+        """
+        while self._queue.qsize() < self._high_watermark:
+            count = min(self._batch_size, self._high_watermark - self._queue.qsize())
+            batch = [self._build() for _ in range(count)]
+            self._persist(batch)
+            for captcha in batch:
+                try:
+                    self._queue.put_nowait(captcha)
+                except queue.Full:
+                    # persisted but never served; it will just go unanswered
+                    break
+            self.produced += len(batch)
@@ -0,0 +1,117 @@
+"""In-process catalog of the thumbnail images in the GCS bucket.
+
+Listing the bucket pages through every blob, so the catalog does it in the
+background and keeps the result partitioned by label. Request handlers read
+the current snapshot without any storage I/O.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+LABELS = ("jamie", "alice")
+
+
+class ThumbnailCatalog:
+    """Cached, label-partitioned list of thumbnail public_urls.
+
+    Args:
+        loader: callable that returns the public_urls of all thumbnails
+        labeler: callable that maps a public_url to its label
+        ttl: number of seconds before the snapshot is considered stale
+
+    The first read blocks until the bucket has been listed once. After that,
+    a stale read returns the current snapshot immediately and starts a
+    background refresh, so callers never wait on the bucket listing again.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[], Iterable[str]],
+        labeler: Callable[[str], str],
+        ttl: float = 300.0,
+    ) -> None:
+        self._loader = loader
+        self._labeler = labeler
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._loaded_at = 0.0
+        self._urls: frozenset = frozenset()
+        self._partitions: Dict[str, Tuple[str, ...]] = {label: () for label in LABELS}
+
+    def partitions(self) -> Dict[str, Tuple[str, ...]]:
+        """Returns the thumbnails grouped by label.
+
+        Returns:
+            A dict that maps each label to a tuple of public_urls. The dict
+            is a snapshot and is never mutated after it is returned.
+        """
+        if not self._loaded_at:
+            self.refresh()
+        elif time.monotonic() - self._loaded_at > self._ttl:
+            self._refresh_in_background()
+        return self._partitions
+
+    def urls(self) -> List[str]:
+        """Returns the public_urls of all thumbnails in the catalog.
+        """
+        partitions = self.partitions()
+        return [url for label in LABELS for url in partitions[label]]
+
+    def refresh(self) -> None:
+        """Lists the bucket and applies any additions or removals.
+
+        Only labels whose thumbnails changed get a new partition; unchanged
+        partitions are carried over from the previous snapshot.
+        """
+        urls = frozenset(self._loader())
+        with self._lock:
+            added = urls - self._urls
+            removed = self._urls - urls
+            changed = {self._labeler(url) for url in added | removed}
+            partitions = dict(self._partitions)
+            for label in changed:
+                if label in partitions:
+                    partitions[label] = tuple(
+                        sorted(url for url in urls if self._labeler(url) == label)
+                    )
+            self._urls = urls
+            self._partitions = partitions
+            self._loaded_at = time.monotonic()
+        if added or removed:
+            logging.info(
+                "thumbnail catalog refreshed: %d added, %d removed, %d total",
+                len(added),
+                len(removed),
+                len(urls),
+            )
+
+    def reset_after_fork(self) -> None:
+        """Resets the lock and refresh flag after a fork, since a refresh
+        thread in the parent doesn't exist in the child.
+        """
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _refresh_in_background(self) -> None:
+        """Starts a refresh thread, unless one is already running.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run() -> None:
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                # keep serving the previous snapshot, and try again once it
+                # is stale again rather than on every request
+                logging.exception("thumbnail catalog refresh failed")
+                self._loaded_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="thumbnail-catalog", daemon=True).start()
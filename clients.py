@@ -0,0 +1,86 @@
+"""Lazily created Google Cloud clients.
+
+Importing the storage and AutoML libraries loads the gRPC stack, and creating
+a client resolves credentials, so neither happens until a client is first
+needed. Each accessor creates its client once per process and is safe to
+call from any thread.
+"""
+import threading
+from typing import Any, Callable, Dict
+
+_CLIENTS: Dict[str, Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get(name: str, factory: Callable[[], Any]) -> Any:
+    """Returns the client called name, creating it with factory on first use.
+    """
+    client = _CLIENTS.get(name)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(name)
+            if client is None:
+                client = _CLIENTS[name] = factory()
+    return client
+
+
+def _new_storage_client() -> Any:
+    from google.cloud import storage  # type: ignore
+
+    return storage.Client()
+
+
+def _new_automl_client() -> Any:
+    from google.cloud import automl_v1beta1 as automl  # type: ignore
+
+    return automl.AutoMlClient()
+
+
+def _new_prediction_client() -> Any:
+    from google.cloud import automl_v1beta1 as automl  # type: ignore
+
+    return automl.PredictionServiceClient()
+
+
+def storage_client() -> Any:
+    """Returns the process-wide google.cloud.storage.Client.
+    """
+    return _get("storage", _new_storage_client)
+
+
+def automl_client() -> Any:
+    """Returns the process-wide AutoMl client.
+    """
+    return _get("automl", _new_automl_client)
+
+
+def prediction_client() -> Any:
+    """Returns the process-wide AutoML PredictionService client.
+    """
+    return _get("prediction", _new_prediction_client)
+
+
+def connect_prediction_channel(timeout: float = 10.0) -> None:
+    """Creates the prediction client and waits until its gRPC channel is
+    connected, so the first predict call doesn't pay for the handshake.
+
+    Raises:
+        grpc.FutureTimeoutError: the channel didn't connect within timeout.
+    """
+    import grpc  # type: ignore
+
+    client = prediction_client()
+    # where the channel lives depends on the client library version
+    transport = getattr(client, "transport", None) or getattr(client, "_transport", None)
+    channel = getattr(transport, "grpc_channel", None) or getattr(
+        transport, "_grpc_channel", None
+    )
+    if channel is not None:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+
+
+def reset_clients() -> None:
+    """Forgets all clients, so they are created again on next use.
+    """
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
@@ -0,0 +1,32 @@
+"""Gunicorn settings for serving the API in production.
+
+Usage:
+    gunicorn -c gunicorn.conf.py main:app
+
+Every setting can be overridden with an environment variable.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# one worker process per core, each serving requests on a pool of threads
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+
+# Import the app once in the parent, so workers share its memory and start
+# faster. Background work is deferred until each worker has forked.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+if preload_app:
+    os.environ["DEFER_BACKGROUND_START"] = "1"
+
+
+def post_fork(server, worker):  # type: ignore
+    """Gives each worker its own clients, connection pools and threads.
+    """
+    if preload_app:
+        import main
+
+        main.reinitialize_after_fork()
@@ -0,0 +1,146 @@
+"""Image downloads for model inference.
+
+Images in our own bucket are read through the authenticated storage client;
+anything else goes over a shared keep-alive HTTP session. Either way the
+download is bounded in time and size.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry  # type: ignore
+
+GCS_HOST = "storage.googleapis.com"
+
+
+class ImageFetchError(Exception):
+    """Raised when an image can't be downloaded or is too large.
+    """
+
+
+class ImageFetcher:
+    """Downloads image bytes from a public_url.
+
+    Args:
+        bucket_name: GCS bucket read directly through the storage client
+        storage_client: callable that returns a google.cloud.storage.Client
+        max_bytes: largest image accepted, in bytes
+        timeout: seconds to wait for connect and for each read
+        retries: number of retries for connection errors and 5xx responses
+        backoff: backoff factor between retries, in seconds
+        pool_size: number of keep-alive connections kept per host
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        storage_client: Callable[[], Any],
+        max_bytes: int = 10 * 1024 * 1024,
+        timeout: float = 5.0,
+        retries: int = 2,
+        backoff: float = 0.2,
+        pool_size: int = 20,
+    ) -> None:
+        self._bucket_name = bucket_name
+        self._storage_client = storage_client
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self._session = requests.Session()
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {
+            source: {"fetches": 0, "errors": 0, "bytes": 0, "seconds": 0.0}
+            for source in ("gcs", "http")
+        }
+
+    def fetch(self, url: str) -> bytes:
+        """Returns the bytes of the image at url.
+
+        Raises:
+            ImageFetchError: the download failed or the image is larger
+            than max_bytes.
+        """
+        blob_name = self._blob_name(url)
+        source = "http" if blob_name is None else "gcs"
+        started = time.perf_counter()
+        try:
+            if blob_name is None:
+                content = self._fetch_http(url)
+            else:
+                content = self._fetch_gcs(blob_name)
+        except Exception as error:
+            self._record(source, started, 0, failed=True)
+            if isinstance(error, ImageFetchError):
+                raise
+            raise ImageFetchError(f"Failed to fetch {url}: {error}") from error
+        self._record(source, started, len(content))
+        return content
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns fetch, error, byte and latency totals per source
+        ("gcs" or "http").
+        """
+        with self._lock:
+            return {source: dict(values) for source, values in self._stats.items()}
+
+    def _blob_name(self, url: str) -> Optional[str]:
+        """Returns the blob name if url points into our bucket, else None.
+        """
+        parsed = urlparse(url)
+        if parsed.netloc != GCS_HOST:
+            return None
+        bucket, _, name = parsed.path.lstrip("/").partition("/")
+        if bucket != self._bucket_name or not name:
+            return None
+        return unquote(name)
+
+    def _fetch_gcs(self, blob_name: str) -> bytes:
+        """Downloads a blob from our bucket with the storage client.
+        """
+        blob = self._storage_client().bucket(self._bucket_name).blob(blob_name)
+        # ask for one byte more than allowed, so we can tell if it's too big
+        content = blob.download_as_bytes(start=0, end=self._max_bytes, timeout=self._timeout)
+        self._check_size(len(content))
+        return content
+
+    def _fetch_http(self, url: str) -> bytes:
+        """Streams an image over HTTP, stopping as soon as it's too large.
+        """
+        with self._session.get(url, timeout=self._timeout, stream=True) as response:
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if length is not None:
+                self._check_size(int(length))
+            chunks = []
+            received = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                received += len(chunk)
+                self._check_size(received)
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _check_size(self, size: int) -> None:
+        if size > self._max_bytes:
+            raise ImageFetchError(f"Image is larger than {self._max_bytes} bytes")
+
+    def _record(self, source: str, started: float, size: int, failed: bool = False) -> None:
+        with self._lock:
+            stats = self._stats[source]
+            stats["fetches"] += 1
+            stats["errors"] += 1 if failed else 0
+            stats["bytes"] += size
+            stats["seconds"] += time.perf_counter() - started
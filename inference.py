@@ -0,0 +1,363 @@
+"""Inference backends for the jamie/alice classifier.
+
+AutoMLBackend sends each image to the hosted AutoML model. LocalModelBackend
+runs an exported on-device model (an AutoML Edge TFLite or ONNX export) on
+the CPU inside this process: concurrent requests are collected into micro-
+batches, decoded and preprocessed together in NumPy, and scored with one
+model invocation per batch. NumPy, Pillow and the model runtime are only
+imported once a local model is loaded, so the AutoML backend doesn't pay
+for them at startup.
+
+Every backend's predict() takes encoded images and returns one dict per
+image that maps each label to its confidence score.
+"""
+import concurrent.futures
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+class ModelUnavailable(Exception):
+    """Raised when a local model couldn't be loaded; the load is retried
+    after a while.
+    """
+
+
+class AutoMLBackend:
+    """Scores images one at a time with a remote model.
+
+    Args:
+        predict_one: callable that takes an encoded image and returns a dict
+                     that maps labels to scores
+    """
+
+    def __init__(self, predict_one: Callable[[bytes], Dict[str, float]]) -> None:
+        self._predict_one = predict_one
+
+    def predict(self, images: Sequence[bytes]) -> List[Dict[str, float]]:
+        return [self._predict_one(image) for image in images]
+
+    def load(self) -> None:
+        """Nothing to load; the model is remote.
+        """
+
+    def stats(self) -> Dict[str, float]:
+        return {}
+
+
+class _TFLiteModel:
+    """A TFLite model, run with tflite_runtime or TensorFlow, whichever is
+    installed. Not thread-safe.
+    """
+
+    def __init__(self, path: str, threads: int) -> None:
+        try:
+            from tflite_runtime.interpreter import Interpreter  # type: ignore
+        except ImportError:
+            from tensorflow.lite import Interpreter  # type: ignore
+
+        self._interpreter = Interpreter(model_path=path, num_threads=threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = 1
+        _, self.height, self.width, _ = self._input["shape"]
+        self.dtype = self._input["dtype"]
+
+    def run(self, batch: Any) -> Any:
+        """Returns the scores for a batch of preprocessed images, one row per
+        image.
+        """
+        import numpy as np  # type: ignore
+
+        if len(batch) != self._batch_size:
+            # exported models have a batch size of 1; resizing reallocates,
+            # so it's only done when the batch size changes
+            self._interpreter.resize_tensor_input(
+                self._input["index"], [len(batch), self.height, self.width, 3]
+            )
+            self._interpreter.allocate_tensors()
+            self._batch_size = len(batch)
+        self._interpreter.set_tensor(self._input["index"], batch)
+        self._interpreter.invoke()
+        scores = self._interpreter.get_tensor(self._output["index"])
+        # quantized models return uint8 scores; map them back to [0, 1]
+        scale, zero_point = self._output.get("quantization", (0.0, 0))
+        if scale:
+            scores = (scores.astype(np.float32) - zero_point) * scale
+        return scores
+
+
+class _ONNXModel:
+    """An ONNX model, run with onnxruntime.
+    """
+
+    def __init__(self, path: str, threads: int) -> None:
+        import numpy as np  # type: ignore
+        import onnxruntime  # type: ignore
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        model_input = self._session.get_inputs()[0]
+        self._input_name = model_input.name
+        # images are fed as NHWC, the layout of AutoML Edge exports
+        batch_dim, self.height, self.width, _ = model_input.shape
+        # a model exported with a fixed batch size of 1 is run image by image
+        self._fixed_batch = batch_dim == 1
+        self.dtype = np.uint8 if model_input.type == "tensor(uint8)" else np.float32
+
+    def run(self, batch: Any) -> Any:
+        import numpy as np  # type: ignore
+
+        if self._fixed_batch:
+            return np.concatenate(
+                [
+                    self._session.run(None, {self._input_name: batch[i : i + 1]})[0]
+                    for i in range(len(batch))
+                ]
+            )
+        return self._session.run(None, {self._input_name: batch})[0]
+
+
+class LocalModelBackend:
+    """Scores images in process with an exported model, in micro-batches.
+
+    Args:
+        model_path: a .tflite or .onnx file, e.g. an AutoML Edge export
+        labels_path: text file with one label per line, in the order of the
+                     model's outputs (the dict.txt of an AutoML Edge export)
+        max_batch: most images scored by one model invocation
+        max_delay: seconds the first image of a batch waits for others to
+                   join it
+        threads: CPU threads used by the model runtime
+        timeout: seconds predict() waits for its images to be scored
+        retry_interval: seconds before a failed model load is retried; the
+                        wait doubles after each failure, up to 5 minutes
+
+    The model is loaded on first use (or by load()), by the thread that runs
+    the batches; that thread is the only one that touches the model. While
+    the model can't be loaded, predictions fail straight away.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        labels_path: str,
+        max_batch: int = 32,
+        max_delay: float = 0.005,
+        threads: int = 2,
+        timeout: float = 10.0,
+        retry_interval: float = 5.0,
+    ) -> None:
+        self._model_path = model_path
+        self._labels_path = labels_path
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._threads = threads
+        self._timeout = timeout
+        self._retry_interval = retry_interval
+        self._model: Any = None
+        self._labels: List[str] = []
+        self._loaded = threading.Event()
+        self._load_error: Optional[BaseException] = None
+        self._load_failures = 0
+        self._retry_load_at = 0.0
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.images = 0
+        self.seconds = 0.0
+
+    def predict(self, images: Sequence[bytes]) -> List[Dict[str, float]]:
+        """Returns the label scores for each image, waiting for the batches
+        they're scored in.
+
+        Raises:
+            ModelUnavailable: the model couldn't be loaded.
+            concurrent.futures.TimeoutError: the images weren't scored within
+                timeout seconds.
+            Whatever decoding an image raised.
+        """
+        self._start()
+        futures = []
+        for image in images:
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            self._queue.put((image, future))
+            futures.append(future)
+        deadline = time.monotonic() + self._timeout
+        try:
+            return [
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+                for future in futures
+            ]
+        finally:
+            # images that haven't been taken for a batch yet are skipped
+            for future in futures:
+                future.cancel()
+
+    def load(self) -> None:
+        """Loads the model now instead of on the first prediction, e.g.
+        during warm-up.
+
+        Raises:
+            ModelUnavailable: the model couldn't be loaded.
+        """
+        self._start()
+        self._loaded.wait()
+        if self._load_error is not None:
+            raise ModelUnavailable(f"Couldn't load {self._model_path}") from self._load_error
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the number of batches and images scored, the average
+        batch size, and the total seconds spent preprocessing and scoring.
+        """
+        return {
+            "batches": self.batches,
+            "images": self.images,
+            "average_batch": self.images / self.batches if self.batches else 0.0,
+            "seconds": self.seconds,
+            "queued": self._queue.qsize(),
+            "loaded": self._model is not None,
+            "load_failures": self._load_failures,
+        }
+
+    def _start(self) -> None:
+        """Starts the batch thread, if it isn't already running (e.g. in a
+        newly forked worker).
+        """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="inference", daemon=True)
+            self._thread.start()
+
+    def _load(self) -> None:
+        if self._model_path.endswith(".onnx"):
+            model: Any = _ONNXModel(self._model_path, self._threads)
+        else:
+            model = _TFLiteModel(self._model_path, self._threads)
+        with open(self._labels_path) as labels:
+            self._labels = [line.strip() for line in labels if line.strip()]
+        self._model = model
+        logging.info(
+            "loaded %s (%dx%d, labels %s)",
+            os.path.basename(self._model_path),
+            model.width,
+            model.height,
+            self._labels,
+        )
+
+    def _try_load(self) -> None:
+        """Loads the model, unless the last attempt failed less than the
+        retry interval ago. A failure (e.g. a transient read error) is
+        retried with exponential backoff rather than kept for good.
+        """
+        if time.monotonic() < self._retry_load_at:
+            return
+        try:
+            self._load()
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception("failed to load %s", self._model_path)
+            self._load_error = error
+            self._load_failures += 1
+            backoff = self._retry_interval * 2 ** min(self._load_failures - 1, 10)
+            self._retry_load_at = time.monotonic() + min(backoff, 300.0)
+        else:
+            self._load_error = None
+            self._load_failures = 0
+
+    def _run(self) -> None:
+        self._try_load()
+        self._loaded.set()
+
+        while True:
+            # skip images whose caller has stopped waiting
+            batch = [
+                (image, future)
+                for image, future in self._take()
+                if future.set_running_or_notify_cancel()
+            ]
+            if self._model is None:
+                self._try_load()
+            if self._model is None:
+                for _, future in batch:
+                    error = ModelUnavailable(f"Couldn't load {self._model_path}")
+                    error.__cause__ = self._load_error
+                    future.set_exception(error)
+                continue
+            if batch:
+                self._score(batch)
+
+    def _take(self) -> List[Tuple[bytes, concurrent.futures.Future]]:
+        """Waits for an image, then returns it with whatever else arrives
+        within max_delay, up to max_batch images.
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self._max_delay
+        while len(batch) < self._max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _score(self, batch: List[Tuple[bytes, concurrent.futures.Future]]) -> None:
+        """Scores a batch and resolves its futures. An image that can't be
+        decoded fails on its own, without failing the rest of the batch.
+        """
+        import numpy as np  # type: ignore
+
+        started = time.perf_counter()
+        arrays, futures = [], []
+        for image, future in batch:
+            try:
+                arrays.append(self._decode(image))
+                futures.append(future)
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+        if not arrays:
+            return
+
+        try:
+            inputs = np.stack(arrays)
+            if self._model.dtype != np.uint8:
+                inputs = inputs.astype(np.float32) / 255.0
+            scores = self._model.run(inputs.astype(self._model.dtype, copy=False))
+        except Exception as error:  # pylint: disable=broad-except
+            for future in futures:
+                future.set_exception(error)
+            return
+
+        for future, row in zip(futures, scores):
+            future.set_result(
+                {label: float(score) for label, score in zip(self._labels, row)}
+            )
+        self.batches += 1
+        self.images += len(futures)
+        self.seconds += time.perf_counter() - started
+
+    def _decode(self, image: bytes) -> Any:
+        """Returns an image as a height x width x 3 uint8 array at the
+        model's input resolution.
+        """
+        import numpy as np  # type: ignore
+        from PIL import Image, ImageOps  # type: ignore
+
+        size = (self._model.width, self._model.height)
+        with Image.open(io.BytesIO(image)) as decoded:
+            # decode at a reduced size where the format allows it (JPEG)
+            decoded.draft("RGB", size)
+            rgb = ImageOps.exif_transpose(decoded).convert("RGB")
+        return np.asarray(rgb.resize(size, Image.BILINEAR), dtype=np.uint8)
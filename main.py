@@ -18,32 +18,172 @@ https://cloud.google.com/appengine/docs/standard/python3/quickstart
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import logging
-import platform
-from pprint import pprint
-import random
-from typing import Any, Dict, List
-import uuid
-import base64
-import requests
-
-import pdb
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from flask import Flask, jsonify, request, Response
 import sqlalchemy # type: ignore
 
-from google.cloud import storage  # type: ignore
-from google.cloud import automl_v1beta1 as automl # type: ignore
-
-from util import cloudsql_postgres
+# The Google Cloud clients are created on first use (see clients.py), so
+# that starting an instance doesn't wait on gRPC and credentials.
+import clients
+from admission import AdmissionGate, CircuitBreaker, Overloaded
+from cache import ReadThroughCache
+from captcha_pool import CaptchaPool
+from catalog import ThumbnailCatalog
+from image_fetcher import ImageFetcher, ImageFetchError
+from inference import AutoMLBackend, LocalModelBackend, ModelUnavailable
+from metrics import Metrics
+from mosaic import ByteLRU, render_mosaic
+from preprocess import content_hash, downscale
+from sampler import ImageSampler
+from schema import KNOWN_LABEL, MODEL_CORRECT, captcha_created_at, new_captcha_id
+from tokens import InvalidToken, decode_captcha_token, encode_captcha_token
+from util import cloudsql_postgres, discard_engines_after_fork, pool_stats
+from warmup import WarmUp
+from write_behind import WriteBehindQueue
 
 from config import (STORAGE_BUCKET, DB_USER, DB_PWD, DB_NAME, CSQL_CONNECTION,
                     PROJECT_ID, COMPUTE_REGION, MODEL_ID)
 
-STORAGE_CLIENT = storage.Client()
-AUTOML_CLIENT = automl.AutoMlClient()
-PREDICTION_CLIENT = automl.PredictionServiceClient()
+# seconds between refreshes of the cached thumbnail list
+CATALOG_TTL = float(os.environ.get("CATALOG_TTL", "300"))
+
+# Captcha images are weighted by how often people get them wrong (see
+# sampler.py): seconds between refreshes of the response statistics, how
+# strongly difficulty is favored (0 = uniform), and seconds allowed for a
+# response to be saved before the statistics read it.
+SAMPLER_REFRESH_INTERVAL = float(os.environ.get("SAMPLER_REFRESH_INTERVAL", "300"))
+SAMPLER_DIFFICULTY_WEIGHT = float(os.environ.get("SAMPLER_DIFFICULTY_WEIGHT", "4"))
+SAMPLER_STATS_LAG = float(os.environ.get("SAMPLER_STATS_LAG", "60"))
+
+# size of the pre-generated captcha pool; set the high watermark to 0 to
+# build every captcha inside the request instead
+CAPTCHA_POOL_LOW_WATERMARK = int(os.environ.get("CAPTCHA_POOL_LOW_WATERMARK", "50"))
+CAPTCHA_POOL_HIGH_WATERMARK = int(os.environ.get("CAPTCHA_POOL_HIGH_WATERMARK", "200"))
+
+# prediction cache: max entries, and seconds to keep predictions and failures
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "10000"))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", "3600"))
+PREDICTION_CACHE_NEGATIVE_TTL = float(os.environ.get("PREDICTION_CACHE_NEGATIVE_TTL", "30"))
+
+# /predict/batch: max urls per request, and max concurrent model calls
+PREDICT_BATCH_MAX_URLS = int(os.environ.get("PREDICT_BATCH_MAX_URLS", "100"))
+PREDICT_BATCH_WORKERS = int(os.environ.get("PREDICT_BATCH_WORKERS", "9"))
+
+# seconds to cache the model's confusion matrix for /matrix, and the human
+# and model counts for /confusion
+MATRIX_CACHE_TTL = float(os.environ.get("MATRIX_CACHE_TTL", "3600"))
+CONFUSION_CACHE_TTL = float(os.environ.get("CONFUSION_CACHE_TTL", "5"))
+
+# opt-in warm-up for new instances: how many pool connections to open and
+# how many predictions to load into the cache before reporting ready
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "0") == "1"
+WARMUP_POOL_CONNECTIONS = int(os.environ.get("WARMUP_POOL_CONNECTIONS", "10"))
+WARMUP_PREDICTIONS = int(os.environ.get("WARMUP_PREDICTIONS", "5000"))
+
+# If set, captcha_ids are signed tokens that carry the captcha's images, and
+# captchas and responses are saved in the background (see tokens.py).
+CAPTCHA_TOKEN_SECRET = os.environ.get("CAPTCHA_TOKEN_SECRET", "").encode()
+CAPTCHA_TOKEN_TTL = float(os.environ.get("CAPTCHA_TOKEN_TTL", "900"))
+
+# Save responses and predictions in the background instead of before
+# answering (see write_behind.py). Always on in token mode. The workers of a
+# pre-forked server share the spill file; write_behind.py locks it.
+WRITE_BEHIND_ENABLED = (
+    bool(CAPTCHA_TOKEN_SECRET) or os.environ.get("WRITE_BEHIND_ENABLED", "0") == "1"
+)
+WRITE_BEHIND_SPILL = os.environ.get("WRITE_BEHIND_SPILL", "/tmp/write_behind.jsonl")
+WRITE_BEHIND_MAX_SIZE = int(os.environ.get("WRITE_BEHIND_MAX_SIZE", "10000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "1"))
+# seconds a token-mode response whose captcha isn't saved yet is retried for
+WRITE_BEHIND_RETRY_TTL = float(os.environ.get("WRITE_BEHIND_RETRY_TTL", "3600"))
+# failed writes after which a record is set aside in the spill's .bad file
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", "10"))
+
+# Admission control for AutoML predictions: concurrent calls, calls allowed to
+# wait (and for how many seconds), the per-call deadline, and the circuit
+# breaker's failure threshold and cool-down in seconds.
+PREDICT_MAX_CONCURRENT = int(os.environ.get("PREDICT_MAX_CONCURRENT", "16"))
+PREDICT_MAX_WAITING = int(os.environ.get("PREDICT_MAX_WAITING", "16"))
+PREDICT_WAIT_TIMEOUT = float(os.environ.get("PREDICT_WAIT_TIMEOUT", "0.5"))
+PREDICT_TIMEOUT = float(os.environ.get("PREDICT_TIMEOUT", "10"))
+PREDICT_BREAKER_FAILURES = int(os.environ.get("PREDICT_BREAKER_FAILURES", "5"))
+PREDICT_BREAKER_RESET = float(os.environ.get("PREDICT_BREAKER_RESET", "30"))
+
+# largest image we'll send to the model, and seconds to wait while fetching it
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", "5"))
+
+# /captcha/<captcha_id>/mosaic: tile size in pixels, JPEG quality, seconds
+# clients may cache a mosaic, the byte budgets of the thumbnail and mosaic
+# caches, and the threads that fetch thumbnails (shared by all requests)
+MOSAIC_TILE_SIZE = int(os.environ.get("MOSAIC_TILE_SIZE", "160"))
+MOSAIC_QUALITY = int(os.environ.get("MOSAIC_QUALITY", "80"))
+MOSAIC_MAX_AGE = int(os.environ.get("MOSAIC_MAX_AGE", "86400"))
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", str(64 * 1024 * 1024)))
+MOSAIC_CACHE_BYTES = int(os.environ.get("MOSAIC_CACHE_BYTES", str(32 * 1024 * 1024)))
+MOSAIC_WORKERS = int(os.environ.get("MOSAIC_WORKERS", "18"))
+# seconds a captcha's image urls are cached for its mosaic; they never change,
+# so this only bounds how long a deleted captcha's mosaic can still be drawn
+CAPTCHA_URL_CACHE_TTL = float(os.environ.get("CAPTCHA_URL_CACHE_TTL", "3600"))
+
+# images are scaled down to fit the model's input resolution (in pixels) and
+# re-encoded at this JPEG quality before they're sent to the model
+MODEL_INPUT_SIZE = int(os.environ.get("MODEL_INPUT_SIZE", "512"))
+MODEL_INPUT_QUALITY = int(os.environ.get("MODEL_INPUT_QUALITY", "90"))
+
+# Where predictions come from: "automl" calls the hosted model; "local" runs
+# an exported model (e.g. an AutoML Edge TFLite export of MODEL_ID) in
+# process, scoring concurrent requests together in batches of up to
+# INFERENCE_MAX_BATCH images, collected for at most INFERENCE_MAX_DELAY
+# seconds.
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "automl")
+if INFERENCE_BACKEND not in ("automl", "local"):
+    raise ValueError(f"INFERENCE_BACKEND must be automl or local, not {INFERENCE_BACKEND!r}")
+# decided once here; aio_main.py uses the same flag
+LOCAL_INFERENCE = INFERENCE_BACKEND == "local"
+LOCAL_MODEL_PATH = os.environ.get("LOCAL_MODEL_PATH", "model/model.tflite")
+LOCAL_MODEL_LABELS = os.environ.get("LOCAL_MODEL_LABELS", "model/dict.txt")
+INFERENCE_MAX_BATCH = int(os.environ.get("INFERENCE_MAX_BATCH", "32"))
+INFERENCE_MAX_DELAY = float(os.environ.get("INFERENCE_MAX_DELAY", "0.005"))
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", "2"))
+
+# downloads images for the model, reading our own bucket directly
+IMAGE_FETCHER = ImageFetcher(
+    STORAGE_BUCKET,
+    clients.storage_client,
+    max_bytes=IMAGE_MAX_BYTES,
+    timeout=IMAGE_FETCH_TIMEOUT,
+)
+
+# Gate in front of the model. When AutoML slows down, extra calls are turned
+# away with a 503 instead of tying up every worker thread.
+MODEL_GATE = AdmissionGate(
+    max_concurrent=PREDICT_MAX_CONCURRENT,
+    max_waiting=PREDICT_MAX_WAITING,
+    wait_timeout=PREDICT_WAIT_TIMEOUT,
+    breaker=CircuitBreaker(PREDICT_BREAKER_FAILURES, PREDICT_BREAKER_RESET),
+)
+
+# shared by all /predict/batch requests, so total fan-out stays bounded
+PREDICT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=PREDICT_BATCH_WORKERS, thread_name_prefix="predict"
+)
+
+# Stage timings, per-request database round trips and latency histograms,
+# reported in a Server-Timing header and at /metrics. When off, /metrics
+# still reports the caches, pools and queues.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+METRICS = Metrics(METRICS_ENABLED)
+METRICS.instrument_sqlalchemy()
 
 # If `entrypoint` is not defined in app.yaml, App Engine will look for an app
 # called `app` in `main.py`.
@@ -76,29 +216,15 @@ def list_blobs(bucket_name: str, delimiter: str = "/") -> List[str]:
     Returns:
         List of the public_url values for all blobs in the bucket.
     """
-    blobs = STORAGE_CLIENT.list_blobs(bucket_name, delimiter=delimiter)  # type: ignore
-    return [blob.public_url for blob in blobs]
+    with METRICS.stage("list_blobs"):
+        blobs = clients.storage_client().list_blobs(bucket_name, delimiter=delimiter)  # type: ignore
+        return [blob.public_url for blob in blobs]
 
 
-def pick_images(candidates) -> set:
-    """Returns 9 images from a list of image URLs, assuring that the
-    returned list includes at least one Jamie and one Alice, and no
-    duplicates.
+def list_thumbnails() -> List[str]:
+    """Returns the urls of all thumbnail images in STORAGE_BUCKET.
     """
-    # First select a random Jamie and a random Alice, so that we have at least
-    # one of each.
-    jamies = [image for image in candidates if url_to_label(image) == "jamie"]
-    alices = [image for image in candidates if url_to_label(image) == "alice"]
-    images = set([random.choice(jamies), random.choice(alices)])
-
-    # Next we add 7 more random images, without duplicating any selected images.
-    while len(images) < 9:
-        images.add(random.choice(candidates))
-
-    # Shuffle the list and return it.
-    image_list = list(images)
-    random.shuffle(image_list)
-    return images
+    return [blob for blob in list_blobs(STORAGE_BUCKET) if thumbnail_name(blob)]
 
 
 @app.route('/response/<captcha_id>', methods = ['POST'])
@@ -108,67 +234,364 @@ def response_handler(captcha_id):
     The data structure POSTed to this endpoint is 9 booleans, each
     indicating whether the user correctly identified the corresponding
     image from the captcha.
+
+    Returns 404 if the captcha doesn't exist and 409 if a response has
+    already been submitted for it. With WRITE_BEHIND_ENABLED, the response
+    is saved after this returns, so an unknown captcha_id isn't detected
+    and duplicates are only rejected if this process saw the first one.
     """
     #data = request.form
     data = request.get_json(force=True)
+    successes = {image_no: bool(data[f"image{image_no}"]) for image_no in range(1, 10)}
+
+    status = 200
+    if CAPTCHA_TOKEN_SECRET:
+        try:
+            token = decode_captcha_token(captcha_id, CAPTCHA_TOKEN_SECRET)
+        except InvalidToken:
+            status = 404
+        else:
+            status = queue_responses(token["id"], successes, token["urls"])
+    elif WRITE_BEHIND:
+        status = queue_responses(captcha_id, successes)
+    else:
+        with METRICS.stage("save_responses"):
+            saved = save_responses(captcha_id, successes)
+        if not saved:
+            status = 409 if captcha_exists(captcha_id) else 404
+
+    response = Response(status=status)
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
 
-    # create database connection
-    db_connection = cloudsql_postgres(
-        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+
+# confusion_counts has this many rows per source and label. Each statement
+# adds to a random one, so concurrent transactions rarely wait for each
+# other's row lock; readers sum the shards.
+CONFUSION_SHARDS = 8
+
+UPSERT_CONFUSION_COUNTS = (
+    " ON CONFLICT (source, label, shard) DO UPDATE SET"
+    " correct = confusion_counts.correct + EXCLUDED.correct,"
+    " incorrect = confusion_counts.incorrect + EXCLUDED.incorrect"
+)
+
+
+def counting_responses(insert: str) -> str:
+    """Extends an INSERT INTO responses statement to also add the rows it
+    inserts to the human counts in confusion_counts, in the same statement.
+    Rows without one of our labels aren't counted.
+    """
+    return (
+        f"WITH inserted AS ({insert} RETURNING label, success)"
+        " INSERT INTO confusion_counts (source, label, shard, correct, incorrect)"
+        f" SELECT 'human', label, CAST(floor(random() * {CONFUSION_SHARDS}) AS smallint),"
+        " count(*) FILTER (WHERE success), count(*) FILTER (WHERE NOT success)"
+        f" FROM inserted WHERE {KNOWN_LABEL} GROUP BY label"
+        + UPSERT_CONFUSION_COUNTS
     )
 
-    # save the responses for the individual images
-    for image_no in range(1, 10):
-        success = data[f"image{image_no}"]
-        public_url = get_public_url(captcha_id, image_no, db_connection)
-        save_response(captcha_id, public_url, success, db_connection)
-        pass
 
-    captcha_handled(captcha_id, db_connection) # set submitted_at
+def counting_predictions(insert: str) -> str:
+    """Extends an INSERT INTO predictions statement to also add the rows it
+    inserts to the model counts in confusion_counts, in the same statement.
+    A row skipped by ON CONFLICT, or without one of our labels, isn't
+    counted.
+    """
+    return (
+        f"WITH inserted AS ({insert} RETURNING label, jamie, alice)"
+        " INSERT INTO confusion_counts (source, label, shard, correct, incorrect)"
+        f" SELECT 'model', label, CAST(floor(random() * {CONFUSION_SHARDS}) AS smallint),"
+        f" count(*) FILTER (WHERE {MODEL_CORRECT}),"
+        f" count(*) FILTER (WHERE NOT {MODEL_CORRECT})"
+        f" FROM inserted WHERE {KNOWN_LABEL} GROUP BY label"
+        + UPSERT_CONFUSION_COUNTS
+    )
 
-    response = Response(status=200)
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    return response
 
-def get_public_url(captcha_id, image_no, db_connection):
-    """Get the public_url associated with a captcha_id and image_no.
+def captcha_match(alias: str, captcha_id: str) -> Tuple[str, Dict[str, Any]]:
+    """Returns an SQL condition that finds captcha_id's rows in the captcha
+    or thumbnail table (as alias), and its bound parameters.
+
+    Both tables are partitioned on created_at, which new captcha ids carry
+    (see schema.new_captcha_id()), so the condition names the one partition
+    to read. Older ids are matched on captcha_id alone.
     """
-    result = db_connection.execute(
-        f"SELECT public_url FROM thumbnail WHERE captcha_id = '{captcha_id}' AND image_no = {image_no}")
-    for row in result:
-        public_url = row["public_url"]
+    created_at = captcha_created_at(captcha_id)
+    if created_at is None:
+        return f"{alias}.captcha_id = :captcha_id", {"captcha_id": captcha_id}
+    return (
+        f"{alias}.captcha_id = :captcha_id AND {alias}.created_at = :created_at",
+        {"captcha_id": captcha_id, "created_at": created_at},
+    )
+
 
-    return public_url
+def captchas_match(alias: str, captcha_ids: List[str]) -> Tuple[str, Dict[str, Any]]:
+    """Like captcha_match(), for a batch: returns a condition that limits
+    alias to the partitions holding captcha_ids, and its bound parameters.
+    The condition is TRUE if any id predates time-ordered ids.
+    """
+    created_ats = [captcha_created_at(captcha_id) for captcha_id in captcha_ids]
+    if not created_ats or None in created_ats:
+        return "TRUE", {}
+    return (
+        f"{alias}.created_at BETWEEN :oldest_created_at AND :newest_created_at",
+        {"oldest_created_at": min(created_ats), "newest_created_at": max(created_ats)},
+    )
 
 
-def save_response(captcha_id, public_url, success, db_connection):
-    """Inserts a record in the responses table.
+def insert_responses(condition: str) -> Any:
+    """Returns the statement that inserts one responses row per thumbnail of
+    a captcha, taking public_url and label from the thumbnail rows (alias t)
+    that match condition and success from the bound parameters.
     """
-    stmt = sqlalchemy.text(
-        "INSERT INTO responses (captcha_id, public_url, label, success)"
-        " VALUES (:captcha_id, :public_url, :label, :success)"
+    return sqlalchemy.text(
+        counting_responses(
+            "INSERT INTO responses (captcha_id, public_url, label, success, submitted_at)"
+            " SELECT t.captcha_id, t.public_url, t.label, r.success, :submitted_at"
+            " FROM thumbnail t JOIN (VALUES"
+            + ", ".join(
+                f" ({image_no}, CAST(:success{image_no} AS boolean))"
+                for image_no in range(1, 10)
+            )
+            + ") AS r (image_no, success) ON r.image_no = t.image_no"
+            f" WHERE {condition}"
+        )
     )
-    with db_connection.connect() as conn:
+
+
+def save_responses(captcha_id: str, successes: Dict[int, bool]) -> bool:
+    """Saves a user's response to all 9 images of a captcha.
+
+    Args:
+        captcha_id: the captcha being answered
+        successes: dict that maps image_no (1-9) to whether the user
+                   identified that image correctly
+
+    Returns:
+        True if the responses were saved. False if the captcha doesn't exist
+        or already has a submitted response, in which case nothing is written.
+
+    Setting captcha.submitted_at and inserting the responses happen in one
+    transaction; the update only matches an unsubmitted captcha, so repeated
+    POSTs are rejected without writing anything.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+
+    submitted_at = datetime.datetime.utcnow()
+    with db_connection.begin() as conn:
+        condition, params = captcha_match("captcha", captcha_id)
+        claimed = conn.execute(
+            sqlalchemy.text(
+                "UPDATE captcha SET submitted_at = :submitted_at"
+                f" WHERE {condition} AND submitted_at IS NULL"
+            ),
+            submitted_at=submitted_at,
+            **params,
+        )
+        if claimed.rowcount == 0:
+            return False
+
+        condition, params = captcha_match("t", captcha_id)
         conn.execute(
-            stmt,
-            captcha_id=captcha_id,
-            public_url=public_url,
-            label=url_to_label(public_url),
-            success=success,
+            insert_responses(condition),
+            submitted_at=submitted_at,
+            **params,
+            **{f"success{image_no}": success for image_no, success in successes.items()},
         )
+    return True
 
 
-def captcha_handled(captcha_id, db_connection):
-    # update captcha.submitted_at for this captcha_id
-    stmt = sqlalchemy.text(
-        "UPDATE captcha SET submitted_at = :submitted_at WHERE captcha_id = :captcha_id"
+# ids of captchas answered by this process in write-behind mode; tokens are
+# rejected once they expire, so entries don't need to outlive CAPTCHA_TOKEN_TTL
+SUBMITTED_CAPTCHAS = ReadThroughCache(
+    lambda captcha_id: None, maxsize=100000, ttl=CAPTCHA_TOKEN_TTL
+)
+
+
+def queue_responses(
+    captcha_id: str, successes: Dict[int, bool], urls: Optional[List[str]] = None
+) -> int:
+    """Queues a user's response to be saved by WRITE_BEHIND.
+
+    Args:
+        captcha_id: the captcha being answered (the database id, not a token)
+        successes: dict that maps image_no (1-9) to whether the user
+                   identified that image correctly
+        urls: the 9 image urls, if known (token mode), so the thumbnail table
+              doesn't need to be read when saving
+
+    Returns:
+        HTTP status: 200 if queued, 409 if this process has already accepted
+        a response for the captcha. Duplicates accepted by other processes are
+        dropped when they're saved (see write_responses()).
+    """
+    if not SUBMITTED_CAPTCHAS.put_if_absent(captcha_id, True):
+        return 409
+    WRITE_BEHIND.put(
+        "response",
+        {
+            "captcha_id": captcha_id,
+            "submitted_at": datetime.datetime.utcnow().isoformat(),
+            "successes": [successes[image_no] for image_no in range(1, 10)],
+            "urls": urls,
+        },
+    )
+    return 200
+
+
+def write_responses(records: List[dict]) -> List[dict]:
+    """Write-behind handler that saves a batch of queued responses.
+
+    Args:
+        records: dicts queued by queue_responses()
+
+    Returns:
+        The responses to retry later: those to a token-mode captcha that
+        isn't in the database yet (its own write was spilled), for up to
+        WRITE_BEHIND_RETRY_TTL seconds after they were submitted.
+
+    In one transaction, claims submitted_at for every captcha in the batch
+    that hasn't been answered yet, then inserts responses for the claimed
+    captchas only: rows with known urls in one multi-row insert, and the
+    rest with one INSERT ... SELECT against the thumbnail table. Responses
+    to captchas that were already answered are dropped.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+
+    with db_connection.begin() as conn:
+        condition, params = captchas_match("c", [record["captcha_id"] for record in records])
+        claimed = {
+            row["captcha_id"]
+            for row in conn.execute(
+                sqlalchemy.text(
+                    "UPDATE captcha c SET submitted_at = v.submitted_at"
+                    " FROM unnest(CAST(:captcha_ids AS text[]), CAST(:submitted_ats AS timestamp[]))"
+                    " AS v (captcha_id, submitted_at)"
+                    " WHERE c.captcha_id = v.captcha_id AND c.submitted_at IS NULL"
+                    f" AND {condition}"
+                    " RETURNING c.captcha_id"
+                ),
+                captcha_ids=[record["captcha_id"] for record in records],
+                submitted_ats=[record["submitted_at"] for record in records],
+                **params,
+            )
+        }
+        unclaimed = [record for record in records if record["captcha_id"] not in claimed]
+        retry = []
+        if unclaimed:
+            condition, params = captchas_match(
+                "captcha", [record["captcha_id"] for record in unclaimed]
+            )
+            existing = {
+                row["captcha_id"]
+                for row in conn.execute(
+                    sqlalchemy.text(
+                        "SELECT captcha_id FROM captcha"
+                        " WHERE captcha_id = ANY(CAST(:captcha_ids AS text[]))"
+                        f" AND {condition}"
+                    ),
+                    captcha_ids=[record["captcha_id"] for record in unclaimed],
+                    **params,
+                )
+            }
+            oldest = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=WRITE_BEHIND_RETRY_TTL
+            )
+            # a token's captcha was queued before its response, so it's on
+            # its way unless it has been missing for too long
+            retry = [
+                record
+                for record in unclaimed
+                if record["urls"]
+                and record["captcha_id"] not in existing
+                and datetime.datetime.fromisoformat(record["submitted_at"]) > oldest
+            ]
+            dropped = len(unclaimed) - len(retry)
+            if dropped:
+                logging.warning("dropped %d responses to unknown or answered captchas", dropped)
+        records = [record for record in records if record["captcha_id"] in claimed]
+
+        known_urls = [
+            {
+                "captcha_id": record["captcha_id"],
+                "public_url": url,
+                "label": url_to_label(url),
+                "success": success,
+                "submitted_at": record["submitted_at"],
+            }
+            for record in records
+            if record["urls"]
+            for url, success in zip(record["urls"], record["successes"])
+        ]
+        if known_urls:
+            conn.execute(
+                sqlalchemy.text(
+                    counting_responses(
+                        "INSERT INTO responses"
+                        " (captcha_id, public_url, label, success, submitted_at)"
+                        " VALUES (:captcha_id, :public_url, :label, :success,"
+                        " CAST(:submitted_at AS timestamp))"
+                    )
+                ),
+                known_urls,
+            )
+
+        unknown_urls = [record for record in records if not record["urls"]]
+        if unknown_urls:
+            condition, params = captchas_match(
+                "t", [record["captcha_id"] for record in unknown_urls]
+            )
+            conn.execute(
+                sqlalchemy.text(
+                    counting_responses(
+                        "INSERT INTO responses"
+                        " (captcha_id, public_url, label, success, submitted_at)"
+                        " SELECT t.captcha_id, t.public_url, t.label, r.success, r.submitted_at"
+                        " FROM thumbnail t JOIN unnest("
+                        "CAST(:captcha_ids AS text[]), CAST(:image_nos AS int[]),"
+                        " CAST(:successes AS boolean[]), CAST(:submitted_ats AS timestamp[]))"
+                        " AS r (captcha_id, image_no, success, submitted_at)"
+                        " ON t.captcha_id = r.captcha_id AND t.image_no = r.image_no"
+                        f" WHERE {condition}"
+                    )
+                ),
+                captcha_ids=[record["captcha_id"] for record in unknown_urls for _ in range(9)],
+                submitted_ats=[record["submitted_at"] for record in unknown_urls for _ in range(9)],
+                image_nos=list(range(1, 10)) * len(unknown_urls),
+                successes=[success for record in unknown_urls for success in record["successes"]],
+                **params,
+            )
+    return retry
+
+
+def write_captchas(records: List[dict]) -> None:
+    """Write-behind handler that saves a batch of queued captchas.
+    """
+    save_captchas(
+        [
+            dict(record, created_at=datetime.datetime.fromisoformat(record["created_at"]))
+            for record in records
+        ]
+    )
+
+
+def captcha_exists(captcha_id: str) -> bool:
+    """Returns True if there is a captcha row for captcha_id.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
     )
+    condition, params = captcha_match("captcha", captcha_id)
     with db_connection.connect() as conn:
-        conn.execute(
-            stmt,
-            submitted_at=datetime.datetime.utcnow(),
-            captcha_id=captcha_id,
+        result = conn.execute(
+            sqlalchemy.text(f"SELECT 1 FROM captcha WHERE {condition}"), **params
         )
+        return result.fetchone() is not None
 
 
 def save_captcha(data: dict) -> None:
@@ -178,42 +601,79 @@ def save_captcha(data: dict) -> None:
         data: a dict returned by captcha_api()
 
     Returns:
-        None. The data is stored in the captcha and thumbnail tables.
+        None. The data is stored in the captcha and thumbnail tables. All ten
+        rows are written in one transaction, so a captcha is never saved
+        without its thumbnails.
     """
+    save_captchas([data])
+
+
+def save_captchas(captchas: List[dict]) -> None:
+    """Saves a batch of captchas to the database in one transaction.
+
+    Args:
+        captchas: a list of dicts returned by build_captcha(); each is
+                  saved with the created_at its captcha_id carries (for
+                  older ids, a created_at datetime in the dict, or now)
+
+    Returns:
+        None. The data is stored in the captcha and thumbnail tables, using
+        one multi-row insert per table. Captchas that were already saved
+        are left as they are.
+    """
+    if not captchas:
+        return
 
-    # create database connection
     db_connection = cloudsql_postgres(
         instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
     )
 
-    # insert the captcha row
-    stmt = sqlalchemy.text(
-        "INSERT INTO captcha (created_at, label, captcha_id)"
-        " VALUES (:created_at, :label, :captcha_id)"
-    )
-    with db_connection.connect() as conn:
+    now = datetime.datetime.utcnow()
+    created_ats = {
+        data["captcha_id"]: captcha_created_at(data["captcha_id"]) or data.get("created_at", now)
+        for data in captchas
+    }
+    captcha_rows = [
+        {
+            "created_at": created_ats[data["captcha_id"]],
+            "label": data["label"],
+            "captcha_id": data["captcha_id"],
+        }
+        for data in captchas
+    ]
+    # thumbnails are partitioned on their captcha's created_at
+    thumbnail_rows = [
+        {
+            "public_url": data[f"image{image_no}"]["url"],
+            "image_no": image_no,
+            "captcha_id": data["captcha_id"],
+            "label": url_to_label(data[f"image{image_no}"]["url"]),
+            "created_at": created_ats[data["captcha_id"]],
+        }
+        for data in captchas
+        for image_no in range(1, 10)
+    ]
+
+    # the write-behind queue may replay a batch that was already written
+    # (e.g. if the process died before it could tell), so rows that are
+    # already there are skipped rather than failing the batch
+    with db_connection.begin() as conn:
         conn.execute(
-            stmt,
-            created_at=datetime.datetime.utcnow(),
-            label=data["label"],
-            captcha_id=data["captcha_id"],
+            sqlalchemy.text(
+                "INSERT INTO captcha (created_at, label, captcha_id)"
+                " VALUES (:created_at, :label, :captcha_id)"
+                " ON CONFLICT (captcha_id, created_at) DO NOTHING"
+            ),
+            captcha_rows,
+        )
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO thumbnail (public_url, image_no, captcha_id, label, created_at)"
+                " VALUES (:public_url, :image_no, :captcha_id, :label, :created_at)"
+                " ON CONFLICT (captcha_id, image_no, created_at) DO NOTHING"
+            ),
+            thumbnail_rows,
         )
-
-    # insert the thumbnails rows
-    stmt = sqlalchemy.text(
-        "INSERT INTO thumbnail (public_url, image_no, captcha_id, label)"
-        " VALUES (:public_url, :image_no, :captcha_id, :label)"
-    )
-    for image_no in range(1, 10):
-        image_dict = data[f"image{image_no}"]
-        with db_connection.connect() as conn:
-            conn.execute(
-                stmt,
-                public_url=image_dict["url"],
-                image_no=image_no,
-                captcha_id=data["captcha_id"],
-                label=url_to_label(image_dict["url"]),
-            )
 
 
 def get_prediction_from_db(url: str):
@@ -232,57 +692,192 @@ def get_prediction_from_db(url: str):
         instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
     )
 
+    with db_connection.connect() as conn:
+        row = conn.execute(SELECT_PREDICTION_BY_URL, url=url).fetchone()
+
+    if row is None:
+        return None
+
+    prediction = {'url' : url}
+    for key in row.keys():
+        prediction[key] = row[key]
+
+    return prediction
+
+
+# A url's prediction is the one stored under its content hash (see
+# image_hashes), or, for urls scored before content hashing, under the url.
+SELECT_PREDICTION_BY_URL = sqlalchemy.text(
+    "SELECT jamie, alice FROM predictions"
+    " WHERE public_url = :url"
+    " OR content_hash = (SELECT content_hash FROM image_hashes WHERE public_url = :url)"
+    " LIMIT 1"
+)
+
+
+def get_prediction_by_hash(digest: str) -> Optional[dict]:
+    """Returns the stored scores for an image's content hash, as a dict with
+    keys jamie and alice, or None if that image hasn't been scored.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+    with db_connection.connect() as conn:
+        row = conn.execute(
+            sqlalchemy.text(
+                "SELECT jamie, alice FROM predictions WHERE content_hash = :content_hash"
+            ),
+            content_hash=digest,
+        ).fetchone()
+    if row is None:
+        return None
+    return {"jamie": row["jamie"], "alice": row["alice"]}
+
+
+def get_predictions_from_db(urls: List[str]) -> Dict[str, dict]:
+    """Retrieves the stored predictions for a list of urls in one query.
+
+    Args:
+        urls: a list of public urls of blobs
+
+    Returns:
+        Dict that maps each url that has a stored prediction to a dict as
+        returned by get_prediction_from_db(). Urls without a prediction are
+        left out.
+    """
+    if not urls:
+        return {}
+
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+
     stmt = sqlalchemy.text(
-        "SELECT jamie, alice"
-        " FROM predictions WHERE public_url = :url"
-        " LIMIT 1"
+        "SELECT DISTINCT ON (u.url) u.url AS public_url, p.jamie, p.alice"
+        " FROM unnest(CAST(:urls AS text[])) AS u (url)"
+        " LEFT JOIN image_hashes h ON h.public_url = u.url"
+        " JOIN predictions p ON p.public_url = u.url OR p.content_hash = h.content_hash"
     )
 
     with db_connection.connect() as conn:
-        result = conn.execute(stmt, url=url)
+        rows = conn.execute(stmt, urls=list(urls)).fetchall()
 
-    if result.rowcount == 0:
-        return None
+    return {
+        row["public_url"]: {"url": row["public_url"], "jamie": row["jamie"], "alice": row["alice"]}
+        for row in rows
+    }
 
-    prediction = {'url' : url}
 
-    for row in result:
-            for key in row.keys():
-                prediction[key] = row[key]
+# Counts of images scored by this process: model_calls went to the model,
+# dedup_hits were already scored under another url with the same content.
+PREDICTION_COUNTS = {"model_calls": 0, "dedup_hits": 0}
+_PREDICTION_COUNTS_LOCK = threading.Lock()
 
-    return prediction
-    
+
+def count_prediction(counter: str) -> None:
+    """Adds one to PREDICTION_COUNTS[counter].
+    """
+    with _PREDICTION_COUNTS_LOCK:
+        PREDICTION_COUNTS[counter] += 1
 
 
 def get_prediction_from_api(url: str):
-    """ Retrieves data from prediction table
+    """ Gets a prediction for an image without a stored one
         
         Args:
             url: a string representing the public url of a blob
 
         Returns:
             Dict. A dict containing the labels as keys and the confidence for 
-            each label as values.
+            each label as values, plus the url and the content_hash of the
+            image. If an image with the same content has already been
+            scored, its scores are reused and the model isn't called.
     """
 
-    img_bytes = requests.get(url).content
-    
+    with METRICS.stage("image_fetch"):
+        img_bytes = IMAGE_FETCHER.fetch(url)
+    digest = content_hash(img_bytes)
+
+    with METRICS.stage("hash_lookup"):
+        scores = get_prediction_by_hash(digest)
+    if scores is None:
+        with METRICS.stage("inference"):
+            scores = MODEL_BACKEND.predict([img_bytes])[0]
+        count_prediction("model_calls")
+    else:
+        count_prediction("dedup_hits")
+
+    return ({
+        "url": url,
+        "jamie": scores['jamie'],
+        "alice": scores['alice'],
+        "content_hash": digest,
+    })
+
+
+def predict_image(img_bytes: bytes) -> Dict[str, float]:
+    """Returns the AutoML model's confidence score for each label of an
+    image. The image is scaled down to MODEL_INPUT_SIZE before it's sent.
+
+    Raises:
+        Overloaded: the call was shed by MODEL_GATE.
+    """
+    img_bytes = downscale(img_bytes, MODEL_INPUT_SIZE, MODEL_INPUT_QUALITY)
     payload = {"image": {"image_bytes": img_bytes}}
     params = { "score_threshold": "0.0" }
 
-    model_full_id = AUTOML_CLIENT.model_path(
+    model_full_id = clients.automl_client().model_path(
         PROJECT_ID, COMPUTE_REGION, MODEL_ID
     )
     result = {}
-    response = PREDICTION_CLIENT.predict(model_full_id, payload, params)
+    with MODEL_GATE.admit():
+        response = clients.prediction_client().predict(
+            request={"name": model_full_id, "payload": payload, "params": params},
+            timeout=PREDICT_TIMEOUT,
+        )
     for label in response.payload:
         result[label.display_name] = label.classification.score
 
-    return ({
-        "url": url,
-        "jamie": result['jamie'],
-        "alice": result['alice'],
-    })
+    return result
+
+
+# Scores images for get_prediction_from_api(). The local backend needs no
+# admission control: requests queue for the next batch instead of a slot.
+MODEL_BACKEND = (
+    LocalModelBackend(
+        LOCAL_MODEL_PATH,
+        LOCAL_MODEL_LABELS,
+        max_batch=INFERENCE_MAX_BATCH,
+        max_delay=INFERENCE_MAX_DELAY,
+        threads=INFERENCE_THREADS,
+        timeout=PREDICT_TIMEOUT,
+    )
+    if LOCAL_INFERENCE
+    else AutoMLBackend(predict_image)
+)
+
+
+def prediction_fields(result: dict) -> dict:
+    """Returns the part of a prediction that the API returns (url, jamie and
+    alice), without internal fields such as content_hash.
+    """
+    return {"url": result["url"], "jamie": result["jamie"], "alice": result["alice"]}
+
+
+def prediction_store_stats() -> Dict[str, float]:
+    """Returns how much content hashing saves.
+
+    Returns:
+        Dict with the model_calls and dedup_hits counts of this process,
+        and dedup_ratio, the fraction of the images it scored that were
+        answered from a stored prediction of the same content.
+    """
+    with _PREDICTION_COUNTS_LOCK:
+        counts = dict(PREDICTION_COUNTS)
+    scored = counts["model_calls"] + counts["dedup_hits"]
+    counts["dedup_ratio"] = counts["dedup_hits"] / scored if scored else 0.0
+    return counts
+
 
 def save_prediction(result: dict):
     """ Retrieves data from prediction table
@@ -298,24 +893,62 @@ def save_prediction(result: dict):
         Returns:
             None. Writes data to prediction table
     """
+    save_predictions([result])
+
+
+def save_predictions(results: List[dict]) -> None:
+    """Inserts a batch of predictions in one transaction.
+
+    Args:
+        results: a list of dicts as returned by get_prediction_from_api()
+
+    Returns:
+        None. Writes data to prediction table, one row per content_hash, and
+        maps each url to its content_hash in the image_hashes table.
+    """
+    if not results:
+        return
 
     db_connection = cloudsql_postgres(
         instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
     )
 
-    
-    url = result['url']
-    jamie = result['jamie']
-    alice = result['alice']
+    # a result whose content was already scored conflicts on content_hash
+    # and only adds its url to image_hashes
     stmt = sqlalchemy.text(
-        "INSERT INTO predictions (label, public_url, jamie, alice)"
-        " VALUES (:label, :url, :jamie, :alice)"
-    )
-
-    with db_connection.connect() as conn:
-        conn.execute(
-            stmt,label=url_to_label(url), url=url, jamie=jamie, alice=alice
+        counting_predictions(
+            "INSERT INTO predictions (label, public_url, jamie, alice, content_hash)"
+            " VALUES (:label, :url, :jamie, :alice, :content_hash)"
+            " ON CONFLICT DO NOTHING"
         )
+    )
+    rows = [
+        {
+            "label": url_to_label(result["url"]),
+            "url": result["url"],
+            "jamie": result["jamie"],
+            "alice": result["alice"],
+            "content_hash": result.get("content_hash"),
+        }
+        for result in results
+    ]
+    hashes = [
+        {"url": result["url"], "content_hash": result["content_hash"]}
+        for result in results
+        if result.get("content_hash")
+    ]
+
+    with db_connection.begin() as conn:
+        conn.execute(stmt, rows)
+        if hashes:
+            conn.execute(
+                sqlalchemy.text(
+                    "INSERT INTO image_hashes (public_url, content_hash)"
+                    " VALUES (:url, :content_hash)"
+                    " ON CONFLICT (public_url) DO NOTHING"
+                ),
+                hashes,
+            )
 
 
 def thumbnail_name(blobname: str) -> bool:
@@ -341,6 +974,45 @@ def url_to_label(public_url: str) -> str:
     return public_url.split("/")[-1][:5].lower()
 
 
+# thumbnails in STORAGE_BUCKET, listed in the background and grouped by label
+THUMBNAILS = ThumbnailCatalog(list_thumbnails, url_to_label, ttl=CATALOG_TTL)
+
+
+def load_response_stats(
+    since: datetime.datetime, until: datetime.datetime
+) -> List[Tuple[str, int, int]]:
+    """Returns (public_url, incorrect, total) for each image with responses
+    submitted from since up to until. Only the partitions of responses that
+    cover that range are read.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+    with db_connection.connect() as conn:
+        rows = conn.execute(
+            sqlalchemy.text(
+                "SELECT public_url, count(*) FILTER (WHERE NOT success), count(*)"
+                " FROM responses"
+                " WHERE submitted_at >= :since AND submitted_at < :until"
+                " GROUP BY public_url"
+            ),
+            since=since,
+            until=until,
+        ).fetchall()
+    return [(url, incorrect, total) for url, incorrect, total in rows]
+
+
+# picks captcha images from THUMBNAILS, favoring ones people get wrong
+IMAGE_SAMPLER = ImageSampler(
+    THUMBNAILS.partitions,
+    url_to_label,
+    load_response_stats,
+    refresh_interval=SAMPLER_REFRESH_INTERVAL,
+    difficulty_weight=SAMPLER_DIFFICULTY_WEIGHT,
+    stats_lag=SAMPLER_STATS_LAG,
+)
+
+
 def who_to_identify(images: List[str]) -> str:
     """Determines who should be identified by the user in a list images.
 
@@ -359,6 +1031,60 @@ def who_to_identify(images: List[str]) -> str:
     )
     return "jamie" if jamie_count > alice_count else "alice"
 
+def load_prediction(url: str) -> dict:
+    """Returns the prediction for url from the predictions table, or gets it
+    from the model and saves it if there isn't one yet.
+    """
+    with METRICS.stage("db_lookup"):
+        result = get_prediction_from_db(url)
+    if not result:
+        result = get_prediction_from_api(url)
+        with METRICS.stage("save_prediction"):
+            record_predictions([result])
+        result = prediction_fields(result)
+    return result
+
+
+def score_through_cache(url: str) -> Tuple[dict, Optional[dict]]:
+    """Returns url's prediction from PREDICTION_CACHE, loading it from the
+    model (but not saving it) on a miss.
+
+    Returns:
+        The prediction, and the model's full result (for record_predictions())
+        if this call scored the image, or None if the prediction came from
+        the cache or a load already in progress.
+    """
+    scored: List[dict] = []
+
+    def score(url: str) -> dict:
+        scored.append(get_prediction_from_api(url))
+        return prediction_fields(scored[0])
+
+    prediction = PREDICTION_CACHE.get(url, loader=score)
+    return prediction, scored[0] if scored else None
+
+
+def record_predictions(results: List[dict]) -> None:
+    """Saves new predictions, in the background if WRITE_BEHIND is enabled.
+    """
+    if WRITE_BEHIND:
+        for result in results:
+            WRITE_BEHIND.put("prediction", result)
+    else:
+        save_predictions(results)
+
+
+# In-process cache in front of the predictions table. Concurrent misses for
+# the same url share one model call and one insert.
+PREDICTION_CACHE = ReadThroughCache(
+    load_prediction,
+    maxsize=PREDICTION_CACHE_SIZE,
+    ttl=PREDICTION_CACHE_TTL,
+    negative_ttl=PREDICTION_CACHE_NEGATIVE_TTL,
+    uncached_errors=(Overloaded, ModelUnavailable, concurrent.futures.TimeoutError),
+)
+
+
 @app.route("/predict", methods=["POST"])  # type: ignore
 def return_prediction() -> Dict:
     """Route handler for the API.
@@ -374,11 +1100,7 @@ def return_prediction() -> Dict:
         }
     """
     url = request.get_json(force=True).get('url')
-    result = get_prediction_from_db(url)
-    if not result:
-        result = get_prediction_from_api(url)
-        save_prediction(result)
-    
+    result = PREDICTION_CACHE.get(url)
 
     resp = jsonify(result)
     resp.headers["Access-Control-Allow-Origin"] = "*"
@@ -387,23 +1109,83 @@ def return_prediction() -> Dict:
 
     return resp
 
-@app.route('/matrix', methods=["GET"])
-def get_confusion_matrix():
+@app.route("/predict/batch", methods=["POST"])  # type: ignore
+def return_predictions() -> Any:
     """Route handler for the API.
 
+    The JSON body is {"urls": [<public_url>, ...]}, with at most
+    PREDICT_BATCH_MAX_URLS urls.
+
+    Returns:
+        JSON serialization of a list with one dict per requested url, in the
+        same order, each with the structure returned by /predict.
+    """
+    urls = request.get_json(force=True).get("urls")
+    if (
+        not isinstance(urls, list)
+        or len(urls) > PREDICT_BATCH_MAX_URLS
+        or not all(isinstance(url, str) and thumbnail_name(url) for url in urls)
+    ):
+        return (
+            f"Expected a list of at most {PREDICT_BATCH_MAX_URLS} urls"
+            " of jamie or alice thumbnails.",
+            400,
+        )
+
+    predictions = {}
+    for url in urls:
+        cached = PREDICTION_CACHE.peek(url)
+        if cached:
+            predictions[url] = cached
+
+    # one query for everything that wasn't cached
+    missing = [url for url in dict.fromkeys(urls) if url not in predictions]
+    predictions.update(get_predictions_from_db(missing))
+    for url in missing:
+        if url in predictions:
+            PREDICTION_CACHE.put(url, predictions[url])
+
+    # Score whatever still isn't known, in parallel, through the cache, so a
+    # url that /predict (or another batch) is already scoring isn't scored
+    # twice. Every call is waited for, even if one fails, so that all the
+    # predictions scored here are saved, in one insert.
+    futures = {
+        url: PREDICT_EXECUTOR.submit(score_through_cache, url)
+        for url in missing
+        if url not in predictions
+    }
+    concurrent.futures.wait(futures.values())
+    record_predictions(
+        [
+            future.result()[1]
+            for future in futures.values()
+            if future.exception() is None and future.result()[1] is not None
+        ]
+    )
+    for url, future in futures.items():
+        predictions[url] = future.result()[0]  # raises the first failure
+
+    resp = jsonify([predictions[url] for url in urls])
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers['Content-Type'] = 'application/json'
+    resp.headers['Access-Control-Allow-Methods'] = 'POST'
+
+    return resp
+
+
+def load_confusion_matrix(model_id: str) -> dict:
+    """Gets the confusion matrix of a model's evaluation from AutoML.
+
     Args:
-        None (decorated as a Flask route)
+        model_id: the AutoML model ID
 
     Returns:
-        JSON serialization of a dict that includes the number of correct and incorrect 
-        guesses by the model for each label:
-        {
-            "jamie': "70.96",
-            "alice": "29.04"
-        }
+        Dict with the number of correct and incorrect guesses by the model
+        for each label, as returned by /matrix.
     """
-    model_full_id = AUTOML_CLIENT.model_path(PROJECT_ID, COMPUTE_REGION, MODEL_ID)
-    response = AUTOML_CLIENT.list_model_evaluations(model_full_id)
+    automl_client = clients.automl_client()
+    model_full_id = automl_client.model_path(PROJECT_ID, COMPUTE_REGION, model_id)
+    response = automl_client.list_model_evaluations(parent=model_full_id)
     for element in response:
         # There is evaluation for each class in a model and for overall model.
         # Get only the evaluation of overall model.
@@ -411,12 +1193,12 @@ def get_confusion_matrix():
             model_evaluation_id = element.name.split("/")[-1]
         
     # Resource name for the model evaluation.
-    model_evaluation_full_id = AUTOML_CLIENT.model_evaluation_path(
-        PROJECT_ID, COMPUTE_REGION, MODEL_ID, model_evaluation_id
+    model_evaluation_full_id = automl_client.model_evaluation_path(
+        PROJECT_ID, COMPUTE_REGION, model_id, model_evaluation_id
     )
 
     # Get a model evaluation.
-    model_evaluation = AUTOML_CLIENT.get_model_evaluation(model_evaluation_full_id)
+    model_evaluation = automl_client.get_model_evaluation(name=model_evaluation_full_id)
 
     class_metrics = model_evaluation.classification_evaluation_metrics
     conf_matrix = class_metrics.confusion_matrix
@@ -448,11 +1230,195 @@ def get_confusion_matrix():
             "incorrect": alice_incorrect
         }
     }
-    resp = jsonify(result)
+    return result
+
+
+# Confusion matrix per model ID. The evaluation only changes when the model
+# does, so this saves two AutoML calls on every /matrix request. Nothing
+# needs invalidating: AutoML models are immutable, so a retrained model has
+# a new MODEL_ID (and a new key here) and is served by a new deployment.
+# Entries otherwise expire after MATRIX_CACHE_TTL.
+MATRIX_CACHE = ReadThroughCache(
+    load_confusion_matrix, maxsize=4, ttl=MATRIX_CACHE_TTL, negative_ttl=10
+)
+
+
+def matrix_etag(result: dict) -> str:
+    """Returns the ETag for a confusion matrix returned by /matrix.
+    """
+    return hashlib.sha1(json.dumps(result, sort_keys=True).encode()).hexdigest()
+
+
+@app.route('/matrix', methods=["GET"])
+def get_confusion_matrix():
+    """Route handler for the API.
+
+    Args:
+        None (decorated as a Flask route)
+
+    Returns:
+        JSON serialization of a dict that includes the number of correct and incorrect 
+        guesses by the model for each label:
+        {
+            "jamie": {"correct": 70, "incorrect": 3},
+            "alice": {"correct": 65, "incorrect": 5}
+        }
+
+    The response has an ETag, and a request with a matching If-None-Match
+    header gets an empty 304 response.
+    """
+    result = MATRIX_CACHE.get(MODEL_ID)
+    etag = matrix_etag(result)
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(result)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={int(MATRIX_CACHE_TTL)}"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+# sums the shards of confusion_counts
+SELECT_CONFUSION_COUNTS = (
+    "SELECT source, label, sum(correct), sum(incorrect)"
+    " FROM confusion_counts GROUP BY source, label"
+)
+
+
+def confusion_counts_dict(rows: Sequence[Sequence[Any]]) -> dict:
+    """Converts the rows of SELECT_CONFUSION_COUNTS to the dict returned by
+    /confusion, with zeros for any source and label without a row. Rows for
+    other labels (counted before they were filtered out) are ignored.
+    """
+    result: Dict[str, Dict[str, Dict[str, int]]] = {
+        source: {label: {"correct": 0, "incorrect": 0} for label in ("jamie", "alice")}
+        for source in ("human", "model")
+    }
+    for source, label, correct, incorrect in rows:
+        if label not in result.get(source, {}):
+            continue
+        result[source][label] = {"correct": int(correct), "incorrect": int(incorrect)}
+    return result
+
+
+def load_confusion_counts(key: str) -> dict:
+    """Reads the human and model confusion counts from confusion_counts.
+
+    Returns:
+        Dict with the number of correct and incorrect answers per label, for
+        humans (responses) and the model (predictions), as returned by
+        /confusion. The counts include rows since archived by retention.py.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+    with db_connection.connect() as conn:
+        rows = conn.execute(SELECT_CONFUSION_COUNTS).fetchall()
+    return confusion_counts_dict(rows)
+
+
+# The counts table has at most 2 sources x 2 labels x CONFUSION_SHARDS rows,
+# so a load is cheap; the cache just keeps dashboard polling off the database.
+CONFUSION_CACHE = ReadThroughCache(
+    load_confusion_counts, maxsize=1, ttl=CONFUSION_CACHE_TTL, negative_ttl=1
+)
+
+
+@app.route("/confusion", methods=["GET"])
+def get_confusion_counts():
+    """Route handler for the API.
+
+    Args:
+        None (decorated as a Flask route)
+
+    Returns:
+        JSON serialization of a dict with the number of correct and incorrect
+        answers per label, by people answering captchas and by our model:
+        {
+            "human": {"jamie": {"correct": 812, "incorrect": 40},
+                      "alice": {"correct": 790, "incorrect": 58}},
+            "model": {"jamie": {"correct": 301, "incorrect": 12},
+                      "alice": {"correct": 288, "incorrect": 9}}
+        }
+
+    Unlike /matrix, which reports AutoML's evaluation, these are counted
+    from our own responses and predictions tables as rows are inserted, so
+    reading them never scans those tables.
+    """
+    result = CONFUSION_CACHE.get("counts")
+    etag = matrix_etag(result)
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(result)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={int(CONFUSION_CACHE_TTL)}"
     resp.headers["Access-Control-Allow-Origin"] = "*"
     return resp
 
 
+# Background writer for captchas, responses and predictions, or None if
+# WRITE_BEHIND_ENABLED is off. Captchas are written before responses, since
+# a response can only be saved once its captcha exists.
+WRITE_BEHIND = (
+    WriteBehindQueue(
+        {
+            "captcha": write_captchas,
+            "response": write_responses,
+            "prediction": save_predictions,
+        },
+        WRITE_BEHIND_SPILL,
+        max_size=WRITE_BEHIND_MAX_SIZE,
+        batch_size=WRITE_BEHIND_BATCH_SIZE,
+        flush_interval=WRITE_BEHIND_INTERVAL,
+        max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+    )
+    if WRITE_BEHIND_ENABLED
+    else None
+)
+
+
+def build_captcha() -> dict:
+    """Returns a new random captcha, as a dict with the structure returned
+    by captcha_api(). The captcha is not saved to the database.
+    """
+    with METRICS.stage("pick_images"):
+        images = IMAGE_SAMPLER.pick()  # 9 random thumbnails
+    label = who_to_identify(images)
+    image_dicts = [captcha_dict(image, label) for image in images]
+    # unique identifier, 36 characters, that carries the captcha's created_at
+    captcha_id = new_captcha_id(datetime.datetime.utcnow())
+    return {
+        "captcha_id": captcha_id,
+        "label": label,
+        "image1": image_dicts[0],
+        "image2": image_dicts[1],
+        "image3": image_dicts[2],
+        "image4": image_dicts[3],
+        "image5": image_dicts[4],
+        "image6": image_dicts[5],
+        "image7": image_dicts[6],
+        "image8": image_dicts[7],
+        "image9": image_dicts[8],
+    }
+
+
+# pre-generated captchas, or None if CAPTCHA_POOL_HIGH_WATERMARK is 0
+CAPTCHA_POOL = (
+    CaptchaPool(
+        build_captcha,
+        save_captchas,
+        low_watermark=CAPTCHA_POOL_LOW_WATERMARK,
+        high_watermark=CAPTCHA_POOL_HIGH_WATERMARK,
+    )
+    if CAPTCHA_POOL_HIGH_WATERMARK and not CAPTCHA_TOKEN_SECRET
+    else None
+)
+
+
 @app.route("/", methods=["GET"])  # type: ignore
 @app.route("/captcha", methods=["GET"])  # type: ignore
 def captcha_api() -> Any:
@@ -481,30 +1447,293 @@ def captcha_api() -> Any:
         }
     """
 
-    # create the data structure to be returned
-    blobs = list_blobs(STORAGE_BUCKET)
-    thumbnails = [blob for blob in blobs if thumbnail_name(blob)]
-    images = pick_images(thumbnails)  # 9 random thumbnails
-    label = who_to_identify(images)
-    image_dicts = [captcha_dict(image, label) for image in images]
-    captcha_id = str(uuid.uuid4())  # unique identifier, 36 characters
-    data = {
-        "captcha_id": captcha_id,
-        "label": label,
-        "image1": image_dicts[0],
-        "image2": image_dicts[1],
-        "image3": image_dicts[2],
-        "image4": image_dicts[3],
-        "image5": image_dicts[4],
-        "image6": image_dicts[5],
-        "image7": image_dicts[6],
-        "image8": image_dicts[7],
-        "image9": image_dicts[8],
+    if CAPTCHA_TOKEN_SECRET:
+        # nothing to wait for: the token carries the captcha, and the
+        # database rows are written in the background
+        data = build_captcha()
+        WRITE_BEHIND.put(
+            "captcha", dict(data, created_at=datetime.datetime.utcnow().isoformat())
+        )
+        token = encode_captcha_token(data, CAPTCHA_TOKEN_SECRET, CAPTCHA_TOKEN_TTL)
+        data = dict(data, captcha_id=token)
+    else:
+        data = CAPTCHA_POOL.get() if CAPTCHA_POOL else None
+        if data is None:
+            # no pool, or the pool ran dry; build one while the client waits
+            data = build_captcha()
+            with METRICS.stage("save_captcha"):
+                save_captcha(data)  # save to database
+
+    resp = jsonify(data)
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+def get_captcha_urls(captcha_id: str) -> Optional[List[str]]:
+    """Returns the urls of a captcha's 9 images, image1 first, or None if
+    there is no such captcha.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+    condition, params = captcha_match("thumbnail", captcha_id)
+    with db_connection.connect() as conn:
+        rows = conn.execute(
+            sqlalchemy.text(
+                f"SELECT public_url FROM thumbnail WHERE {condition} ORDER BY image_no"
+            ),
+            **params,
+        ).fetchall()
+    if len(rows) != 9:
+        return None
+    return [row["public_url"] for row in rows]
+
+
+# A captcha's images never change, so its urls are read from the database
+# once. Thumbnails and rendered mosaics are cached by size in bytes.
+CAPTCHA_URL_CACHE = ReadThroughCache(
+    get_captcha_urls, maxsize=10000, ttl=CAPTCHA_URL_CACHE_TTL, negative_ttl=5
+)
+THUMBNAIL_IMAGE_CACHE = ByteLRU(THUMBNAIL_CACHE_BYTES)
+MOSAIC_CACHE = ByteLRU(MOSAIC_CACHE_BYTES)
+
+# fetches the thumbnails of a mosaic in parallel
+MOSAIC_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MOSAIC_WORKERS, thread_name_prefix="mosaic"
+)
+
+
+def captcha_urls(captcha_id: str) -> Optional[List[str]]:
+    """Returns the image urls for a captcha_id (a token in token mode), or
+    None if it isn't a valid captcha.
+    """
+    if CAPTCHA_TOKEN_SECRET:
+        try:
+            return decode_captcha_token(captcha_id, CAPTCHA_TOKEN_SECRET)["urls"]
+        except InvalidToken:
+            return None
+    return CAPTCHA_URL_CACHE.get(captcha_id)
+
+
+def fetch_thumbnail(url: str) -> bytes:
+    """Returns the bytes of a thumbnail, from THUMBNAIL_IMAGE_CACHE if
+    possible.
+    """
+    content = THUMBNAIL_IMAGE_CACHE.get(url)
+    if content is None:
+        content = IMAGE_FETCHER.fetch(url)
+        THUMBNAIL_IMAGE_CACHE.put(url, content)
+    return content
+
+
+def mosaic_etag(urls: List[str]) -> str:
+    """Returns the ETag for the mosaic of a captcha's image urls.
+
+    The mosaic only depends on the urls and the rendering settings, so
+    captchas that share all 9 images in the same order share one mosaic.
+    """
+    key = "\n".join(urls + [f"{MOSAIC_TILE_SIZE}:{MOSAIC_QUALITY}"])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_mosaic(urls: List[str]) -> bytes:
+    """Returns the JPEG mosaic of a captcha's image urls, rendering it if it
+    isn't in MOSAIC_CACHE.
+
+    Raises:
+        ImageFetchError: a thumbnail couldn't be downloaded.
+    """
+    etag = mosaic_etag(urls)
+    mosaic = MOSAIC_CACHE.get(etag)
+    if mosaic is None:
+        with METRICS.stage("thumbnail_fetch"):
+            images = list(MOSAIC_EXECUTOR.map(fetch_thumbnail, urls))
+        with METRICS.stage("render_mosaic"):
+            mosaic = render_mosaic(images, MOSAIC_TILE_SIZE, MOSAIC_QUALITY)
+        MOSAIC_CACHE.put(etag, mosaic)
+    return mosaic
+
+
+@app.route("/captcha/<captcha_id>/mosaic", methods=["GET"])  # type: ignore
+def captcha_mosaic(captcha_id: str) -> Any:
+    """Route handler for the API.
+
+    Returns:
+        A JPEG with the captcha's 9 images in a 3x3 grid, image1-image3 in
+        the top row, so a client can show the captcha with one image request.
+        404 if the captcha doesn't exist.
+
+    The mosaic of a captcha never changes, so the response can be cached by
+    the client and any proxy in between; a request with a matching
+    If-None-Match header gets an empty 304 response.
+    """
+    urls = captcha_urls(captcha_id)
+    if urls is None:
+        resp = Response("Unknown captcha.", status=404)
+        resp.headers["Access-Control-Allow-Origin"] = "*"
+        return resp
+
+    etag = mosaic_etag(urls)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        try:
+            resp = Response(get_mosaic(urls), mimetype="image/jpeg")
+        except ImageFetchError:
+            logging.exception("Failed to fetch the thumbnails of a mosaic.")
+            resp = Response("Couldn't fetch the captcha's images.", status=502)
+            resp.headers["Access-Control-Allow-Origin"] = "*"
+            return resp
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={MOSAIC_MAX_AGE}, immutable"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+def open_pool_connections() -> None:
+    """Opens WARMUP_POOL_CONNECTIONS database connections and returns them to
+    the pool, so early requests don't wait on connection setup.
+    """
+    db_connection = cloudsql_postgres(
+        instance=CSQL_CONNECTION, username=DB_USER, password=DB_PWD, database=DB_NAME
+    )
+    connections = [db_connection.connect() for _ in range(WARMUP_POOL_CONNECTIONS)]
+    for conn in connections:
+        conn.execute(sqlalchemy.text("SELECT 1"))
+        conn.close()
+
+
+def prime_prediction_cache() -> None:
+    """Loads up to WARMUP_PREDICTIONS stored predictions for current
+    thumbnails into the prediction cache.
+    """
+    urls = THUMBNAILS.urls()[:WARMUP_PREDICTIONS]
+    for batch_start in range(0, len(urls), 1000):
+        batch = urls[batch_start : batch_start + 1000]
+        for url, prediction in get_predictions_from_db(batch).items():
+            PREDICTION_CACHE.put(url, prediction)
+
+
+WARM_UP = WarmUp(
+    [
+        ("database_pool", open_pool_connections),
+        ("thumbnail_catalog", THUMBNAILS.refresh),
+        ("image_sampler", IMAGE_SAMPLER.refresh),
+        ("prediction_cache", prime_prediction_cache),
+        ("local_model", MODEL_BACKEND.load)
+        if LOCAL_INFERENCE
+        else ("prediction_channel", clients.connect_prediction_channel),
+    ]
+    + ([("captcha_pool", CAPTCHA_POOL.start)] if CAPTCHA_POOL else [])
+)
+
+
+@app.route("/readyz", methods=["GET"])  # type: ignore
+def readiness() -> Any:
+    """Readiness check for the load balancer.
+
+    Returns:
+        200 once warm-up has finished (or immediately, if WARMUP_ENABLED is
+        off), 503 before that. The body reports the status of each step.
+    """
+    resp = jsonify({"ready": WARM_UP.ready(), "steps": WARM_UP.status()})
+    resp.status_code = 200 if WARM_UP.ready() else 503
+    return resp
+
+
+@app.route("/_ah/warmup", methods=["GET"])  # type: ignore
+def warmup_request() -> Any:
+    """App Engine warmup request handler (see inbound_services in app.yaml).
+
+    Runs warm-up, if it's enabled, and returns once it has finished, so App
+    Engine only sends traffic to the instance after that.
+    """
+    if WARMUP_ENABLED:
+        WARM_UP.start()
+        WARM_UP.wait(timeout=60)
+    return "", 200
+
+
+def component_stats() -> Dict[str, Any]:
+    """Returns the stats() of every cache, pool and queue in this process,
+    keyed by component name.
+    """
+    stats: Dict[str, Any] = {
+        "db_pool": pool_stats(),
+        "prediction_cache": PREDICTION_CACHE.stats(),
+        "matrix_cache": MATRIX_CACHE.stats(),
+        "confusion_cache": CONFUSION_CACHE.stats(),
+        "captcha_url_cache": CAPTCHA_URL_CACHE.stats(),
+        "submitted_captchas": SUBMITTED_CAPTCHAS.stats(),
+        "thumbnail_image_cache": THUMBNAIL_IMAGE_CACHE.stats(),
+        "mosaic_cache": MOSAIC_CACHE.stats(),
+        "model_gate": MODEL_GATE.stats(),
+        "model_backend": MODEL_BACKEND.stats(),
+        "image_fetcher": IMAGE_FETCHER.stats(),
+        "image_sampler": IMAGE_SAMPLER.stats(),
+        "predictions": prediction_store_stats(),
+        "warmup": {"ready": WARM_UP.ready()},
     }
+    if CAPTCHA_POOL:
+        stats["captcha_pool"] = CAPTCHA_POOL.stats()
+    if WRITE_BEHIND:
+        stats["write_behind"] = WRITE_BEHIND.stats()
+    return stats
 
-    save_captcha(data)  # save to database
 
-    resp = jsonify(data)
+@app.route("/metrics", methods=["GET"])  # type: ignore
+def get_metrics() -> Any:
+    """Route handler for Prometheus.
+
+    Returns:
+        Stage and request latency histograms and database round trips per
+        request (if METRICS_ENABLED), and the stats of every cache, pool and
+        queue, in the Prometheus text format.
+    """
+    return Response(
+        METRICS.render(component_stats()), mimetype="text/plain; version=0.0.4"
+    )
+
+
+@app.before_request
+def start_request_timing() -> None:
+    METRICS.start_request()
+
+
+@app.after_request
+def add_server_timing(response: Response) -> Response:
+    # stage durations and database round trips of this request
+    server_timing = METRICS.finish_request(request.endpoint)
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@app.errorhandler(Overloaded)
+def overloaded(e):  # type: ignore
+    # A model call was shed; tell the client when to come back.
+    resp = Response("The prediction service is overloaded.", status=503)
+    resp.headers["Retry-After"] = str(e.retry_after)
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+@app.errorhandler(ModelUnavailable)
+def model_unavailable(e):  # type: ignore
+    # The local model couldn't be loaded; it's retried in the background.
+    logging.error("Prediction failed: %s", e)
+    resp = Response("The prediction model is unavailable.", status=503)
+    resp.headers["Retry-After"] = "5"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+@app.errorhandler(concurrent.futures.TimeoutError)
+def timed_out(e):  # type: ignore
+    # The local model didn't score the image within PREDICT_TIMEOUT.
+    logging.warning("Request timed out: %s", e)
+    resp = Response("The prediction service timed out.", status=503)
+    resp.headers["Retry-After"] = "1"
     resp.headers["Access-Control-Allow-Origin"] = "*"
     return resp
 
@@ -516,6 +1745,37 @@ def server_error(e):  # type: ignore
     return "An internal error occurred.", 500
 
 
+def start_background_work() -> None:
+    """Starts warm-up, or marks the instance ready if warm-up is disabled.
+    """
+    if WARMUP_ENABLED:
+        WARM_UP.start()
+    else:
+        WARM_UP.skip()
+
+
+def reinitialize_after_fork() -> None:
+    """Recreates per-process resources in a pre-forked worker.
+
+    gRPC channels and database connections can't be shared across a fork,
+    and background threads don't survive one, so a worker drops whatever it
+    inherited from the parent and starts its own.
+    """
+    clients.reset_clients()
+    discard_engines_after_fork()
+    THUMBNAILS.reset_after_fork()
+    IMAGE_SAMPLER.reset_after_fork()
+    if CAPTCHA_POOL:
+        CAPTCHA_POOL.clear()
+    start_background_work()
+
+
+# When a pre-forking server imports this module in the parent process (see
+# gunicorn.conf.py), background work is started in each worker instead.
+if os.environ.get("DEFER_BACKGROUND_START") != "1":
+    start_background_work()
+
+
 if __name__ == "__main__":
     # This is used when running locally only. When deploying to Google App
     # Engine, a webserver process such as Gunicorn will serve the app. This
@@ -0,0 +1,242 @@
+"""Request timing and counters, exposed in Prometheus text format.
+
+Handlers wrap their expensive steps in stage("name"). Each stage's time is
+recorded in a latency histogram and, for the current request, reported in
+the response's Server-Timing header along with the number of database round
+trips the request made. When metrics are disabled, stage() returns a shared
+no-op context manager and the request hooks return at once, so the
+instrumentation costs next to nothing.
+"""
+import bisect
+import contextlib
+import contextvars
+import re
+import threading
+import time
+from typing import Any, ContextManager, Dict, Iterator, List, Optional, Sequence
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of the database round trips per request buckets
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+_NOOP = contextlib.nullcontext()
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, as Prometheus expects.
+    """
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self._buckets) + 1)  # the last is +Inf
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        """Returns the exposition lines of this histogram.
+
+        Args:
+            name: the metric name
+            labels: the label pairs, e.g. 'stage="save_captcha"', or ""
+        """
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        prefix = labels + "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            upper = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{prefix}le="{upper}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {total}")
+        lines.append(f"{name}_count{suffix} {count}")
+        return lines
+
+
+class _RequestTimings:
+    """Stage durations and database round trips of one request.
+    """
+
+    __slots__ = ("started", "stages", "db_round_trips", "db_seconds")
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.db_round_trips = 0
+        self.db_seconds = 0.0
+
+
+class Metrics:
+    """Latency histograms per stage and per endpoint, and database round
+    trip counts, for one process.
+
+    Args:
+        enabled: if False, nothing is timed or counted
+    """
+
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._current: contextvars.ContextVar = contextvars.ContextVar("request_timings")
+        self._stages: Dict[str, Histogram] = {}
+        self._requests: Dict[str, Histogram] = {}
+        self._round_trips: Dict[str, Histogram] = {}
+        self.db_round_trips = 0
+
+    def stage(self, name: str) -> ContextManager:
+        """Returns a context manager that times a stage of the current
+        request, or does nothing if metrics are disabled.
+        """
+        if not self.enabled:
+            return _NOOP
+        return self._timed(name)
+
+    def start_request(self) -> None:
+        """Starts collecting timings for the request being handled.
+        """
+        if self.enabled:
+            self._current.set(_RequestTimings())
+
+    def finish_request(self, endpoint: Optional[str]) -> Optional[str]:
+        """Records the request's latency and round trips under endpoint.
+
+        Returns:
+            The value for the request's Server-Timing header, or None if
+            metrics are disabled.
+        """
+        if not self.enabled:
+            return None
+        timings = self._current.get(None)
+        if timings is None:
+            return None
+        self._current.set(None)
+        elapsed = time.perf_counter() - timings.started
+        endpoint = endpoint or "unknown"
+        self._histogram(self._requests, endpoint, LATENCY_BUCKETS).observe(elapsed)
+        self._histogram(self._round_trips, endpoint, ROUND_TRIP_BUCKETS).observe(
+            timings.db_round_trips
+        )
+
+        entries = [
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.stages.items()
+        ]
+        entries.append(
+            f'db;dur={timings.db_seconds * 1000:.1f};desc="{timings.db_round_trips} round trips"'
+        )
+        entries.append(f"total;dur={elapsed * 1000:.1f}")
+        return ", ".join(entries)
+
+    def instrument_sqlalchemy(self) -> None:
+        """Counts and times every statement run through a SQLAlchemy engine,
+        for all engines, including ones created later.
+        """
+        if not self.enabled:
+            return
+        import sqlalchemy  # type: ignore
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany):  # type: ignore
+            conn.info["metrics_started"] = time.perf_counter()
+
+        def after_execute(conn, cursor, statement, parameters, context, executemany):  # type: ignore
+            elapsed = time.perf_counter() - conn.info.pop("metrics_started", time.perf_counter())
+            with self._lock:
+                self.db_round_trips += 1
+            timings = self._current.get(None)
+            if timings is not None:
+                timings.db_round_trips += 1
+                timings.db_seconds += elapsed
+
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine, "before_cursor_execute", before_execute)
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine, "after_cursor_execute", after_execute)
+
+    def render(self, stats: Dict[str, Any], prefix: str = "samoyed") -> str:
+        """Returns all metrics in the Prometheus text exposition format.
+
+        Args:
+            stats: dict that maps a component name to the dict returned by
+                   its stats() method; each number becomes a gauge named
+                   <prefix>_<component>_<key>. A nested dict (e.g. one per
+                   engine or source) becomes a "name" label, and a string
+                   value (e.g. a breaker state) becomes a "value" label on a
+                   gauge of 1.
+            prefix: prefix of every metric name
+        """
+        lines = []
+        for family, histograms, label in (
+            ("stage_seconds", self._stages, "stage"),
+            ("request_seconds", self._requests, "endpoint"),
+            ("request_db_round_trips", self._round_trips, "endpoint"),
+        ):
+            name = f"{prefix}_{family}"
+            lines.append(f"# TYPE {name} histogram")
+            with self._lock:
+                items = sorted(histograms.items())
+            for key, histogram in items:
+                lines.extend(histogram.render(name, f'{label}="{key}"'))
+        lines.append(f"# TYPE {prefix}_db_round_trips_total counter")
+        lines.append(f"{prefix}_db_round_trips_total {self.db_round_trips}")
+
+        for component, values in stats.items():
+            lines.extend(_gauges(f"{prefix}_{_metric_name(component)}", values, ""))
+        return "\n".join(lines) + "\n"
+
+    @contextlib.contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._histogram(self._stages, name, LATENCY_BUCKETS).observe(elapsed)
+            timings = self._current.get(None)
+            if timings is not None:
+                timings.stages[name] = timings.stages.get(name, 0.0) + elapsed
+
+    def _histogram(
+        self, histograms: Dict[str, Histogram], key: str, buckets: Sequence[float]
+    ) -> Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+
+def _metric_name(text: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", text)
+
+
+def _gauges(name: str, values: Any, labels: str) -> List[str]:
+    """Returns gauge lines for a stats() dict, recursing into nested dicts.
+    """
+    if isinstance(values, bool):
+        return [f"{name}{{{labels}}} {int(values)}" if labels else f"{name} {int(values)}"]
+    if isinstance(values, (int, float)):
+        return [f"{name}{{{labels}}} {values}" if labels else f"{name} {values}"]
+    if isinstance(values, str):
+        pair = f'value="{values}"'
+        return [f"{name}{{{labels + ',' if labels else ''}{pair}}} 1"]
+    if not isinstance(values, dict):
+        return []
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, dict) and not labels:
+            # e.g. one entry per engine or per source: make the key a label
+            for inner_key, inner_value in value.items():
+                lines.extend(
+                    _gauges(f"{name}_{_metric_name(inner_key)}", inner_value, f'name="{key}"')
+                )
+        else:
+            lines.extend(_gauges(f"{name}_{_metric_name(str(key))}", value, labels))
+    return lines
@@ -0,0 +1,98 @@
+"""Server-side rendering of a captcha's 9 thumbnails as one 3x3 image.
+
+A client that shows the mosaic makes one image request per captcha instead
+of nine. Thumbnails and finished mosaics are kept in byte-bounded LRU caches,
+since the same thumbnails turn up in many captchas.
+"""
+import collections
+import io
+import threading
+from typing import Dict, Hashable, Optional, Sequence
+
+GRID = 3  # tiles per row and per column
+
+
+class ByteLRU:
+    """LRU cache of bytes values, bounded by their total size.
+
+    Args:
+        max_bytes: total size of the values kept; least recently used
+                   entries are evicted first, and a value larger than this
+                   is never stored
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Returns the value for key, or None if it isn't cached.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """Stores value, evicting the least recently used entries to make
+        room for it.
+        """
+        if len(value) > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= len(old)
+            self._entries[key] = value
+            self.size_bytes += len(value)
+            while self.size_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of entries, their total size and the
+        hit/miss/eviction counters.
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def render_mosaic(images: Sequence[bytes], tile_size: int, quality: int = 85) -> bytes:
+    """Returns a JPEG of images laid out in a 3x3 grid, row by row.
+
+    Args:
+        images: the 9 encoded thumbnails, image1 first
+        tile_size: width and height of each tile in pixels; thumbnails with
+                   a different shape are scaled and center-cropped to fit
+        quality: JPEG quality of the result
+    """
+    # imported on first use, so starting an instance doesn't load Pillow
+    from PIL import Image, ImageOps  # type: ignore
+
+    mosaic = Image.new("RGB", (GRID * tile_size, GRID * tile_size))
+    for position, data in enumerate(images):
+        with Image.open(io.BytesIO(data)) as image:
+            # decode at a reduced size where the format allows it (JPEG)
+            image.draft("RGB", (tile_size, tile_size))
+            tile = ImageOps.fit(image.convert("RGB"), (tile_size, tile_size))
+        row, column = divmod(position, GRID)
+        mosaic.paste(tile, (column * tile_size, row * tile_size))
+
+    output = io.BytesIO()
+    mosaic.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
@@ -0,0 +1,49 @@
+"""Image preprocessing before inference.
+
+Images are identified by a hash of their content, so the same photo stored
+under two urls is only scored once, and are downscaled to the model's input
+resolution before upload, so the model gets a small payload instead of the
+original file.
+"""
+import hashlib
+import io
+
+
+def content_hash(data: bytes) -> str:
+    """Returns the hex SHA-256 of an image's bytes.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def downscale(data: bytes, size: int, quality: int = 90) -> bytes:
+    """Returns an image as an RGB JPEG that fits within size x size pixels.
+
+    Args:
+        data: the encoded image, in any format Pillow can read
+        size: the model's input resolution; larger images are scaled down,
+              keeping their aspect ratio
+        quality: JPEG quality of the re-encoded image
+
+    A JPEG that already fits is returned unchanged, to avoid a lossy
+    re-encode that saves nothing.
+    """
+    # imported on first use, like the clients in clients.py, so starting an
+    # instance doesn't load Pillow
+    from PIL import Image, ImageOps  # type: ignore
+
+    with Image.open(io.BytesIO(data)) as image:
+        if (
+            image.format == "JPEG"
+            and image.mode == "RGB"
+            and max(image.size) <= size
+            and image.getexif().get(0x0112, 1) == 1  # EXIF orientation: upright
+        ):
+            return data
+        # decode at a reduced size where the format allows it (JPEG)
+        image.draft("RGB", (size, size))
+        normalized = ImageOps.exif_transpose(image).convert("RGB")
+    normalized.thumbnail((size, size), Image.LANCZOS)
+
+    output = io.BytesIO()
+    normalized.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
@@ -0,0 +1,107 @@
+"""Bulk pre-scoring of every thumbnail in the bucket.
+
+Predictions are normally created the first time someone asks /predict for an
+image, which makes that first request wait for the model. This script scores
+all thumbnails ahead of time so /predict can answer from the database.
+
+Usage:
+    python prescore.py [--workers N] [--batch-size N] [--checkpoint FILE]
+
+Urls that already have a prediction are skipped, and each scored batch is
+recorded in the checkpoint file, so an interrupted run can just be restarted.
+"""
+import argparse
+import concurrent.futures
+import logging
+import os
+from typing import Iterator, List, Set
+
+# Only main's scoring and saving helpers are used here; don't start its
+# warm-up, captcha pool refill or write-behind flusher.
+os.environ["DEFER_BACKGROUND_START"] = "1"
+
+import main  # noqa: E402  pylint: disable=wrong-import-position
+
+
+def chunks(items: List[str], size: int) -> Iterator[List[str]]:
+    """Yields consecutive slices of items, each at most size long.
+    """
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    """Returns the urls recorded as done in the checkpoint file.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return {line.strip() for line in checkpoint if line.strip()}
+
+
+def score(url: str):
+    """Returns the model's prediction for url, or None if it failed.
+    """
+    try:
+        return main.get_prediction_from_api(url)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception("failed to score %s", url)
+        return None
+
+
+def prescore(workers: int, batch_size: int, checkpoint_path: str) -> int:
+    """Scores every thumbnail that doesn't have a prediction yet.
+
+    Args:
+        workers: maximum number of concurrent model calls
+        batch_size: number of urls looked up, scored and inserted together
+        checkpoint_path: file that records the urls already handled
+
+    Returns:
+        The number of new predictions saved.
+    """
+    done = load_checkpoint(checkpoint_path)
+    urls = [url for url in main.list_thumbnails() if url not in done]
+    logging.info("%d thumbnails to check (%d in checkpoint)", len(urls), len(done))
+
+    saved = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, open(
+        checkpoint_path, "a"
+    ) as checkpoint:
+        for batch in chunks(urls, batch_size):
+            known = main.get_predictions_from_db(batch)
+            missing = [url for url in batch if url not in known]
+            results = [
+                result for result in executor.map(score, missing) if result is not None
+            ]
+            main.save_predictions(results)
+            saved += len(results)
+
+            # failed urls are left out, so the next run retries them
+            scored = {result["url"] for result in results}
+            for url in batch:
+                if url in known or url in scored:
+                    checkpoint.write(url + "\n")
+            checkpoint.flush()
+            logging.info(
+                "batch done: %d already known, %d scored, %d failed",
+                len(known),
+                len(results),
+                len(missing) - len(results),
+            )
+
+    return saved
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Pre-score all thumbnails.")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent model calls")
+    parser.add_argument("--batch-size", type=int, default=200, help="urls per batch")
+    parser.add_argument(
+        "--checkpoint", default="prescore.checkpoint", help="file of urls already done"
+    )
+    args = parser.parse_args()
+    count = prescore(args.workers, args.batch_size, args.checkpoint)
+    logging.info("saved %d new predictions", count)
+    logging.info("content dedup: %s", main.prediction_store_stats())
@@ -0,0 +1,165 @@
+"""Retention job for the monthly partitions of captcha, thumbnail and responses.
+
+Run this daily (e.g. from cron). It:
+    - creates the partitions for the next few months, ahead of time, moving
+      any rows that landed in a default partition into them
+    - warns (and exits 1 at the end) if a default partition still holds
+      rows, i.e. rows outside every monthly partition
+    - deletes captchas that were never answered within the TTL
+    - archives partitions older than the retention period to gzipped CSV
+      files, then detaches and drops them
+
+so the hot tables stay about the same size however long the API runs.
+
+Usage:
+    python retention.py [--retention-months N] [--archive-dir DIR]
+                        [--unsubmitted-ttl-hours N]
+"""
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import re
+import sys
+from typing import Any, Dict, List
+
+import sqlalchemy  # type: ignore
+
+from schema import (MONTHS_AHEAD, PARTITIONED_TABLES, create_month_partitions,
+                    month_start)
+from util import cloudsql_postgres
+
+
+def ensure_partitions(engine: Any, months_ahead: int = MONTHS_AHEAD) -> None:
+    """Creates each table's partitions from this month to months_ahead.
+    """
+    now = datetime.datetime.utcnow()
+    with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            create_month_partitions(
+                conn, table, month_start(now), month_start(now, months_ahead)
+            )
+
+
+def default_partition_rows(engine: Any) -> Dict[str, int]:
+    """Returns the number of rows in each table's default partition, which
+    should be 0 once ensure_partitions() has run.
+    """
+    with engine.connect() as conn:
+        return {
+            table: conn.execute(f"SELECT count(*) FROM {table}_default").scalar()
+            for table in PARTITIONED_TABLES
+        }
+
+
+def purge_unsubmitted(engine: Any, ttl_hours: float) -> int:
+    """Deletes captchas (and their thumbnails) that were created more than
+    ttl_hours ago and never answered.
+
+    Returns:
+        The number of captchas deleted.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=ttl_hours)
+    with engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.text(
+                "DELETE FROM thumbnail t USING captcha c"
+                " WHERE t.captcha_id = c.captcha_id AND t.created_at = c.created_at"
+                " AND c.submitted_at IS NULL AND c.created_at < :cutoff"
+                " AND t.created_at < :cutoff"
+            ),
+            cutoff=cutoff,
+        )
+        result = conn.execute(
+            sqlalchemy.text(
+                "DELETE FROM captcha WHERE submitted_at IS NULL AND created_at < :cutoff"
+            ),
+            cutoff=cutoff,
+        )
+        return result.rowcount
+
+
+def expired_partitions(conn: Any, table: str, retention_months: int) -> List[str]:
+    """Returns table's monthly partitions that end before the retention
+    period, oldest first.
+    """
+    oldest_kept = month_start(datetime.datetime.utcnow(), -retention_months)
+    partitions = conn.execute(
+        sqlalchemy.text(
+            "SELECT c.relname FROM pg_inherits i"
+            " JOIN pg_class c ON c.oid = i.inhrelid"
+            " WHERE i.inhparent = CAST(:table AS regclass)"
+        ),
+        table=table,
+    ).fetchall()
+
+    expired = []
+    for (name,) in partitions:
+        match = re.fullmatch(rf"{table}_p(\d{{4}})(\d{{2}})", name)
+        if match and datetime.date(int(match[1]), int(match[2]), 1) < oldest_kept:
+            expired.append(name)
+    return sorted(expired)
+
+
+def archive_partition(engine: Any, table: str, partition: str, archive_dir: str) -> str:
+    """Copies a partition to archive_dir/<partition>.csv.gz, then detaches
+    and drops it.
+
+    Returns:
+        The path of the archive file.
+    """
+    path = os.path.join(archive_dir, f"{partition}.csv.gz")
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        with gzip.open(path + ".tmp", "wb") as archive:
+            cursor.execute(
+                f"COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)", stream=archive
+            )
+        # only drop the data once the archive is safely on disk
+        os.replace(path + ".tmp", path)
+        conn.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+        conn.execute(f"DROP TABLE {partition}")
+    return path
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Archive and drop old partitions.")
+    parser.add_argument(
+        "--retention-months", type=int, default=3, help="full months of data to keep"
+    )
+    parser.add_argument("--archive-dir", default="archive", help="where to write archives")
+    parser.add_argument(
+        "--unsubmitted-ttl-hours",
+        type=float,
+        default=24,
+        help="delete unanswered captchas older than this",
+    )
+    args = parser.parse_args()
+
+    engine = cloudsql_postgres()
+    os.makedirs(args.archive_dir, exist_ok=True)
+
+    ensure_partitions(engine)
+    stranded = {table: rows for table, rows in default_partition_rows(engine).items() if rows}
+    for table, rows in stranded.items():
+        logging.error(
+            "%s_default holds %d rows outside every monthly partition", table, rows
+        )
+    purged = purge_unsubmitted(engine, args.unsubmitted_ttl_hours)
+    logging.info("purged %d unanswered captchas", purged)
+
+    for table in PARTITIONED_TABLES:
+        with engine.connect() as conn:
+            partitions = expired_partitions(conn, table, args.retention_months)
+        for partition in partitions:
+            path = archive_partition(engine, table, partition, args.archive_dir)
+            logging.info("archived %s to %s", partition, path)
+
+    if stranded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
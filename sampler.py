@@ -0,0 +1,295 @@
+"""Difficulty-weighted sampling of captcha images.
+
+Images that people get wrong more often are shown more often. Each image's
+weight comes from its response history, and draws use Walker's alias method,
+so picking a captcha takes constant time however many thumbnails there are.
+
+A captcha needs 9 different images with at least one of each label. Rather
+than drawing from one table and retrying on duplicates, each label's images
+are split into disjoint random strata, with an alias table per stratum:
+a captcha with j images of the first label draws one image from each of
+that label's j strata and one from each of the other label's 9 - j strata.
+The strata don't overlap, so the 9 images are always different. j itself
+is drawn from its own alias table, following the binomial distribution of
+the label mix that weighted sampling would give.
+"""
+import datetime
+import logging
+import math
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from catalog import LABELS
+
+IMAGES_PER_CAPTCHA = 9
+
+# one label can have at most this many of a captcha's images
+MAX_PER_LABEL = IMAGES_PER_CAPTCHA - 1
+
+
+class NotEnoughImages(Exception):
+    """Raised when the catalog can't make a captcha: it needs 9 images in
+    all, with at least one of each label.
+    """
+
+
+class AliasTable:
+    """Walker's alias table over a list of positive weights.
+
+    draw() returns index i with probability weights[i] / sum(weights), using
+    one random index and one random number.
+    """
+
+    __slots__ = ("_probability", "_alias")
+
+    def __init__(self, weights: Sequence[float]) -> None:
+        size = len(weights)
+        total = sum(weights)
+        scaled = [weight * size / total for weight in weights]
+        self._probability = [1.0] * size
+        self._alias = list(range(size))
+
+        # Vose's construction: pair each underfull slot with an overfull one
+        small = [index for index, value in enumerate(scaled) if value < 1.0]
+        large = [index for index, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probability[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # whatever is left is full, up to rounding error
+
+    def draw(self) -> int:
+        index = int(random.random() * len(self._probability))
+        if random.random() < self._probability[index]:
+            return index
+        return self._alias[index]
+
+
+class _LabelTables:
+    """A label's images split into k disjoint strata, for each k from 1 to
+    MAX_PER_LABEL (or the number of images, if that's smaller).
+    """
+
+    def __init__(self, urls: Tuple[str, ...], weights: List[float]) -> None:
+        self.urls = urls
+        self.total_weight = sum(weights)
+        order = list(range(len(urls)))
+        random.shuffle(order)
+        # strata[k] is a list of k (urls, alias table) pairs
+        self.strata: Dict[int, List[Tuple[Tuple[str, ...], AliasTable]]] = {}
+        for count in range(1, min(MAX_PER_LABEL, len(urls)) + 1):
+            self.strata[count] = [
+                (
+                    tuple(urls[index] for index in order[stratum::count]),
+                    AliasTable([weights[index] for index in order[stratum::count]]),
+                )
+                for stratum in range(count)
+            ]
+
+
+class _Snapshot:
+    """Everything pick() reads; replaced as a whole on each rebuild.
+    """
+
+    def __init__(self, tables: Dict[str, _LabelTables]) -> None:
+        self.tables = tables
+        first, second = (tables[label] for label in LABELS)
+        # possible numbers of first-label images, and their probabilities
+        self.first_counts = list(
+            range(
+                max(1, IMAGES_PER_CAPTCHA - len(second.strata)),
+                len(first.strata) + 1,
+            )
+        )
+        share = first.total_weight / (first.total_weight + second.total_weight)
+        self.first_count_table = AliasTable(
+            [
+                _binomial(IMAGES_PER_CAPTCHA, count, share)
+                # keep every possible mix drawable, however skewed the weights
+                + 1e-9
+                for count in self.first_counts
+            ]
+        )
+
+
+def _binomial(trials: int, successes: int, probability: float) -> float:
+    combinations = math.factorial(trials) // (
+        math.factorial(successes) * math.factorial(trials - successes)
+    )
+    return combinations * probability ** successes * (1 - probability) ** (trials - successes)
+
+
+class ImageSampler:
+    """Picks the 9 images of a captcha, weighted by how often people get
+    each image wrong.
+
+    Args:
+        partitions: callable that returns the thumbnails grouped by label,
+                    e.g. ThumbnailCatalog.partitions
+        labeler: callable that maps a public_url to its label
+        load_stats: callable that takes a start and an end time and returns
+                    (public_url, incorrect, total) for the responses
+                    submitted in between
+        refresh_interval: seconds between background refreshes of the
+                          response statistics and alias tables
+        difficulty_weight: how much more likely an image people always get
+                           wrong is than one they always get right; 0 makes
+                           sampling uniform
+        stats_lag: seconds a response may take to be saved (e.g. by the
+                   write-behind queue); newer responses are left for the
+                   next refresh, so none is missed or counted twice
+
+    An image's weight is 1 + difficulty_weight * (incorrect + 1) / (total + 2):
+    its smoothed error rate, so an image without responses sits in the middle.
+    """
+
+    def __init__(
+        self,
+        partitions: Callable[[], Dict[str, Sequence[str]]],
+        labeler: Callable[[str], str],
+        load_stats: Callable[
+            [datetime.datetime, datetime.datetime], Iterable[Tuple[str, int, int]]
+        ],
+        refresh_interval: float = 300.0,
+        difficulty_weight: float = 4.0,
+        stats_lag: float = 60.0,
+    ) -> None:
+        self._partitions = partitions
+        self._labeler = labeler
+        self._load_stats = load_stats
+        self._refresh_interval = refresh_interval
+        self._difficulty_weight = difficulty_weight
+        self._stats_lag = datetime.timedelta(seconds=stats_lag)
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refreshed_at = 0.0
+        self._snapshot: Optional[_Snapshot] = None
+        # public_url -> [incorrect, total], for responses up to _stats_until
+        self._stats: Dict[str, List[int]] = {}
+        self._stats_until = datetime.datetime(1970, 1, 1)
+        self.picks = 0
+        self.rebuilds = 0
+        self.rebuild_seconds = 0.0
+
+    def pick(self) -> List[str]:
+        """Returns 9 different images, in random order, with at least one
+        of each label.
+
+        Raises:
+            NotEnoughImages: the catalog has too few images for a captcha.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            # first use: build from the catalog without waiting for stats
+            snapshot = self._rebuild()
+        if time.monotonic() - self._refreshed_at > self._refresh_interval:
+            self._refresh_in_background()
+
+        first_count = snapshot.first_counts[snapshot.first_count_table.draw()]
+        images = []
+        for label, count in zip(LABELS, (first_count, IMAGES_PER_CAPTCHA - first_count)):
+            for urls, table in snapshot.tables[label].strata[count]:
+                images.append(urls[table.draw()])
+        random.shuffle(images)
+        self.picks += 1
+        return images
+
+    def refresh(self) -> None:
+        """Adds the responses saved since the last refresh to the statistics,
+        then rebuilds the alias tables of each label whose images or weights
+        changed.
+
+        Raises:
+            NotEnoughImages: the catalog has too few images for a captcha;
+                the previous tables, if any, are kept.
+        """
+        until = datetime.datetime.utcnow() - self._stats_lag
+        added = 0
+        changed = set()
+        for url, incorrect, total in self._load_stats(self._stats_until, until):
+            counts = self._stats.setdefault(url, [0, 0])
+            counts[0] += incorrect
+            counts[1] += total
+            added += total
+            changed.add(self._labeler(url))
+        self._stats_until = until
+        self._rebuild(changed)
+        self._refreshed_at = time.monotonic()
+        if added:
+            logging.info("image sampler refreshed with %d new responses", added)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the number of images with response statistics, picks, and
+        table rebuilds and the time they took.
+        """
+        return {
+            "images_with_stats": len(self._stats),
+            "picks": self.picks,
+            "rebuilds": self.rebuilds,
+            "rebuild_seconds": self.rebuild_seconds,
+        }
+
+    def reset_after_fork(self) -> None:
+        """Resets the lock and refresh flag after a fork, since a refresh
+        thread in the parent doesn't exist in the child.
+        """
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _weight(self, url: str) -> float:
+        incorrect, total = self._stats.get(url, (0, 0))
+        return 1.0 + self._difficulty_weight * (incorrect + 1) / (total + 2)
+
+    def _rebuild(self, reweighted: Iterable[str] = LABELS) -> _Snapshot:
+        """Builds alias tables for the current catalog and statistics.
+
+        Args:
+            reweighted: labels whose weights changed; the tables of other
+                        labels are reused if their images are the same
+        """
+        started = time.perf_counter()
+        partitions = self._partitions()
+        counts = {label: len(partitions[label]) for label in LABELS}
+        if min(counts.values()) < 1 or sum(counts.values()) < IMAGES_PER_CAPTCHA:
+            raise NotEnoughImages(
+                f"A captcha needs {IMAGES_PER_CAPTCHA} images with at least one of"
+                f" each label; the catalog has {counts}"
+            )
+        previous = self._snapshot.tables if self._snapshot else {}
+        tables = {}
+        for label in LABELS:
+            urls = tuple(partitions[label])
+            if label in previous and label not in reweighted and previous[label].urls == urls:
+                tables[label] = previous[label]
+            else:
+                tables[label] = _LabelTables(urls, [self._weight(url) for url in urls])
+        snapshot = _Snapshot(tables)
+        self._snapshot = snapshot
+        self.rebuilds += 1
+        self.rebuild_seconds += time.perf_counter() - started
+        return snapshot
+
+    def _refresh_in_background(self) -> None:
+        """Starts a refresh thread, unless one is already running.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run() -> None:
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                # keep sampling from the previous tables; try again next time
+                logging.exception("image sampler refresh failed")
+                self._refreshed_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="image-sampler", daemon=True).start()
@@ -0,0 +1,479 @@
+"""Database schema for the captcha, thumbnail, responses and predictions tables.
+
+Migrations are numbered and applied in order; the schema_version table
+records which ones have run. The first migration also adopts a database
+whose tables were created by hand, adding any missing keys and indexes;
+the second partitions captcha, thumbnail and responses by month (see
+retention.py for the job that maintains the partitions).
+
+Usage:
+    python schema.py upgrade   apply any pending migrations
+    python schema.py current   print the current schema version
+    python schema.py check     EXPLAIN the hot queries; exit 1 if any of
+                               them would need a sequential scan
+"""
+import argparse
+import datetime
+import logging
+import secrets
+import sys
+from typing import Any, Callable, List, Optional, Tuple
+import uuid
+
+import sqlalchemy  # type: ignore
+
+from util import cloudsql_postgres
+
+# arbitrary key for the advisory lock that serializes concurrent upgrades
+UPGRADE_LOCK_KEY = 7231906
+
+
+def has_primary_key(conn: Any, table: str) -> bool:
+    """Returns True if table has a primary key constraint.
+    """
+    return (
+        conn.execute(
+            sqlalchemy.text(
+                "SELECT 1 FROM pg_constraint"
+                " WHERE conrelid = CAST(:table AS regclass) AND contype = 'p'"
+            ),
+            table=table,
+        ).fetchone()
+        is not None
+    )
+
+
+def migrate_1(conn: Any) -> None:
+    """Tables, keys and indexes used by main.py."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS captcha ("
+        " captcha_id varchar(36) NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " created_at timestamp NOT NULL,"
+        " submitted_at timestamp)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS thumbnail ("
+        " captcha_id varchar(36) NOT NULL,"
+        " image_no smallint NOT NULL,"
+        " public_url text NOT NULL,"
+        " label varchar(5) NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        " captcha_id varchar(36) NOT NULL,"
+        " public_url text NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " success boolean NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS predictions ("
+        " public_url text NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " jamie double precision NOT NULL,"
+        " alice double precision NOT NULL)"
+    )
+
+    # predictions were inserted without a uniqueness check, so concurrent
+    # misses may have stored the same url twice; keep one row per url
+    conn.execute(
+        "DELETE FROM predictions a USING predictions b"
+        " WHERE a.public_url = b.public_url AND a.ctid < b.ctid"
+    )
+
+    primary_keys = [
+        ("captcha", "captcha_id"),  # save_responses / captcha_exists
+        ("thumbnail", "captcha_id, image_no"),  # INSERT_RESPONSES join
+        ("predictions", "public_url"),  # get_prediction_from_db
+    ]
+    for table, columns in primary_keys:
+        if not has_primary_key(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD PRIMARY KEY ({columns})")
+
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS responses_captcha_id_idx ON responses (captcha_id)"
+    )
+
+
+# Tables partitioned by month, and the column each is partitioned on.
+PARTITIONED_TABLES = {
+    "captcha": "created_at",
+    "thumbnail": "created_at",
+    "responses": "submitted_at",
+}
+
+
+def month_start(when: datetime.date, months: int = 0) -> datetime.date:
+    """Returns the first day of the month that is months after when's month.
+    """
+    month_index = when.year * 12 + when.month - 1 + months
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: datetime.date) -> str:
+    """Returns the name of table's partition for month, e.g. captcha_p202610.
+    """
+    return f"{table}_p{month:%Y%m}"
+
+
+def create_month_partitions(
+    conn: Any, table: str, first: datetime.date, last: datetime.date
+) -> None:
+    """Creates table's monthly partitions from first through last, skipping
+    any that already exist.
+
+    Postgres won't create a partition while the default partition holds
+    rows in its range (e.g. rows inserted before the partition existed),
+    so those rows are moved into the new partition: the default partition
+    is detached, the partition created, the rows moved, and the default
+    partition attached again, all in the caller's transaction.
+    """
+    column = PARTITIONED_TABLES[table]
+    default = f"{table}_default"
+    month = first
+    while month <= last:
+        following = month_start(month, 1)
+        partition = partition_name(table, month)
+        stranded = (
+            conn.execute(
+                sqlalchemy.text("SELECT to_regclass(:partition) IS NULL"), partition=partition
+            ).scalar()
+            and conn.execute(
+                sqlalchemy.text("SELECT to_regclass(:default) IS NOT NULL"), default=default
+            ).scalar()
+            and conn.execute(
+                sqlalchemy.text(
+                    f"SELECT EXISTS (SELECT 1 FROM {default}"
+                    f" WHERE {column} >= :month AND {column} < :following)"
+                ),
+                month=month,
+                following=following,
+            ).scalar()
+        )
+        if stranded:
+            logging.warning("moving %s rows from %s to %s", table, default, partition)
+            conn.execute(f"ALTER TABLE {table} DETACH PARTITION {default}")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition}"
+            f" PARTITION OF {table}"
+            f" FOR VALUES FROM ('{month}') TO ('{following}')"
+        )
+        if stranded:
+            conn.execute(
+                f"INSERT INTO {table} SELECT * FROM {default}"
+                f" WHERE {column} >= '{month}' AND {column} < '{following}'"
+            )
+            conn.execute(
+                f"DELETE FROM {default}"
+                f" WHERE {column} >= '{month}' AND {column} < '{following}'"
+            )
+            conn.execute(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT")
+        month = following
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# how far ahead of this process's clock another process's clock may be
+MAX_CLOCK_SKEW = datetime.timedelta(hours=1)
+
+
+def new_captcha_id(created_at: datetime.datetime) -> str:
+    """Returns a new captcha_id that carries created_at, to the millisecond.
+
+    captcha_id alone isn't unique in the partitioned tables, and a lookup
+    by captcha_id alone has to probe every partition. The id is a version 7
+    (time-ordered) UUID, so captcha_created_at() gets the partition key
+    back from the id and queries can name the partition.
+    """
+    millis = (created_at - _EPOCH) // datetime.timedelta(milliseconds=1)
+    value = millis << 80 | secrets.randbits(80)
+    value = value & ~(0xF << 76) | 0x7 << 76  # version 7
+    value = value & ~(0x3 << 62) | 0x2 << 62  # RFC 4122 variant
+    return str(uuid.UUID(int=value))
+
+
+def captcha_created_at(captcha_id: str) -> Optional[datetime.datetime]:
+    """Returns the created_at encoded in a captcha_id made by new_captcha_id(),
+    or None for other ids (e.g. the random UUIDs of older captchas, or a
+    crafted id whose time is out of range or in the future).
+    """
+    try:
+        parsed = uuid.UUID(captcha_id)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if parsed.version != 7:
+        return None
+    try:
+        created_at = _EPOCH + datetime.timedelta(milliseconds=parsed.int >> 80)
+    except (OverflowError, ValueError):
+        return None
+    # a time this far ahead didn't come from new_captcha_id(); it would only
+    # name a partition that doesn't exist
+    if created_at > datetime.datetime.utcnow() + MAX_CLOCK_SKEW:
+        return None
+    return created_at
+
+
+def migrate_2(conn: Any) -> None:
+    """Partition captcha, thumbnail and responses by month."""
+    # move the existing tables (and their index names) out of the way
+    for table in PARTITIONED_TABLES:
+        conn.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned")
+        indexes = conn.execute(
+            sqlalchemy.text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+            table=f"{table}_unpartitioned",
+        ).fetchall()
+        for (index,) in indexes:
+            conn.execute(f"ALTER INDEX {index} RENAME TO {index[:50]}_unpartitioned")
+
+    # The partition key has to be part of every primary key, so thumbnail
+    # gets its captcha's created_at and responses gets submitted_at.
+    conn.execute(
+        "CREATE TABLE captcha ("
+        " captcha_id varchar(36) NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " created_at timestamp NOT NULL,"
+        " submitted_at timestamp,"
+        " PRIMARY KEY (captcha_id, created_at))"
+        " PARTITION BY RANGE (created_at)"
+    )
+    conn.execute(
+        "CREATE TABLE thumbnail ("
+        " captcha_id varchar(36) NOT NULL,"
+        " image_no smallint NOT NULL,"
+        " public_url text NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " created_at timestamp NOT NULL,"
+        " PRIMARY KEY (captcha_id, image_no, created_at))"
+        " PARTITION BY RANGE (created_at)"
+    )
+    conn.execute(
+        "CREATE TABLE responses ("
+        " captcha_id varchar(36) NOT NULL,"
+        " public_url text NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " success boolean NOT NULL,"
+        " submitted_at timestamp NOT NULL)"
+        " PARTITION BY RANGE (submitted_at)"
+    )
+    conn.execute("CREATE INDEX responses_captcha_id_idx ON responses (captcha_id)")
+
+    # a partition for every month with data, plus a few months ahead, and a
+    # default partition so an insert never fails for lack of one
+    oldest = conn.execute("SELECT min(created_at) FROM captcha_unpartitioned").scalar()
+    now = datetime.datetime.utcnow()
+    for table in PARTITIONED_TABLES:
+        create_month_partitions(
+            conn, table, month_start(oldest or now), month_start(now, MONTHS_AHEAD)
+        )
+        conn.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+    conn.execute(
+        "INSERT INTO captcha (captcha_id, label, created_at, submitted_at)"
+        " SELECT captcha_id, label, created_at, submitted_at FROM captcha_unpartitioned"
+    )
+    conn.execute(
+        "INSERT INTO thumbnail (captcha_id, image_no, public_url, label, created_at)"
+        " SELECT t.captcha_id, t.image_no, t.public_url, t.label, c.created_at"
+        " FROM thumbnail_unpartitioned t"
+        " JOIN captcha_unpartitioned c ON c.captcha_id = t.captcha_id"
+    )
+    conn.execute(
+        "INSERT INTO responses (captcha_id, public_url, label, success, submitted_at)"
+        " SELECT r.captcha_id, r.public_url, r.label, r.success,"
+        " coalesce(c.submitted_at, c.created_at, now())"
+        " FROM responses_unpartitioned r"
+        " LEFT JOIN captcha_unpartitioned c ON c.captcha_id = r.captcha_id"
+    )
+    for table in PARTITIONED_TABLES:
+        conn.execute(f"DROP TABLE {table}_unpartitioned")
+
+
+def migrate_3(conn: Any) -> None:
+    """Key predictions by image content hash."""
+    # url -> hash of the image's bytes, so urls with the same content share
+    # one predictions row
+    conn.execute(
+        "CREATE TABLE image_hashes ("
+        " public_url text PRIMARY KEY,"
+        " content_hash varchar(64) NOT NULL)"
+    )
+    conn.execute("CREATE INDEX image_hashes_content_hash_idx ON image_hashes (content_hash)")
+    # rows scored before this migration have no hash and are found by url
+    conn.execute("ALTER TABLE predictions ADD COLUMN content_hash varchar(64)")
+    conn.execute(
+        "CREATE UNIQUE INDEX predictions_content_hash_idx ON predictions (content_hash)"
+    )
+
+
+def migrate_4(conn: Any) -> None:
+    """Human and model confusion counts, maintained on insert."""
+    # one row per source ("human" or "model"), label and shard; see
+    # main.counting_responses() and main.counting_predictions()
+    conn.execute(
+        "CREATE TABLE confusion_counts ("
+        " source varchar(5) NOT NULL,"
+        " label varchar(5) NOT NULL,"
+        " shard smallint NOT NULL,"
+        " correct bigint NOT NULL,"
+        " incorrect bigint NOT NULL,"
+        " PRIMARY KEY (source, label, shard))"
+    )
+    # counts for the rows saved so far; from here on, every insert into
+    # responses or predictions adds its own rows
+    conn.execute(
+        "INSERT INTO confusion_counts (source, label, shard, correct, incorrect)"
+        " SELECT 'human', label, 0,"
+        " count(*) FILTER (WHERE success), count(*) FILTER (WHERE NOT success)"
+        f" FROM responses WHERE {KNOWN_LABEL} GROUP BY label"
+    )
+    conn.execute(
+        "INSERT INTO confusion_counts (source, label, shard, correct, incorrect)"
+        " SELECT 'model', label, 0,"
+        f" count(*) FILTER (WHERE {MODEL_CORRECT}),"
+        f" count(*) FILTER (WHERE NOT {MODEL_CORRECT})"
+        f" FROM predictions WHERE {KNOWN_LABEL} GROUP BY label"
+    )
+
+
+# SQL condition that is true for the rows counted in confusion_counts: any
+# url can be scored, but only thumbnails have one of our labels
+KNOWN_LABEL = "label IN ('jamie', 'alice')"
+
+# SQL condition that is true when a predictions row scores its own label
+# highest; a tie counts as incorrect
+MODEL_CORRECT = "CASE label WHEN 'jamie' THEN jamie > alice ELSE alice > jamie END"
+
+# number of future monthly partitions kept ready (see retention.py)
+MONTHS_AHEAD = 2
+
+# (version, migration function), in the order they must be applied
+MIGRATIONS: List[Tuple[int, Callable[[Any], None]]] = [
+    (1, migrate_1),
+    (2, migrate_2),
+    (3, migrate_3),
+    (4, migrate_4),
+]
+
+# Queries on the request path, with sample parameters, that must be able to
+# use an index.
+HOT_QUERIES = [
+    # captcha ids carry their created_at (see new_captcha_id()), so these
+    # read a single partition
+    (
+        "claim captcha",
+        "UPDATE captcha SET submitted_at = now()"
+        " WHERE captcha_id = 'x' AND created_at = now()::timestamp AND submitted_at IS NULL",
+    ),
+    (
+        "captcha exists",
+        "SELECT 1 FROM captcha WHERE captcha_id = 'x' AND created_at = now()::timestamp",
+    ),
+    (
+        "thumbnail by image_no",
+        "SELECT public_url FROM thumbnail"
+        " WHERE captcha_id = 'x' AND created_at = now()::timestamp AND image_no = 1",
+    ),
+    (
+        "thumbnails of captcha",
+        "SELECT * FROM thumbnail WHERE captcha_id = 'x' AND created_at = now()::timestamp",
+    ),
+    ("responses of captcha", "SELECT * FROM responses WHERE captcha_id = 'x'"),
+    (
+        "prediction by url",
+        "SELECT jamie, alice FROM predictions WHERE public_url = 'x'"
+        " OR content_hash = (SELECT content_hash FROM image_hashes WHERE public_url = 'x')",
+    ),
+    (
+        "prediction by content hash",
+        "SELECT jamie, alice FROM predictions WHERE content_hash = 'x'",
+    ),
+    (
+        "predictions by urls",
+        "SELECT DISTINCT ON (u.url) u.url, p.jamie, p.alice"
+        " FROM unnest(ARRAY['x', 'y']) AS u (url)"
+        " LEFT JOIN image_hashes h ON h.public_url = u.url"
+        " JOIN predictions p ON p.public_url = u.url OR p.content_hash = h.content_hash",
+    ),
+]
+
+
+def current_version(conn: Any) -> int:
+    """Returns the highest applied migration, or 0 for an empty database.
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        " version integer PRIMARY KEY,"
+        " description text NOT NULL,"
+        " applied_at timestamp NOT NULL)"
+    )
+    return conn.execute("SELECT coalesce(max(version), 0) FROM schema_version").scalar()
+
+
+def upgrade(engine: Any) -> int:
+    """Applies every pending migration, each in its own transaction.
+
+    Returns:
+        The schema version after upgrading.
+    """
+    version = 0
+    for target, migration in MIGRATIONS:
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"), key=UPGRADE_LOCK_KEY)
+            version = current_version(conn)
+            if target <= version:
+                continue
+            logging.info("applying migration %d: %s", target, migration.__doc__)
+            migration(conn)
+            conn.execute(
+                sqlalchemy.text(
+                    "INSERT INTO schema_version (version, description, applied_at)"
+                    " VALUES (:version, :description, :applied_at)"
+                ),
+                version=target,
+                description=migration.__doc__,
+                applied_at=datetime.datetime.utcnow(),
+            )
+            version = target
+    return version
+
+
+def check(engine: Any) -> List[str]:
+    """EXPLAINs each of HOT_QUERIES with sequential scans disabled.
+
+    The tables may be small enough that the planner prefers a sequential
+    scan anyway, so enable_seqscan is turned off: if a plan still contains
+    a sequential scan, no index can serve that query.
+
+    Returns:
+        The names of the hot queries that can't use an index.
+    """
+    failures = []
+    with engine.connect() as conn:
+        for name, query in HOT_QUERIES:
+            with conn.begin() as transaction:
+                conn.execute("SET LOCAL enable_seqscan = off")
+                plan = "\n".join(row[0] for row in conn.execute(f"EXPLAIN {query}"))
+                transaction.rollback()
+            if "Seq Scan" in plan:
+                failures.append(name)
+                logging.error("%s needs a sequential scan:\n%s", name, plan)
+            else:
+                logging.info("%s: ok", name)
+    return failures
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Manage the database schema.")
+    parser.add_argument("command", choices=["upgrade", "current", "check"])
+    args = parser.parse_args()
+
+    db_engine = cloudsql_postgres()
+    if args.command == "upgrade":
+        print(f"schema version {upgrade(db_engine)}")
+    elif args.command == "current":
+        with db_engine.connect() as connection:
+            print(f"schema version {current_version(connection)}")
+    else:
+        sys.exit(1 if check(db_engine) else 0)
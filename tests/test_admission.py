@@ -0,0 +1,232 @@
+"""Tests for admission: the circuit breaker and the admission gates."""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import AdmissionGate, AsyncAdmissionGate, CircuitBreaker, Overloaded
+
+
+class Clock:
+    """Stands in for time.monotonic, moved forward by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def open_breaker(breaker, failures=3):
+    for _ in range(failures):
+        assert breaker.allow()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    open_breaker(breaker, 2)
+    breaker.record_success()  # resets the count
+    open_breaker(breaker, 2)
+    assert breaker.state == "closed"
+    open_breaker(breaker, 1)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.rejecting()
+    clock.now += 10
+    assert breaker.retry_after() == 20
+
+
+def test_half_open_breaker_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert not breaker.rejecting()
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    assert breaker.rejecting()
+
+
+def test_successful_trial_closes_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+    # it takes a full run of failures to open it again
+    open_breaker(breaker, 2)
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_reopens_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_gate_records_outcomes_on_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    gate = AdmissionGate(2, 2, 0.1, breaker)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            with gate.admit():
+                raise RuntimeError("backend error")
+    assert breaker.state == "open"
+
+    with pytest.raises(Overloaded) as shed:
+        with gate.admit():
+            pytest.fail("call ran while the breaker was open")
+    assert shed.value.retry_after == 30
+    assert gate.stats() == {"in_flight": 0, "waiting": 0, "rejected": 1, "breaker": "open"}
+
+    clock.now += 30
+    with gate.admit():
+        pass
+    assert breaker.state == "closed"
+
+
+def test_gate_rejects_when_the_wait_queue_is_full():
+    gate = AdmissionGate(1, 1, 5.0, CircuitBreaker())
+    running = threading.Event()
+    release = threading.Event()
+    outcomes = []
+
+    def call():
+        try:
+            with gate.admit():
+                running.set()
+                release.wait(5)
+            outcomes.append("ran")
+        except Overloaded:
+            outcomes.append("shed")
+
+    holder = threading.Thread(target=call)
+    holder.start()
+    assert running.wait(5)
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    while gate.stats()["waiting"] < 1:
+        time.sleep(0.001)
+
+    with pytest.raises(Overloaded) as shed:
+        with gate.admit():
+            pytest.fail("call ran past a full queue")
+    assert shed.value.retry_after == 1
+
+    release.set()
+    holder.join(5)
+    waiter.join(5)
+    assert outcomes == ["ran", "ran"]
+    assert gate.stats() == {"in_flight": 0, "waiting": 0, "rejected": 1, "breaker": "closed"}
+
+
+def test_gate_rejects_after_the_wait_timeout():
+    gate = AdmissionGate(1, 5, 0.01, CircuitBreaker())
+    with gate.admit():
+        with pytest.raises(Overloaded, match="Timed out"):
+            with gate.admit():
+                pytest.fail("two calls ran at once")
+    assert gate.stats()["rejected"] == 1
+    with gate.admit():
+        pass
+
+
+
+# these use the real clock, which the event loop's timers need
+
+
+def test_async_gate_records_outcomes_on_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    gate = AsyncAdmissionGate(2, 2, 0.1, breaker)
+
+    async def calls():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                async with gate.admit():
+                    raise RuntimeError("backend error")
+        assert breaker.state == "open"
+        with pytest.raises(Overloaded, match="failing"):
+            async with gate.admit():
+                pytest.fail("call ran while the breaker was open")
+        await asyncio.sleep(0.05)
+        async with gate.admit():
+            pass
+
+    asyncio.run(calls())
+    assert gate.stats() == {"in_flight": 0, "waiting": 0, "rejected": 1, "breaker": "closed"}
+
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0)
+
+
+def test_async_gate_sheds_past_its_limits():
+    gate = AsyncAdmissionGate(1, 1, 0.05, CircuitBreaker())
+    release = None
+
+    async def call():
+        async with gate.admit():
+            await release.wait()
+
+    async def calls():
+        nonlocal release
+        release = asyncio.Event()
+        holder = asyncio.ensure_future(call())
+        await until(lambda: gate.in_flight == 1)
+        # waits for the slot, and times out
+        waiter = asyncio.ensure_future(call())
+        await until(lambda: gate.waiting == 1)
+        # no room to wait
+        with pytest.raises(Overloaded, match="Too many"):
+            await call()
+        with pytest.raises(Overloaded, match="Timed out"):
+            await waiter
+        release.set()
+        await holder
+        await call()
+
+    asyncio.run(calls())
+    assert gate.stats() == {"in_flight": 0, "waiting": 0, "rejected": 2, "breaker": "closed"}
+
+
+def test_cancelled_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    gate = AsyncAdmissionGate(1, 1, 0.1, breaker)
+
+    async def call():
+        async with gate.admit():
+            await asyncio.sleep(10)
+
+    async def calls():
+        trial = asyncio.ensure_future(call())
+        await until(lambda: gate.in_flight == 1)
+        assert breaker.state == "half_open"
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    asyncio.run(calls())
+    assert breaker.state == "open"
+    assert gate.stats()["in_flight"] == 0
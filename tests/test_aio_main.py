@@ -0,0 +1,43 @@
+"""Tests for how aio_main starts up."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("quart")
+pytest.importorskip("config")
+
+
+def import_aio_main(**environ):
+    """Imports aio_main in a new interpreter, and prints the names of the
+    threads running afterwards.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), **environ)
+    env.pop("DEFER_BACKGROUND_START", None)
+    return subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import threading, aio_main; print(sorted(t.name for t in threading.enumerate()))",
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+def test_import_starts_none_of_mains_background_work():
+    result = import_aio_main(WARMUP_ENABLED="1")
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "['MainThread']"
+
+
+@pytest.mark.parametrize(
+    "setting", [{"CAPTCHA_TOKEN_SECRET": "secret"}, {"WRITE_BEHIND_ENABLED": "1"}]
+)
+def test_unsupported_settings_fail_at_startup(setting):
+    result = import_aio_main(**setting)
+    assert result.returncode != 0
+    assert "aio_main doesn't support" in result.stderr
@@ -0,0 +1,230 @@
+"""Tests for cache.ReadThroughCache: TTLs, eviction and single-flight loads."""
+import threading
+import time
+
+import pytest
+
+import cache
+from cache import ReadThroughCache
+
+
+class Clock:
+    """Stands in for time.monotonic, moved forward by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+class Loader:
+    def __init__(self, results=None):
+        self.calls = []
+        self.results = results or {}
+
+    def __call__(self, key):
+        self.calls.append(key)
+        result = self.results.get(key, key.upper())
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+class BadKey(Exception):
+    def __init__(self, key):
+        super().__init__(key)
+        self.key = key
+
+
+def test_values_are_kept_until_the_ttl(clock):
+    loader = Loader()
+    rtc = ReadThroughCache(loader, ttl=60)
+    assert rtc.get("a") == "A"
+    clock.now += 59
+    assert rtc.get("a") == "A"
+    assert loader.calls == ["a"]
+    clock.now += 2
+    assert rtc.get("a") == "A"
+    assert loader.calls == ["a", "a"]
+    assert rtc.stats() == {"size": 1, "hits": 1, "misses": 2, "negative_hits": 0, "coalesced": 0}
+
+
+def test_none_is_remembered_for_the_negative_ttl(clock):
+    loader = Loader({"missing": None})
+    rtc = ReadThroughCache(loader, ttl=60, negative_ttl=5)
+    assert rtc.get("missing") is None
+    assert rtc.get("missing") is None
+    assert loader.calls == ["missing"]
+    assert rtc.peek("missing") is None
+    clock.now += 6
+    assert rtc.get("missing") is None
+    assert loader.calls == ["missing", "missing"]
+    assert rtc.stats()["negative_hits"] == 1
+
+
+def traceback_depth(error):
+    depth = 0
+    traceback = error.__traceback__
+    while traceback:
+        depth += 1
+        traceback = traceback.tb_next
+    return depth
+
+
+def test_failures_are_raised_again_as_fresh_copies(clock):
+    original = BadKey("bad")
+    loader = Loader({"bad": original})
+    rtc = ReadThroughCache(loader, negative_ttl=5)
+    with pytest.raises(BadKey) as first:
+        rtc.get("bad")
+    assert first.value is original
+    depth = traceback_depth(original)
+
+    raised = []
+    for _ in range(3):
+        with pytest.raises(BadKey) as hit:
+            rtc.get("bad")
+        raised.append(hit.value)
+    assert loader.calls == ["bad"]
+    assert len({id(error) for error in raised}) == 3
+    for error in raised:
+        assert error is not original
+        assert error.args == ("bad",) and error.key == "bad"
+        assert error.__cause__ is original
+    # the original's traceback doesn't grow with each hit
+    assert traceback_depth(original) == depth
+
+    clock.now += 6
+    with pytest.raises(BadKey):
+        rtc.get("bad")
+    assert loader.calls == ["bad", "bad"]
+
+
+def test_uncached_errors_are_never_remembered(clock):
+    loader = Loader({"busy": TimeoutError("shed")})
+    rtc = ReadThroughCache(loader, negative_ttl=5, uncached_errors=(TimeoutError,))
+    for _ in range(3):
+        with pytest.raises(TimeoutError):
+            rtc.get("busy")
+    assert loader.calls == ["busy"] * 3
+    assert rtc.stats()["size"] == 0
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    loader = Loader()
+    rtc = ReadThroughCache(loader, maxsize=2)
+    rtc.get("a")
+    rtc.get("b")
+    rtc.get("a")  # b is now the least recently used
+    rtc.get("c")
+    assert rtc.peek("a") == "A"
+    assert rtc.peek("b") is None
+    assert rtc.peek("c") == "C"
+
+
+def test_put_if_absent_keeps_an_unexpired_value(clock):
+    rtc = ReadThroughCache(Loader(), ttl=60)
+    assert rtc.put_if_absent("a", 1)
+    assert not rtc.put_if_absent("a", 2)
+    assert rtc.get("a") == 1
+    clock.now += 61
+    assert rtc.put_if_absent("a", 3)
+    assert rtc.get("a") == 3
+
+
+def test_invalidate(clock):
+    loader = Loader()
+    rtc = ReadThroughCache(loader)
+    rtc.get("a")
+    rtc.get("b")
+    rtc.invalidate("a")
+    assert rtc.peek("a") is None and rtc.peek("b") == "B"
+    rtc.invalidate()
+    assert rtc.stats()["size"] == 0
+
+
+def test_loader_override_is_used_on_a_miss_only(clock):
+    loader = Loader()
+    rtc = ReadThroughCache(loader)
+    assert rtc.get("a", loader=lambda key: "override") == "override"
+    assert rtc.get("a", loader=lambda key: "unused") == "override"
+    assert loader.calls == []
+
+
+def test_concurrent_misses_share_one_load():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_loader(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return key.upper()
+
+    rtc = ReadThroughCache(slow_loader)
+    results = []
+
+    def get():
+        results.append(rtc.get("a"))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while rtc.stats()["coalesced"] < 7:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ["a"]
+    assert results == ["A"] * 8
+    assert rtc.stats()["misses"] == 1
+
+
+def test_followers_of_a_failed_load_get_their_own_copies():
+    started = threading.Event()
+    release = threading.Event()
+    original = BadKey("bad")
+
+    def failing_loader(key):
+        started.set()
+        release.wait(5)
+        raise original
+
+    rtc = ReadThroughCache(failing_loader, uncached_errors=(BadKey,))
+    errors = []
+
+    def get():
+        try:
+            rtc.get("bad")
+        except BadKey as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=get) for _ in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while rtc.stats()["coalesced"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(errors) == 4
+    assert sum(error is original for error in errors) == 1
+    assert len({id(error) for error in errors}) == 4
+    assert all(error.__cause__ is original for error in errors if error is not original)
+    # an uncached error isn't remembered, even though followers saw it
+    assert rtc.stats()["size"] == 0
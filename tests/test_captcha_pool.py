@@ -0,0 +1,105 @@
+"""Tests for captcha_pool: the pre-generated captcha queue and its producer."""
+import itertools
+import threading
+import time
+
+import pytest
+
+from captcha_pool import CaptchaPool
+
+
+def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+class Store:
+    """Builds numbered captchas and records the batches persisted."""
+
+    def __init__(self, failures=0):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.batches = []
+        self.failures = failures
+        self.open = threading.Event()
+        self.open.set()
+
+    def build(self):
+        return {"captcha_id": next(self._ids)}
+
+    def persist(self, batch):
+        self.open.wait()
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                raise OSError("database unavailable")
+            self.batches.append([captcha["captcha_id"] for captcha in batch])
+
+
+def test_watermarks_must_be_ordered():
+    with pytest.raises(ValueError):
+        CaptchaPool(dict, list, low_watermark=5, high_watermark=5)
+    with pytest.raises(ValueError):
+        CaptchaPool(dict, list, low_watermark=0, high_watermark=5)
+
+
+def test_first_get_misses_and_starts_filling_in_batches():
+    store = Store()
+    store.open.clear()
+    pool = CaptchaPool(store.build, store.persist, low_watermark=2, high_watermark=5, batch_size=2)
+    assert pool.get() is None
+    store.open.set()
+    until(lambda: pool.depth() == 5)
+    assert store.batches == [[1, 2], [3, 4], [5]]
+    # captchas are served in the order they were persisted
+    assert [pool.get()["captcha_id"] for _ in range(3)] == [1, 2, 3]
+    assert pool.stats() == {
+        "depth": 2,
+        "low_watermark": 2,
+        "high_watermark": 5,
+        "served": 3,
+        "misses": 1,
+        "produced": 5,
+    }
+
+
+def test_dropping_below_the_low_watermark_refills_to_the_high_one():
+    store = Store()
+    pool = CaptchaPool(store.build, store.persist, low_watermark=2, high_watermark=5, batch_size=5)
+    pool.start()
+    until(lambda: pool.depth() == 5)
+    pool.get()
+    pool.get()
+    pool.get()
+    pool.get()  # leaves 1, below the low watermark
+    until(lambda: pool.depth() == 5)
+    assert store.batches == [[1, 2, 3, 4, 5], [6, 7, 8, 9]]
+
+
+def test_clear_discards_queued_captchas():
+    store = Store()
+    pool = CaptchaPool(store.build, store.persist, low_watermark=2, high_watermark=5)
+    pool.start()
+    until(lambda: pool.depth() == 5)
+    store.open.clear()
+    pool.clear()
+    assert pool.depth() == 0
+    assert pool.get() is None
+    store.open.set()
+    until(lambda: pool.depth() == 5)
+    # none of the discarded captchas is served
+    assert pool.get()["captcha_id"] > 5
+
+
+def test_a_failed_batch_is_retried_on_the_next_wakeup():
+    store = Store(failures=1)
+    pool = CaptchaPool(store.build, store.persist, low_watermark=2, high_watermark=5, batch_size=5)
+    pool.start()
+    until(lambda: store.failures == 0)
+    assert pool.get() is None  # wakes the producer
+    until(lambda: pool.depth() == 5)
+    # the failed batch was never queued
+    assert store.batches == [[6, 7, 8, 9, 10]]
+    assert pool.stats()["produced"] == 5
@@ -0,0 +1,96 @@
+"""Tests for catalog.ThumbnailCatalog."""
+import time
+
+import pytest
+
+import catalog
+from catalog import ThumbnailCatalog
+
+JAMIE = "https://storage.googleapis.com/bucket/jamie001.jpg"
+ALICE = "https://storage.googleapis.com/bucket/alice001.jpg"
+
+
+class Clock:
+    """Stands in for time.monotonic, moved forward by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(catalog.time, "monotonic", clock)
+    return clock
+
+
+class Bucket:
+    """A loader whose listing can be changed or made to fail."""
+
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self.error = None
+        self.listings = 0
+
+    def __call__(self):
+        self.listings += 1
+        if self.error:
+            raise self.error
+        return self.urls
+
+
+def labeler(url):
+    return url.split("/")[-1][:5]
+
+
+def wait_for_refresh(thumbnails):
+    # the refresh thread clears the flag when it's done
+    for _ in range(1000):
+        if not thumbnails._refreshing:
+            return
+        time.sleep(0.001)
+    raise AssertionError("refresh didn't finish")
+
+
+def test_first_read_lists_the_bucket(clock):
+    thumbnails = ThumbnailCatalog(Bucket([JAMIE, ALICE]), labeler, ttl=60)
+    assert thumbnails.partitions() == {"jamie": (JAMIE,), "alice": (ALICE,)}
+    assert thumbnails.urls() == [JAMIE, ALICE]
+
+
+def test_stale_read_refreshes_in_the_background(clock):
+    bucket = Bucket([JAMIE])
+    thumbnails = ThumbnailCatalog(bucket, labeler, ttl=60)
+    thumbnails.partitions()
+    bucket.urls.append(ALICE)
+    clock.now += 61
+    thumbnails.partitions()
+    wait_for_refresh(thumbnails)
+    assert thumbnails.partitions()["alice"] == (ALICE,)
+    assert bucket.listings == 2
+
+
+def test_failed_refresh_waits_for_the_ttl_before_retrying(clock):
+    bucket = Bucket([JAMIE, ALICE])
+    thumbnails = ThumbnailCatalog(bucket, labeler, ttl=60)
+    thumbnails.partitions()
+    bucket.error = OSError("storage unavailable")
+    clock.now += 61
+    thumbnails.partitions()
+    wait_for_refresh(thumbnails)
+    assert bucket.listings == 2
+
+    # the previous snapshot is served, without listing the bucket again
+    for _ in range(10):
+        assert thumbnails.partitions() == {"jamie": (JAMIE,), "alice": (ALICE,)}
+    wait_for_refresh(thumbnails)
+    assert bucket.listings == 2
+
+    bucket.error = None
+    clock.now += 61
+    thumbnails.partitions()
+    wait_for_refresh(thumbnails)
+    assert bucket.listings == 3
@@ -0,0 +1,50 @@
+"""Tests for image_fetcher.ImageFetcher's reads from our bucket."""
+import pytest
+
+pytest.importorskip("requests")
+
+from image_fetcher import ImageFetcher, ImageFetchError  # noqa: E402
+
+
+class Blob:
+    """Stands in for a storage Blob, recording how it was downloaded."""
+
+    def __init__(self, content):
+        self.content = content
+        self.calls = []
+
+    def download_as_bytes(self, start=None, end=None, timeout=None):
+        self.calls.append({"start": start, "end": end, "timeout": timeout})
+        return self.content[start : end + 1]
+
+
+class Client:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def bucket(self, name):
+        assert name == "bucket"
+        return self
+
+    def blob(self, name):
+        return self.blobs[name]
+
+
+def fetcher(blobs, **kwargs):
+    return ImageFetcher("bucket", lambda: Client(blobs), **kwargs)
+
+
+def test_bucket_reads_are_bounded_in_time_and_size():
+    blob = Blob(b"x" * 10)
+    content = fetcher({"jamie001.jpg": blob}, max_bytes=100, timeout=3.0).fetch(
+        "https://storage.googleapis.com/bucket/jamie001.jpg"
+    )
+    assert content == b"x" * 10
+    assert blob.calls == [{"start": 0, "end": 100, "timeout": 3.0}]
+
+
+def test_too_large_bucket_image_is_rejected():
+    images = fetcher({"alice001.jpg": Blob(b"x" * 11)}, max_bytes=10)
+    with pytest.raises(ImageFetchError):
+        images.fetch("https://storage.googleapis.com/bucket/alice001.jpg")
+    assert images.stats()["gcs"]["errors"] == 1
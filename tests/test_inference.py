@@ -0,0 +1,128 @@
+"""Tests for inference: the AutoML and local model backends."""
+import concurrent.futures
+import io
+import threading
+
+import pytest
+
+import inference
+from inference import AutoMLBackend, LocalModelBackend, ModelUnavailable
+
+np = pytest.importorskip("numpy")
+image_module = pytest.importorskip("PIL.Image")
+
+
+def jpeg(color):
+    output = io.BytesIO()
+    image_module.new("RGB", (8, 8), color).save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+class FakeModel:
+    """Scores each image by its mean red and blue, recording batch sizes."""
+
+    width = height = 4
+    dtype = np.uint8
+
+    def __init__(self, gate=None):
+        self.batch_sizes = []
+        self._gate = gate
+
+    def run(self, batch):
+        if self._gate is not None:
+            self._gate.wait()
+        self.batch_sizes.append(len(batch))
+        return batch[..., [0, 2]].mean(axis=(1, 2)) / 255.0
+
+
+class Backend(LocalModelBackend):
+    """A LocalModelBackend whose model is loaded from a list of outcomes."""
+
+    def __init__(self, outcomes, **kwargs):
+        super().__init__("model.tflite", "dict.txt", **kwargs)
+        self.outcomes = list(outcomes)
+        self.loads = 0
+
+    def _load(self):
+        self.loads += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        self._labels = ["jamie", "alice"]
+        self._model = outcome
+
+
+def test_automl_backend_scores_images_one_at_a_time():
+    backend = AutoMLBackend(lambda image: {"jamie": len(image) / 10})
+    assert backend.predict([b"a", b"abc"]) == [{"jamie": 0.1}, {"jamie": 0.3}]
+    backend.load()
+    assert backend.stats() == {}
+
+
+def test_concurrent_images_are_scored_in_one_batch():
+    gate = threading.Event()
+    model = FakeModel(gate)
+    backend = Backend([model], max_batch=8, max_delay=0.5)
+    red, blue = jpeg((255, 0, 0)), jpeg((0, 0, 255))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(backend.predict, [red, blue])
+        second = executor.submit(backend.predict, [blue])
+        gate.set()
+        scores = first.result(timeout=5) + second.result(timeout=5)
+    assert model.batch_sizes == [3]
+    assert scores[0]["jamie"] > 0.9 and scores[0]["alice"] < 0.1
+    assert scores[1]["jamie"] < 0.1 and scores[1]["alice"] > 0.9
+    assert scores[2] == scores[1]
+    stats = backend.stats()
+    assert (stats["batches"], stats["images"], stats["loaded"]) == (1, 3, True)
+
+
+def test_an_undecodable_image_fails_on_its_own():
+    model = FakeModel()
+    backend = Backend([model], max_delay=0.0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        good = executor.submit(backend.predict, [jpeg((255, 0, 0))])
+        bad = executor.submit(backend.predict, [b"not an image"])
+        assert good.result(timeout=5)[0]["jamie"] > 0.9
+        with pytest.raises(Exception):
+            bad.result(timeout=5)
+
+
+def test_predict_times_out_when_the_model_is_slow():
+    gate = threading.Event()
+    backend = Backend([FakeModel(gate)], max_delay=0.0, timeout=0.1)
+    try:
+        with pytest.raises(concurrent.futures.TimeoutError):
+            backend.predict([jpeg((255, 0, 0))])
+    finally:
+        gate.set()
+
+
+def test_a_failed_load_is_retried_after_the_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(inference.time, "monotonic", lambda: now[0])
+    backend = Backend([OSError("read error"), FakeModel()], max_delay=0.0, retry_interval=5.0)
+
+    with pytest.raises(ModelUnavailable) as raised:
+        backend.load()
+    assert isinstance(raised.value.__cause__, OSError)
+    # within the retry interval predictions fail without another load
+    with pytest.raises(ModelUnavailable):
+        backend.predict([jpeg((255, 0, 0))])
+    assert backend.loads == 1
+    assert backend.stats()["load_failures"] == 1
+
+    now[0] += 5.0
+    assert backend.predict([jpeg((255, 0, 0))])[0]["jamie"] > 0.9
+    assert backend.loads == 2
+    assert backend.stats()["load_failures"] == 0
+
+
+def test_load_retries_back_off_exponentially(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(inference.time, "monotonic", lambda: now[0])
+    backend = Backend([OSError("read error")] * 3, retry_interval=5.0)
+    for expected in (5.0, 10.0, 20.0):
+        backend._retry_load_at = 0.0
+        backend._try_load()
+        assert backend._retry_load_at == now[0] + expected
@@ -0,0 +1,225 @@
+"""Tests for main: route behavior that doesn't need the database or GCS."""
+import concurrent.futures
+import io
+import os
+import sqlite3
+import time
+
+import pytest
+
+# no warm-up, pool refill or write-behind thread in tests
+os.environ.setdefault("DEFER_BACKGROUND_START", "1")
+main = pytest.importorskip("main")
+
+from admission import Overloaded  # noqa: E402
+from cache import ReadThroughCache  # noqa: E402
+from image_fetcher import ImageFetchError  # noqa: E402
+from inference import ModelUnavailable  # noqa: E402
+from mosaic import ByteLRU  # noqa: E402
+
+THUMBNAIL = "https://storage.googleapis.com/bucket/jamie001.jpg"
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def failing_predictions(monkeypatch, error):
+    def load(url):
+        raise error
+
+    monkeypatch.setattr(
+        main,
+        "PREDICTION_CACHE",
+        ReadThroughCache(load, uncached_errors=main.PREDICTION_CACHE._uncached_errors),
+    )
+
+
+@pytest.mark.parametrize(
+    "error, retry_after",
+    [
+        (Overloaded("Backend is failing", 7), "7"),
+        (ModelUnavailable("no model"), "5"),
+        (concurrent.futures.TimeoutError(), "1"),
+    ],
+)
+def test_prediction_failures_are_503s(client, monkeypatch, error, retry_after):
+    failing_predictions(monkeypatch, error)
+    resp = client.post("/predict", json={"url": THUMBNAIL})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == retry_after
+    assert resp.headers["Access-Control-Allow-Origin"] == "*"
+
+
+def test_batch_saves_every_scored_prediction_when_one_fails(client, monkeypatch):
+    slow, failing = (THUMBNAIL.replace("001", number) for number in ("002", "003"))
+
+    def score(url):
+        if url == failing:
+            raise ValueError("unreadable image")
+        if url == slow:
+            time.sleep(0.2)  # finishes well after the failure
+        return {"url": url, "jamie": 0.9, "alice": 0.1, "content_hash": "h" + url[-7:-4]}
+
+    saved = []
+    monkeypatch.setattr(main, "PREDICTION_CACHE", ReadThroughCache(main.load_prediction))
+    monkeypatch.setattr(main, "get_predictions_from_db", lambda urls: {})
+    monkeypatch.setattr(main, "get_prediction_from_api", score)
+    monkeypatch.setattr(main, "record_predictions", saved.append)
+
+    resp = client.post("/predict/batch", json={"urls": [failing, THUMBNAIL, slow]})
+    assert resp.status_code == 500
+    assert len(saved) == 1
+    assert sorted(result["url"] for result in saved[0]) == [THUMBNAIL, slow]
+    assert main.PREDICTION_CACHE.peek(slow) == {"url": slow, "jamie": 0.9, "alice": 0.1}
+
+
+def test_batch_saves_only_what_it_scored(client, monkeypatch):
+    other = THUMBNAIL.replace("001", "002")
+    saved = []
+    monkeypatch.setattr(main, "PREDICTION_CACHE", ReadThroughCache(main.load_prediction))
+    main.PREDICTION_CACHE.put(THUMBNAIL, {"url": THUMBNAIL, "jamie": 0.2, "alice": 0.8})
+    monkeypatch.setattr(main, "get_predictions_from_db", lambda urls: {})
+    monkeypatch.setattr(
+        main,
+        "get_prediction_from_api",
+        lambda url: {"url": url, "jamie": 0.9, "alice": 0.1, "content_hash": "h"},
+    )
+    monkeypatch.setattr(main, "record_predictions", saved.append)
+
+    resp = client.post("/predict/batch", json={"urls": [THUMBNAIL, other, THUMBNAIL]})
+    assert resp.status_code == 200
+    assert resp.get_json() == [
+        {"url": THUMBNAIL, "jamie": 0.2, "alice": 0.8},
+        {"url": other, "jamie": 0.9, "alice": 0.1},
+        {"url": THUMBNAIL, "jamie": 0.2, "alice": 0.8},
+    ]
+    assert saved == [[{"url": other, "jamie": 0.9, "alice": 0.1, "content_hash": "h"}]]
+
+
+def test_predict_scores_any_url(client, monkeypatch):
+    # only thumbnails are counted in /confusion, but any image can be scored
+    url = "https://example.com/dog.jpg"
+    prediction = {"url": url, "jamie": 0.5, "alice": 0.5}
+    monkeypatch.setattr(main, "PREDICTION_CACHE", ReadThroughCache(lambda url: prediction))
+    resp = client.post("/predict", json={"url": url})
+    assert resp.status_code == 200
+    assert resp.get_json() == prediction
+
+
+def test_confusion_counts_ignore_unknown_labels():
+    rows = [
+        ("human", "jamie", 3, 1),
+        ("model", "alice", 2, 2),
+        # counted before unknown labels were filtered out
+        ("model", "dog.j", 1, 0),
+    ]
+    assert main.confusion_counts_dict(rows) == {
+        "human": {"jamie": {"correct": 3, "incorrect": 1}, "alice": {"correct": 0, "incorrect": 0}},
+        "model": {"jamie": {"correct": 0, "incorrect": 0}, "alice": {"correct": 2, "incorrect": 2}},
+    }
+
+
+def counted(statement, columns, rows):
+    """Runs the counting half of a counting_*() statement over rows standing
+    in for the ones its insert returned, and returns (source, label, correct,
+    incorrect) per label. SQLite's random() isn't Postgres', so the shard is
+    left out.
+    """
+    counting = statement[statement.index(" SELECT '") : statement.index(" ON CONFLICT")]
+    conn = sqlite3.connect(":memory:")
+    conn.execute(f"CREATE TABLE inserted ({', '.join(columns)})")
+    conn.executemany(f"INSERT INTO inserted VALUES ({', '.join('?' * len(columns))})", rows)
+    return sorted(
+        (source, label, correct, incorrect)
+        for source, label, _, correct, incorrect in conn.execute(counting)
+    )
+
+
+def test_counting_responses_counts_the_inserted_rows_by_label():
+    statement = main.counting_responses("INSERT INTO responses SELECT 1")
+    assert statement.startswith(
+        "WITH inserted AS (INSERT INTO responses SELECT 1 RETURNING label, success)"
+    )
+    assert statement.endswith(main.UPSERT_CONFUSION_COUNTS)
+    rows = [("jamie", True), ("jamie", True), ("jamie", False), ("alice", False), ("dog.j", True)]
+    assert counted(statement, ["label", "success"], rows) == [
+        ("human", "alice", 0, 1),
+        ("human", "jamie", 2, 1),
+    ]
+
+
+def test_counting_predictions_counts_ties_as_incorrect():
+    statement = main.counting_predictions("INSERT INTO predictions SELECT 1")
+    assert statement.startswith(
+        "WITH inserted AS (INSERT INTO predictions SELECT 1 RETURNING label, jamie, alice)"
+    )
+    assert statement.endswith(main.UPSERT_CONFUSION_COUNTS)
+    rows = [
+        ("jamie", 0.9, 0.1),
+        ("jamie", 0.5, 0.5),
+        ("alice", 0.2, 0.8),
+        ("alice", 0.7, 0.3),
+        # any url can be scored, but only thumbnails are counted
+        ("dog.j", 0.9, 0.1),
+    ]
+    assert counted(statement, ["label", "jamie", "alice"], rows) == [
+        ("model", "alice", 1, 1),
+        ("model", "jamie", 1, 1),
+    ]
+
+
+class Fetcher:
+    """Stands in for main.IMAGE_FETCHER, serving small JPEGs."""
+
+    def __init__(self, fail=False):
+        self.fetched = []
+        self.fail = fail
+
+    def fetch(self, url):
+        if self.fail:
+            raise ImageFetchError("storage unavailable")
+        self.fetched.append(url)
+        image_module = pytest.importorskip("PIL.Image")
+        output = io.BytesIO()
+        image_module.new("RGB", (30, 30), (200, 0, 0)).save(output, format="JPEG")
+        return output.getvalue()
+
+
+@pytest.fixture
+def mosaics(monkeypatch):
+    urls = [THUMBNAIL.replace("001", f"00{image_no}") for image_no in range(1, 10)]
+    captchas = {"c1": urls}
+    monkeypatch.setattr(main, "CAPTCHA_URL_CACHE", ReadThroughCache(captchas.get))
+    monkeypatch.setattr(main, "THUMBNAIL_IMAGE_CACHE", ByteLRU(10 ** 6))
+    monkeypatch.setattr(main, "MOSAIC_CACHE", ByteLRU(10 ** 6))
+    fetcher = Fetcher()
+    monkeypatch.setattr(main, "IMAGE_FETCHER", fetcher)
+    return fetcher
+
+
+def test_mosaic_is_rendered_once_and_revalidated_by_etag(client, mosaics):
+    resp = client.get("/captcha/c1/mosaic")
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/jpeg"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert len(mosaics.fetched) == 9
+
+    again = client.get("/captcha/c1/mosaic")
+    assert again.data == resp.data
+    assert len(mosaics.fetched) == 9
+
+    etag = resp.headers["ETag"]
+    revalidated = client.get("/captcha/c1/mosaic", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+
+
+def test_mosaic_of_unknown_captcha_is_404(client, mosaics):
+    assert client.get("/captcha/nope/mosaic").status_code == 404
+
+
+def test_mosaic_with_unfetchable_images_is_502(client, mosaics):
+    mosaics.fail = True
+    assert client.get("/captcha/c1/mosaic").status_code == 502
@@ -0,0 +1,101 @@
+"""Tests for metrics: request timings and the Prometheus exposition."""
+import threading
+
+import pytest
+
+from metrics import Histogram, Metrics
+
+
+def test_round_trips_from_many_threads_are_all_counted():
+    sqlalchemy = pytest.importorskip("sqlalchemy")
+    metrics = Metrics(enabled=True)
+    metrics.instrument_sqlalchemy()
+    engine = sqlalchemy.create_engine("sqlite://")
+
+    def run():
+        with engine.connect() as conn:
+            for _ in range(200):
+                conn.execute("SELECT 1")
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.db_round_trips == 1600
+
+
+def samples(text):
+    """Returns {name with labels: value} for the sample lines of an
+    exposition, checking that each line parses.
+    """
+    result = {}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            assert line.startswith("# TYPE ")
+            continue
+        name, value = line.rsplit(" ", 1)
+        result[name] = float(value)
+    return result
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.render("latency", 'stage="x"') == [
+        'latency_bucket{stage="x",le="0.1"} 2',
+        'latency_bucket{stage="x",le="1.0"} 3',
+        'latency_bucket{stage="x",le="+Inf"} 4',
+        'latency_sum{stage="x"} 2.65',
+        'latency_count{stage="x"} 4',
+    ]
+
+
+def test_render_turns_stats_into_gauges():
+    metrics = Metrics(enabled=True)
+    text = metrics.render(
+        {
+            "prediction_cache": {"size": 3, "hits": 10},
+            # one entry per engine: the key becomes a name label
+            "engines": {"postgres+pg8000://db": {"checked_out": 2, "size": 5}},
+            # a string becomes a value label on a gauge of 1
+            "model_gate": {"in_flight": 1, "breaker": "half_open"},
+            "warm-up": {"ready": True},
+            "ignored": {"list": [1, 2]},
+        }
+    )
+    assert samples(text) == {
+        "samoyed_db_round_trips_total": 0,
+        "samoyed_prediction_cache_size": 3,
+        "samoyed_prediction_cache_hits": 10,
+        'samoyed_engines_checked_out{name="postgres+pg8000://db"}': 2,
+        'samoyed_engines_size{name="postgres+pg8000://db"}': 5,
+        "samoyed_model_gate_in_flight": 1,
+        'samoyed_model_gate_breaker{value="half_open"}': 1,
+        "samoyed_warm_up_ready": 1,
+    }
+
+
+def test_render_includes_request_and_stage_timings():
+    metrics = Metrics(enabled=True)
+    metrics.start_request()
+    with metrics.stage("db_lookup"):
+        pass
+    server_timing = metrics.finish_request("return_prediction")
+    assert server_timing.startswith("db_lookup;dur=")
+    assert 'db;dur=0.0;desc="0 round trips"' in server_timing
+
+    values = samples(metrics.render({}))
+    assert values['samoyed_stage_seconds_count{stage="db_lookup"}'] == 1
+    assert values['samoyed_request_seconds_count{endpoint="return_prediction"}'] == 1
+    assert values['samoyed_request_db_round_trips_bucket{endpoint="return_prediction",le="0"}'] == 1
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.start_request()
+    with metrics.stage("db_lookup"):
+        pass
+    assert metrics.finish_request("return_prediction") is None
+    assert samples(metrics.render({})) == {"samoyed_db_round_trips_total": 0}
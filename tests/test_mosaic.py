@@ -0,0 +1,49 @@
+"""Tests for mosaic: the byte-bounded cache and mosaic rendering."""
+import io
+
+import pytest
+
+from mosaic import ByteLRU, render_mosaic
+
+
+def test_byte_lru_evicts_least_recently_used_by_size():
+    lru = ByteLRU(max_bytes=10)
+    lru.put("a", b"aaaa")
+    lru.put("b", b"bbbb")
+    assert lru.get("a") == b"aaaa"  # b is now the least recently used
+    lru.put("c", b"cccc")
+    assert lru.get("b") is None
+    assert lru.get("a") == b"aaaa" and lru.get("c") == b"cccc"
+    assert lru.stats() == {"entries": 2, "bytes": 8, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_byte_lru_replaces_and_skips_oversized_values():
+    lru = ByteLRU(max_bytes=10)
+    lru.put("a", b"aaaa")
+    lru.put("a", b"aa")
+    assert lru.stats()["bytes"] == 2
+    lru.put("big", b"x" * 11)
+    assert lru.get("big") is None
+    assert lru.get("a") == b"aa"
+
+
+def jpeg(color, size):
+    image_module = pytest.importorskip("PIL.Image")
+    output = io.BytesIO()
+    image_module.new("RGB", size, color).save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def test_mosaic_lays_out_tiles_row_by_row():
+    image_module = pytest.importorskip("PIL.Image")
+    colors = [(255 * (i % 2), 28 * i, 255 - 28 * i) for i in range(9)]
+    # thumbnails of other shapes are scaled and cropped to the tile
+    images = [jpeg(color, (40, 30) if i % 3 else (30, 30)) for i, color in enumerate(colors)]
+
+    with image_module.open(io.BytesIO(render_mosaic(images, tile_size=20))) as mosaic:
+        assert mosaic.format == "JPEG"
+        assert mosaic.size == (60, 60)
+        for i, color in enumerate(colors):
+            row, column = divmod(i, 3)
+            center = mosaic.getpixel((column * 20 + 10, row * 20 + 10))
+            assert all(abs(a - b) < 16 for a, b in zip(center, color)), (i, center, color)
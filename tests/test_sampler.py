@@ -0,0 +1,103 @@
+"""Tests for sampler: alias tables, strata and catalog size checks."""
+import collections
+import random
+
+import pytest
+
+from sampler import IMAGES_PER_CAPTCHA, AliasTable, ImageSampler, NotEnoughImages
+
+
+def make_sampler(partitions, stats=()):
+    labels = {url: label for label, urls in partitions.items() for url in urls}
+    return ImageSampler(
+        lambda: partitions,
+        labels.__getitem__,
+        lambda start, end: stats,
+        refresh_interval=1e9,
+    )
+
+
+def catalog(jamie, alice):
+    return {
+        "jamie": [f"jamie-{i}" for i in range(jamie)],
+        "alice": [f"alice-{i}" for i in range(alice)],
+    }
+
+
+def test_alias_table_draws_in_proportion_to_weights():
+    random.seed(1)
+    weights = [1.0, 2.0, 3.0, 0.5, 3.5]
+    table = AliasTable(weights)
+    draws = 200000
+    counts = collections.Counter(table.draw() for _ in range(draws))
+    for index, weight in enumerate(weights):
+        assert counts[index] / draws == pytest.approx(weight / sum(weights), abs=0.01)
+
+
+def test_alias_table_with_one_weight():
+    assert {AliasTable([2.0]).draw() for _ in range(100)} == {0}
+
+
+@pytest.mark.parametrize("jamie, alice", [(1, 8), (8, 1), (5, 5), (30, 40)])
+def test_pick_returns_nine_different_images_of_both_labels(jamie, alice):
+    random.seed(2)
+    sampler = make_sampler(catalog(jamie, alice))
+    for _ in range(500):
+        images = sampler.pick()
+        assert len(images) == IMAGES_PER_CAPTCHA
+        assert len(set(images)) == IMAGES_PER_CAPTCHA
+        assert {image.split("-")[0] for image in images} == {"jamie", "alice"}
+
+
+def test_pick_reaches_every_image():
+    random.seed(3)
+    partitions = catalog(20, 20)
+    sampler = make_sampler(partitions)
+    seen = set()
+    for _ in range(500):
+        seen.update(sampler.pick())
+    assert seen == set(partitions["jamie"] + partitions["alice"])
+
+
+def test_pick_favors_images_people_get_wrong():
+    random.seed(4)
+    partitions = catalog(20, 20)
+    # jamie-0 is always wrong, jamie-1 always right, over many responses
+    sampler = make_sampler(partitions, [("jamie-0", 1000, 1000), ("jamie-1", 0, 1000)])
+    sampler.refresh()
+    counts = collections.Counter()
+    for _ in range(5000):
+        counts.update(sampler.pick())
+    # weights of about 5 versus 1; each is drawn against the rest of its
+    # stratum, so the ratio of picks depends on how the strata fell
+    assert counts["jamie-0"] > 2 * counts["jamie-1"]
+
+
+def test_label_mix_follows_the_binomial_distribution():
+    random.seed(5)
+    sampler = make_sampler(catalog(50, 50))
+    draws = 20000
+    mix = collections.Counter(
+        sum(image.startswith("jamie") for image in sampler.pick()) for _ in range(draws)
+    )
+    # equal weights: C(9, k) / 2^9, restricted to 1..8 and renormalized
+    assert mix[0] == mix[9] == 0
+    for count, expected in ((1, 9 / 510), (4, 126 / 510), (5, 126 / 510), (8, 9 / 510)):
+        assert mix[count] / draws == pytest.approx(expected, abs=0.01)
+
+
+@pytest.mark.parametrize("jamie, alice", [(3, 3), (9, 0), (0, 20), (4, 4)])
+def test_too_small_a_catalog_raises(jamie, alice):
+    sampler = make_sampler(catalog(jamie, alice))
+    with pytest.raises(NotEnoughImages):
+        sampler.pick()
+
+
+def test_failed_refresh_keeps_the_previous_tables():
+    partitions = catalog(5, 5)
+    sampler = make_sampler(partitions)
+    sampler.pick()
+    partitions["alice"] = []
+    with pytest.raises(NotEnoughImages):
+        sampler.refresh()
+    assert len(set(sampler.pick())) == IMAGES_PER_CAPTCHA
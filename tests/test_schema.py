@@ -0,0 +1,127 @@
+"""Tests for schema: time-ordered captcha ids and monthly partitions."""
+import datetime
+import uuid
+
+import pytest
+
+schema = pytest.importorskip("schema")
+
+
+def test_captcha_id_round_trips_created_at():
+    created_at = datetime.datetime(2024, 10, 17, 12, 34, 56, 789000)
+    captcha_id = schema.new_captcha_id(created_at)
+    assert uuid.UUID(captcha_id).version == 7
+    assert len(captcha_id) == 36
+    assert schema.captcha_created_at(captcha_id) == created_at
+
+
+def test_captcha_ids_are_unique_and_time_ordered():
+    start = datetime.datetime(2024, 10, 17)
+    ids = [schema.new_captcha_id(start + datetime.timedelta(seconds=i)) for i in range(100)]
+    assert len(set(ids)) == 100
+    assert ids == sorted(ids)
+
+
+@pytest.mark.parametrize(
+    "captcha_id",
+    [
+        str(uuid.uuid4()),  # ids of captchas made before time-ordered ids
+        "not a uuid",
+        "",
+        None,
+        # a crafted version 7 id whose time is out of datetime's range
+        "ffffffff-ffff-7fff-bfff-ffffffffffff",
+    ],
+)
+def test_other_ids_have_no_created_at(captcha_id):
+    assert schema.captcha_created_at(captcha_id) is None
+
+
+def test_ids_from_the_future_have_no_created_at():
+    now = datetime.datetime.utcnow()
+    assert schema.captcha_created_at(schema.new_captcha_id(now)) is not None
+    skewed = now + schema.MAX_CLOCK_SKEW / 2
+    assert schema.captcha_created_at(schema.new_captcha_id(skewed)) is not None
+    future = now + datetime.timedelta(days=400)
+    assert schema.captcha_created_at(schema.new_captcha_id(future)) is None
+
+
+def test_month_start():
+    assert schema.month_start(datetime.date(2026, 10, 17)) == datetime.date(2026, 10, 1)
+    assert schema.month_start(datetime.date(2026, 11, 30), 2) == datetime.date(2027, 1, 1)
+    assert schema.month_start(datetime.date(2026, 1, 1), -1) == datetime.date(2025, 12, 1)
+
+
+class Connection:
+    """Records the statements create_month_partitions() runs, and answers
+    its catalog queries as if the given tables and default-partition rows
+    existed.
+    """
+
+    def __init__(self, tables, stranded_months):
+        self.tables = set(tables)
+        self.stranded_months = set(stranded_months)
+        self.statements = []
+
+    def execute(self, statement, **params):
+        sql = str(statement)
+        self.statements.append(sql)
+        if "to_regclass(:partition) IS NULL" in sql:
+            return Result(params["partition"] not in self.tables)
+        if "to_regclass(:default) IS NOT NULL" in sql:
+            return Result(params["default"] in self.tables)
+        if sql.startswith("SELECT EXISTS"):
+            return Result(params["month"] in self.stranded_months)
+        return Result(None)
+
+
+class Result:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+def ddl(conn):
+    return [sql for sql in conn.statements if not sql.startswith("SELECT")]
+
+
+def test_partitions_are_created_for_each_month():
+    conn = Connection({"captcha_default"}, stranded_months=())
+    schema.create_month_partitions(
+        conn, "captcha", datetime.date(2026, 11, 1), datetime.date(2027, 1, 1)
+    )
+    assert ddl(conn) == [
+        "CREATE TABLE IF NOT EXISTS captcha_p202611 PARTITION OF captcha"
+        " FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')",
+        "CREATE TABLE IF NOT EXISTS captcha_p202612 PARTITION OF captcha"
+        " FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')",
+        "CREATE TABLE IF NOT EXISTS captcha_p202701 PARTITION OF captcha"
+        " FOR VALUES FROM ('2027-01-01') TO ('2027-02-01')",
+    ]
+
+
+def test_rows_in_the_default_partition_are_moved_to_the_new_partition():
+    month = datetime.date(2026, 11, 1)
+    conn = Connection({"responses_default"}, stranded_months={month})
+    schema.create_month_partitions(conn, "responses", month, datetime.date(2026, 12, 1))
+    in_november = "submitted_at >= '2026-11-01' AND submitted_at < '2026-12-01'"
+    assert ddl(conn) == [
+        "ALTER TABLE responses DETACH PARTITION responses_default",
+        "CREATE TABLE IF NOT EXISTS responses_p202611 PARTITION OF responses"
+        " FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')",
+        f"INSERT INTO responses SELECT * FROM responses_default WHERE {in_november}",
+        f"DELETE FROM responses_default WHERE {in_november}",
+        "ALTER TABLE responses ATTACH PARTITION responses_default DEFAULT",
+        # December has no stranded rows, so the default stays attached
+        "CREATE TABLE IF NOT EXISTS responses_p202612 PARTITION OF responses"
+        " FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')",
+    ]
+
+
+def test_existing_partitions_are_left_alone():
+    month = datetime.date(2026, 11, 1)
+    conn = Connection({"thumbnail_default", "thumbnail_p202611"}, stranded_months={month})
+    schema.create_month_partitions(conn, "thumbnail", month, month)
+    assert not any("DETACH" in sql or "INSERT" in sql for sql in conn.statements)
@@ -0,0 +1,68 @@
+"""Tests for tokens: signed captcha tokens."""
+import pytest
+
+import tokens
+from tokens import InvalidToken, decode_captcha_token, encode_captcha_token
+
+SECRET = b"test secret"
+
+CAPTCHA = {
+    "captcha_id": "0190f1d2-8a00-7000-8000-000000000000",
+    "label": "alice",
+    **{f"image{image_no}": {"url": f"https://example.com/{image_no}.jpg"} for image_no in range(1, 10)},
+}
+
+
+def test_round_trip():
+    payload = decode_captcha_token(encode_captcha_token(CAPTCHA, SECRET, ttl=60), SECRET)
+    assert payload["id"] == CAPTCHA["captcha_id"]
+    assert payload["label"] == "alice"
+    assert payload["urls"] == [f"https://example.com/{image_no}.jpg" for image_no in range(1, 10)]
+
+
+def test_token_is_url_safe():
+    token = encode_captcha_token(CAPTCHA, SECRET, ttl=60)
+    assert set(token) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.")
+
+
+def flip(text, index):
+    # not the last character, whose low bits may be base64 padding
+    return text[:index] + ("A" if text[index] != "A" else "B") + text[index + 1 :]
+
+
+@pytest.mark.parametrize("part", [0, 1])
+@pytest.mark.parametrize("index", [0, 5, 20])
+def test_tampering_is_detected(part, index):
+    parts = encode_captcha_token(CAPTCHA, SECRET, ttl=60).split(".")
+    parts[part] = flip(parts[part], index % len(parts[part]))
+    with pytest.raises(InvalidToken):
+        decode_captcha_token(".".join(parts), SECRET)
+
+
+def test_body_signed_for_another_captcha_is_rejected():
+    body = encode_captcha_token(CAPTCHA, SECRET, ttl=60).split(".")[0]
+    other = encode_captcha_token({**CAPTCHA, "label": "jamie"}, SECRET, ttl=60)
+    with pytest.raises(InvalidToken):
+        decode_captcha_token(body + "." + other.split(".")[1], SECRET)
+
+
+def test_wrong_secret_is_rejected():
+    token = encode_captcha_token(CAPTCHA, SECRET, ttl=60)
+    with pytest.raises(InvalidToken):
+        decode_captcha_token(token, b"another secret")
+
+
+@pytest.mark.parametrize("token", ["", ".", "garbage", "a.b.c", "!!!.###"])
+def test_malformed_tokens_are_rejected(token):
+    with pytest.raises(InvalidToken):
+        decode_captcha_token(token, SECRET)
+
+
+def test_expired_token_is_rejected(monkeypatch):
+    token = encode_captcha_token(CAPTCHA, SECRET, ttl=60)
+    now = tokens.time.time()
+    monkeypatch.setattr(tokens.time, "time", lambda: now + 59)
+    decode_captcha_token(token, SECRET)
+    monkeypatch.setattr(tokens.time, "time", lambda: now + 62)
+    with pytest.raises(InvalidToken, match="expired"):
+        decode_captcha_token(token, SECRET)
@@ -0,0 +1,203 @@
+"""Tests for write_behind.WriteBehindQueue: spilling, replay and failures."""
+import json
+import threading
+import time
+
+import pytest
+
+from write_behind import WriteBehindQueue
+
+
+class Recorder:
+    """A handler that records what it wrote, and can be made to fail."""
+
+    def __init__(self):
+        self.written = []
+        self.failing = False
+
+    def __call__(self, records):
+        if self.failing:
+            raise RuntimeError("database unavailable")
+        self.written.extend(record["id"] for record in records)
+
+
+def make_queue(tmp_path, **handlers):
+    return WriteBehindQueue(
+        handlers, str(tmp_path / "spill.jsonl"), batch_size=10, flush_interval=0.01
+    )
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_flush_spills_only_the_failed_kind(tmp_path):
+    captchas, responses = Recorder(), Recorder()
+    wbq = make_queue(tmp_path, captcha=captchas, response=responses)
+    responses.failing = True
+
+    wbq._flush([("captcha", {"id": "c1"}, 0), ("response", {"id": "r1"}, 0)])
+    assert captchas.written == ["c1"]
+
+    # the committed captcha isn't replayed, so it isn't written twice
+    responses.failing = False
+    wbq._replay_spill()
+    assert captchas.written == ["c1"]
+    assert responses.written == ["r1"]
+
+
+def test_replay_keeps_the_rest_when_a_batch_fails(tmp_path):
+    captchas = Recorder()
+    wbq = make_queue(tmp_path, captcha=captchas)
+    wbq._spill([("captcha", {"id": f"c{i}"}, 0) for i in range(25)])
+
+    captchas.failing = True
+    wbq._replay_spill()
+    assert captchas.written == []
+
+    captchas.failing = False
+    wbq._replay_spill()
+    assert sorted(captchas.written) == sorted(f"c{i}" for i in range(25))
+
+
+def test_truncated_spill_line_is_quarantined(tmp_path):
+    captchas = Recorder()
+    wbq = make_queue(tmp_path, captcha=captchas)
+    spill = tmp_path / "spill.jsonl"
+    # the first line is in the format spilled before attempts were counted
+    spill.write_text(json.dumps(["captcha", {"id": "c1"}]) + "\n" + '["captcha", {"id": "c')
+
+    # a later spill starts a new line instead of extending the partial one
+    wbq._spill([("captcha", {"id": "c2"}, 0)])
+    wbq._replay_spill()
+
+    assert captchas.written == ["c1", "c2"]
+    assert wbq.quarantined == 1
+    assert (tmp_path / "spill.jsonl.bad").read_text() == '["captcha", {"id": "c\n'
+    assert not spill.exists()
+
+
+def test_flusher_survives_a_bad_spill_file(tmp_path):
+    captchas = Recorder()
+    (tmp_path / "spill.jsonl").write_text('["captcha", {"id"')
+    wbq = make_queue(tmp_path, captcha=captchas)
+
+    wbq.put("captcha", {"id": "c1"})
+    wait_for(lambda: captchas.written == ["c1"])
+    assert wbq._thread.is_alive()
+    assert wbq.depth() == 0
+    wbq.drain()
+
+
+def test_flusher_survives_an_error_outside_the_handlers(tmp_path, monkeypatch):
+    captchas = Recorder()
+    wbq = make_queue(tmp_path, captcha=captchas)
+    calls = []
+
+    def broken_replay():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("disk error")
+
+    monkeypatch.setattr(wbq, "_replay_spill", broken_replay)
+    wbq.put("captcha", {"id": "c1"})
+    wait_for(lambda: captchas.written == ["c1"])
+    assert wbq._thread.is_alive()
+    wbq.drain()
+
+
+def test_records_returned_by_a_handler_are_retried(tmp_path):
+    written = []
+    ready = {"c1": False}
+
+    def responses(records):
+        # like main.write_responses: hold back responses to unsaved captchas
+        written.extend(record["id"] for record in records if ready[record["captcha"]])
+        return [record for record in records if not ready[record["captcha"]]]
+
+    wbq = make_queue(tmp_path, response=responses)
+    assert wbq._flush([("response", {"id": "r1", "captcha": "c1"}, 0)])
+    assert written == []
+    assert wbq.deferred == 1
+
+    ready["c1"] = True
+    wbq._replay_spill()
+    assert written == ["r1"]
+
+
+def test_full_queue_spills_instead_of_blocking(tmp_path):
+    wbq = WriteBehindQueue(
+        {"captcha": Recorder()}, str(tmp_path / "spill.jsonl"), max_size=1, put_timeout=0.01
+    )
+    # no flusher thread, so the queue stays full
+    wbq.start = lambda: None
+    wbq.put("captcha", {"id": "c1"})
+    wbq.put("captcha", {"id": "c2"})
+    lines = (tmp_path / "spill.jsonl").read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [["captcha", {"id": "c2"}, 0]]
+
+
+@pytest.mark.parametrize("workers", [4])
+def test_concurrent_spills_and_replays_lose_and_repeat_nothing(tmp_path, workers):
+    captchas = Recorder()
+    wbq = make_queue(tmp_path, captcha=captchas)
+
+    def work(worker):
+        for i in range(50):
+            wbq._spill([("captcha", {"id": f"{worker}-{i}"}, 0)])
+            if i % 10 == 0:
+                wbq._replay_spill()
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wbq._replay_spill()
+
+    assert sorted(captchas.written) == sorted(
+        f"{worker}-{i}" for worker in range(workers) for i in range(50)
+    )
+
+
+def test_flush_fails_only_when_nothing_was_written(tmp_path):
+    captchas, responses = Recorder(), Recorder()
+    wbq = make_queue(tmp_path, captcha=captchas, response=responses)
+    responses.failing = True
+    assert wbq._flush([("captcha", {"id": "c1"}, 0), ("response", {"id": "r1"}, 0)])
+    assert not wbq._flush([("response", {"id": "r2"}, 0)])
+
+
+def test_a_record_that_always_fails_is_quarantined(tmp_path):
+    written = []
+
+    def captchas(records):
+        # the database rejects p1 every time, and everything with it
+        if any(record["id"] == "p1" for record in records):
+            raise ValueError("invalid input syntax")
+        written.extend(record["id"] for record in records)
+
+    wbq = WriteBehindQueue(
+        {"captcha": captchas}, str(tmp_path / "spill.jsonl"), batch_size=10, max_attempts=3
+    )
+    wbq._flush([("captcha", {"id": record_id}, 0) for record_id in ("c1", "p1", "c2")])
+    assert written == []
+
+    # the first replay writes the others one at a time
+    wbq._replay_spill()
+    assert sorted(written) == ["c1", "c2"]
+    spilled = [json.loads(line) for line in (tmp_path / "spill.jsonl").read_text().splitlines()]
+    assert spilled == [["captcha", {"id": "p1"}, 2]]
+
+    wbq._replay_spill()
+    assert not (tmp_path / "spill.jsonl").exists()
+    bad = [json.loads(line) for line in (tmp_path / "spill.jsonl.bad").read_text().splitlines()]
+    assert bad == [["captcha", {"id": "p1"}, 3]]
+    assert wbq.quarantined == 1
+    assert sorted(written) == ["c1", "c2"]
+
+    wbq._replay_spill()
+    assert sorted(written) == ["c1", "c2"]
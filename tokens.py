@@ -0,0 +1,81 @@
+"""Stateless, HMAC-signed captcha tokens.
+
+A token carries everything /response needs to know about a captcha (its id,
+label and the 9 image urls), signed so it can't be forged and stamped with
+an expiry time. That lets /captcha answer before anything is written to the
+database, and /response answer without reading it.
+
+Token format: base64url(zlib(json payload)) "." base64url(hmac-sha256)
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+import zlib
+from typing import Dict
+
+
+class InvalidToken(Exception):
+    """Raised when a token is malformed, has a bad signature, or has expired.
+    """
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _signature(body: str, secret: bytes) -> bytes:
+    return hmac.new(secret, body.encode("ascii"), hashlib.sha256).digest()
+
+
+def encode_captcha_token(captcha: dict, secret: bytes, ttl: float) -> str:
+    """Returns a signed token for a captcha.
+
+    Args:
+        captcha: a dict as returned by main.build_captcha()
+        secret: the HMAC key
+        ttl: number of seconds the token stays valid
+
+    Returns:
+        The token, which is URL-safe and can be used as a captcha_id.
+    """
+    payload = {
+        "id": captcha["captcha_id"],
+        "label": captcha["label"],
+        "urls": [captcha[f"image{image_no}"]["url"] for image_no in range(1, 10)],
+        "exp": int(time.time() + ttl),
+    }
+    body = _b64encode(zlib.compress(json.dumps(payload, separators=(",", ":")).encode()))
+    return f"{body}.{_b64encode(_signature(body, secret))}"
+
+
+def decode_captcha_token(token: str, secret: bytes) -> Dict:
+    """Verifies a token and returns its payload.
+
+    Args:
+        token: a token returned by encode_captcha_token()
+        secret: the HMAC key it was signed with
+
+    Returns:
+        Dict with keys "id" (the captcha_id stored in the database), "label",
+        "urls" (list of the 9 image urls, image1 first) and "exp".
+
+    Raises:
+        InvalidToken: the token is malformed, forged or expired.
+    """
+    body, _, signature = token.partition(".")
+    try:
+        valid = hmac.compare_digest(_b64decode(signature), _signature(body, secret))
+        if not valid:
+            raise InvalidToken("Bad token signature")
+        payload = json.loads(zlib.decompress(_b64decode(body)))
+    except (ValueError, zlib.error, UnicodeError) as error:
+        raise InvalidToken("Malformed token") from error
+    if payload["exp"] < time.time():
+        raise InvalidToken("Token has expired")
+    return payload
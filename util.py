@@ -1,12 +1,21 @@
 """Miscellaneous utility functions for starter project.
 """
+import atexit
 import platform
-from typing import Any, Dict
+import threading
+from typing import Any, Dict, Tuple
 
 import sqlalchemy # type: ignore
 
 from config import CSQL_CONNECTION, DB_USER, DB_PWD, DB_NAME
 
+# Process-wide engine registry, keyed by connection parameters. Each engine
+# owns a connection pool, so creating one per request throws the pool away;
+# instead the first caller creates the engine and everyone else reuses it.
+_ENGINES: Dict[Tuple, Any] = {}
+_ENGINE_METRICS: Dict[Tuple, Dict[str, int]] = {}
+_ENGINES_LOCK = threading.Lock()
+
 
 def cloudsql_postgres(
     *,
@@ -20,7 +29,7 @@ def cloudsql_postgres(
     pool_timeout: int = 30,
     pool_recycle: int = 1800,
 ) -> Any:
-    """Creates a SQLAlchemy connection for a Cloud SQL Postgres instance.
+    """Returns the SQLAlchemy engine for a Cloud SQL Postgres instance.
 
     Args:
         instance: Cloud SQL instance name (project:region:instance)
@@ -35,14 +44,67 @@ def cloudsql_postgres(
         pool_recycle: number of seconds until a connection will be recycled
 
     Returns:
-        A SQLAlchemy connection instance created with create_engine.
-        We assume that if this code is running on Windows (for local dev/test)
-        then we're connecting to Cloud SQL via the proxy, so need to use
-        localhost instead of a Unix socket for the connection.
+        A SQLAlchemy engine created with create_engine. Engines are created
+        lazily and cached for the life of the process, so repeated calls
+        with the same settings share one connection pool.
 
     Note that default settings from config.py are used, so for most cases the
     caller doesn't need to explicitly specify any settings.
     """
+    key = (
+        instance,
+        username,
+        password,
+        database,
+        driver,
+        pool_size,
+        max_overflow,
+        pool_timeout,
+        pool_recycle,
+    )
+    engine = _ENGINES.get(key)
+    if engine is not None:
+        return engine
+
+    with _ENGINES_LOCK:
+        # another thread may have created the engine while we waited
+        engine = _ENGINES.get(key)
+        if engine is None:
+            engine = _create_engine(
+                instance=instance,
+                username=username,
+                password=password,
+                database=database,
+                driver=driver,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle,
+            )
+            _ENGINE_METRICS[key] = _instrument_pool(engine)
+            _ENGINES[key] = engine
+    return engine
+
+
+def _create_engine(
+    *,
+    instance: str,
+    username: str,
+    password: str,
+    database: str,
+    driver: str,
+    pool_size: int,
+    max_overflow: int,
+    pool_timeout: int,
+    pool_recycle: int,
+) -> Any:
+    """Creates a new SQLAlchemy engine. Use cloudsql_postgres() instead of
+    calling this directly, so that the engine is shared.
+
+    We assume that if this code is running on Windows (for local dev/test)
+    then we're connecting to Cloud SQL via the proxy, so need to use
+    localhost instead of a Unix socket for the connection.
+    """
 
     if platform.system() == "Windows":
         connection_string = f"{driver}://postgres:{password}@127.0.0.1:5432/{database}"
@@ -65,4 +127,91 @@ def cloudsql_postgres(
         max_overflow=max_overflow,
         pool_timeout=pool_timeout,
         pool_recycle=pool_recycle,
+        pool_pre_ping=True,
     )
+
+
+def _instrument_pool(engine: Any) -> Dict[str, int]:
+    """Attaches pool event listeners that count connects and checkouts.
+
+    Returns:
+        The dict of counters, which is updated in place by the listeners.
+    """
+    counters = {"connects": 0, "checkouts": 0, "checkins": 0, "invalidated": 0}
+
+    def on_connect(dbapi_connection, connection_record):  # type: ignore
+        counters["connects"] += 1
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):  # type: ignore
+        counters["checkouts"] += 1
+
+    def on_checkin(dbapi_connection, connection_record):  # type: ignore
+        counters["checkins"] += 1
+
+    def on_invalidate(dbapi_connection, connection_record, exception):  # type: ignore
+        counters["invalidated"] += 1
+
+    sqlalchemy.event.listen(engine, "connect", on_connect)
+    sqlalchemy.event.listen(engine, "checkout", on_checkout)
+    sqlalchemy.event.listen(engine, "checkin", on_checkin)
+    sqlalchemy.event.listen(engine, "invalidate", on_invalidate)
+    return counters
+
+
+def pool_stats() -> Dict[str, Dict[str, int]]:
+    """Returns pool health and checkout metrics for every registered engine.
+
+    Returns:
+        A dict keyed by "<database>@<instance>", where each value contains
+        the current pool size, connections checked in/out, overflow, and the
+        cumulative connect/checkout/checkin/invalidated counters.
+    """
+    stats = {}
+    for key, engine in list(_ENGINES.items()):
+        instance, _, _, database = key[:4]
+        pool = engine.pool
+        stats[f"{database}@{instance}"] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            **_ENGINE_METRICS.get(key, {}),
+        }
+    return stats
+
+
+def dispose_engines() -> None:
+    """Closes all pooled connections and empties the engine registry.
+
+    This is registered to run at interpreter exit, so that Cloud SQL sees
+    clean disconnects instead of dropped sockets.
+    """
+    with _ENGINES_LOCK:
+        engines = list(_ENGINES.values())
+        _ENGINES.clear()
+        _ENGINE_METRICS.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+def discard_engines_after_fork() -> None:
+    """Empties the engine registry without closing the pooled connections.
+
+    Call this in a child process after a fork: the inherited connections
+    belong to the parent, so the child must not use or close them. The next
+    cloudsql_postgres() call creates a fresh engine for the child.
+    """
+    with _ENGINES_LOCK:
+        engines = list(_ENGINES.values())
+        _ENGINES.clear()
+        _ENGINE_METRICS.clear()
+    for engine in engines:
+        try:
+            engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33 can't dispose without closing; just drop
+            # the engine and let the parent keep its connections
+            pass
+
+
+atexit.register(dispose_engines)
@@ -0,0 +1,83 @@
+"""Warm-up phase for new instances.
+
+The first requests on a new instance would otherwise pay for filling the
+connection pool, listing the bucket and opening the AutoML channel. A WarmUp
+runs those steps in the background after start, and the readiness endpoint
+reports ready only once it has finished.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class WarmUp:
+    """Runs a list of named warm-up steps once, in a background thread.
+
+    Args:
+        steps: list of (name, callable) pairs, run in order
+
+    A step that raises is logged and recorded in status(), and warm-up moves
+    on to the next step; a broken cache shouldn't keep an instance out of
+    service forever.
+    """
+
+    def __init__(self, steps: List[Tuple[str, Callable[[], None]]]) -> None:
+        self._steps = steps
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._status: Dict[str, str] = {name: "pending" for name, _ in steps}
+
+    def start(self) -> None:
+        """Starts running the steps, unless warm-up is running or done.
+        """
+        with self._lock:
+            if self._ready.is_set() or (self._thread and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self.run, name="warm-up", daemon=True)
+            self._thread.start()
+
+    def skip(self) -> None:
+        """Marks the instance ready without running any steps.
+        """
+        with self._lock:
+            self._status = {name: "skipped" for name, _ in self._steps}
+        self._ready.set()
+
+    def run(self) -> None:
+        """Runs every step in the calling thread, then marks the instance ready.
+        """
+        for name, step in self._steps:
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("warm-up step %s failed", name)
+                outcome = "failed"
+            else:
+                outcome = "ok"
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._status[name] = f"{outcome} ({elapsed:.3f}s)"
+        self._ready.set()
+        logging.info("warm-up finished: %s", self._status)
+
+    def ready(self) -> bool:
+        """Returns True once warm-up has finished (or was skipped).
+        """
+        return self._ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until warm-up has finished or timeout seconds have passed.
+
+        Returns:
+            True if warm-up has finished.
+        """
+        return self._ready.wait(timeout)
+
+    def status(self) -> Dict[str, str]:
+        """Returns the outcome and duration of each step so far.
+        """
+        with self._lock:
+            return dict(self._status)
@@ -0,0 +1,349 @@
+"""Write-behind buffer for rows the client doesn't need to wait for.
+
+Request handlers put records on the queue and return; a background thread
+writes them in batches, calling one handler per kind of record with all the
+records of that kind in the batch. If the database is unavailable, records
+are appended to a local spill file and written when it comes back. Spilled
+lines that can't be read back, and records that still fail after
+max_attempts writes, are set aside in a .bad file.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, where we only run a single local process
+    fcntl = None  # type: ignore
+
+
+# a queued or spilled record: (kind, record, number of failed writes)
+_Item = Tuple[str, dict, int]
+
+
+@contextlib.contextmanager
+def _file_lock(path: str, blocking: bool = True) -> Iterator[bool]:
+    """Holds an exclusive lock on path across processes (e.g. the workers of
+    one gunicorn server), creating the file if needed.
+
+    Yields:
+        True if the lock is held; False if blocking is off and another
+        process holds it.
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class WriteBehindQueue:
+    """Bounded queue of records that are written to the database in batches.
+
+    Args:
+        handlers: dict that maps each kind of record to a callable that
+                  writes a list of records of that kind in one transaction;
+                  handlers run in the order of this dict, so a kind can
+                  depend on an earlier one. A handler may return records it
+                  can't write yet (e.g. whose parent row was spilled); they
+                  are spilled and retried with the other spilled records.
+        spill_path: file that records are appended to when they can't be
+                    written or the queue is full; processes may share it,
+                    since access is serialized with lock files next to it
+        max_size: maximum number of records waiting in memory
+        batch_size: a flush happens as soon as this many records are waiting
+        flush_interval: ... or when the oldest waiting record is this many
+                        seconds old
+        put_timeout: seconds put() waits for room in a full queue before
+                     spilling the record to disk instead
+        max_attempts: number of failed writes after which a record is moved
+                      to the .bad file instead of being retried again
+
+    Records must be JSON-serializable, so that they can be spilled.
+    """
+
+    def __init__(
+        self,
+        handlers: Dict[str, Callable[[List[dict]], Optional[List[dict]]]],
+        spill_path: str,
+        max_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        put_timeout: float = 0.5,
+        max_attempts: int = 10,
+    ) -> None:
+        self._handlers = handlers
+        self._spill_path = spill_path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._put_timeout = put_timeout
+        self._max_attempts = max_attempts
+        self._queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self.flushes = 0
+        self.flushed = 0
+        self.spilled = 0
+        self.deferred = 0
+        self.quarantined = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        atexit.register(self.drain)
+
+    def put(self, kind: str, record: dict) -> None:
+        """Queues a record to be written by the handler for kind.
+
+        If the queue is full, waits up to put_timeout for room (slowing the
+        caller down when the database falls behind), then spills the record
+        to disk rather than failing the request.
+        """
+        self.start()
+        try:
+            self._queue.put((kind, record, 0), timeout=self._put_timeout)
+        except queue.Full:
+            self._spill([(kind, record, 0)])
+
+    def start(self) -> None:
+        """Starts the flusher thread, if it isn't already running.
+        """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def drain(self) -> None:
+        """Stops the flusher thread and writes everything still queued.
+        """
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+        while not self._queue.empty():
+            self._flush(self._take(block=False))
+
+    def depth(self) -> int:
+        """Returns the number of records waiting in memory.
+        """
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, float]:
+        """Returns queue depth, flush counts and flush latency.
+        """
+        return {
+            "depth": self.depth(),
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "spilled": self.spilled,
+            "deferred": self.deferred,
+            "quarantined": self.quarantined,
+            "flush_seconds": self.flush_seconds,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+    def _run(self) -> None:
+        replay = True
+        while not self._stopping.is_set():
+            try:
+                if replay:
+                    replay = False
+                    self._replay_spill()
+                batch = self._take(block=True)
+                # only retry spilled records once the database is accepting writes
+                replay = bool(batch) and self._flush(batch)
+            except Exception:  # pylint: disable=broad-except
+                # a dead thread would be restarted by the next put() only to
+                # fail the same way, so log it and carry on
+                logging.exception("write-behind flusher failed")
+                self._stopping.wait(self._flush_interval)
+
+    def _take(self, block: bool) -> List[_Item]:
+        """Returns up to batch_size records, waiting at most flush_interval
+        after the first one for the rest.
+        """
+        batch: List[_Item] = []
+        deadline = None
+        while len(batch) < self._batch_size:
+            if not block:
+                timeout = None
+            elif deadline is None:
+                timeout = self._flush_interval  # wait for the first record
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                if block:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self._flush_interval
+        return batch
+
+    def _flush(self, batch: List[_Item], isolate: bool = False) -> bool:
+        """Writes a batch. Each handler commits on its own, so if one fails,
+        only the records of that kind are spilled to disk; the kinds that
+        were written aren't written again when the spill is replayed.
+
+        Args:
+            batch: the records to write
+            isolate: if a handler fails on several records, write them one
+                     at a time, so that a record the database always rejects
+                     doesn't hold back the others
+
+        Returns:
+            False if every handler failed, i.e. the database may be down.
+        """
+        if not batch:
+            return True
+        started = time.perf_counter()
+        by_kind: Dict[str, List[_Item]] = {kind: [] for kind in self._handlers}
+        for item in batch:
+            by_kind[item[0]].append(item)
+        failed: List[_Item] = []
+        deferred: List[_Item] = []
+        try:
+            for items in by_kind.values():
+                if items:
+                    failed.extend(self._write(items, deferred, isolate))
+            exhausted = [item for item in failed if item[2] >= self._max_attempts]
+            if exhausted:
+                self._quarantine(
+                    [json.dumps(list(item)) + "\n" for item in exhausted],
+                    f"records that failed {self._max_attempts} times",
+                )
+            retried = [item for item in failed if item[2] < self._max_attempts]
+            if retried or deferred:
+                self._spill(retried + deferred)
+                self.deferred += len(deferred)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+        written = len(batch) - len(failed) - len(deferred)
+        self.flushed += written
+        return len(failed) < len(batch)
+
+    def _write(self, items: List[_Item], deferred: List[_Item], isolate: bool) -> List[_Item]:
+        """Runs the handler for the kind of items, adding any records it
+        returns to deferred.
+
+        Returns:
+            The items that weren't written, each with one more failed write.
+        """
+        kind = items[0][0]
+        try:
+            retry = self._handlers[kind]([record for _, record, _ in items])
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("write-behind flush of %d %s records failed", len(items), kind)
+            if isolate and len(items) > 1:
+                return [
+                    item for single in items for item in self._write([single], deferred, False)
+                ]
+            return [(kind, record, attempts + 1) for _, record, attempts in items]
+        # a deferred record hasn't failed; its handler decides how long it's
+        # worth retrying
+        deferred.extend((kind, record, 0) for record in retry or ())
+        return []
+
+    def _spill(self, batch: List[_Item]) -> None:
+        """Appends records to the spill file.
+        """
+        if not batch:
+            return
+        lines = "".join(json.dumps(list(item)) + "\n" for item in batch).encode()
+        with self._spill_lock, _file_lock(self._spill_path + ".lock"), open(
+            self._spill_path, "ab+"
+        ) as spill:
+            # a crash mid-write leaves a partial last line; don't glue the
+            # next record onto it
+            end = spill.seek(0, os.SEEK_END)
+            if end:
+                spill.seek(end - 1)
+                if spill.read(1) != b"\n":
+                    lines = b"\n" + lines
+            spill.write(lines)
+        self.spilled += len(batch)
+
+    def _replay_spill(self) -> None:
+        """Writes any spilled records, in batches. If a batch fails, its
+        failed records and the rest are spilled again for the next attempt.
+
+        One process replays at a time; the others skip their replay rather
+        than wait, since the spill file is shared.
+        """
+        with _file_lock(self._spill_path + ".replay.lock", blocking=False) as locked:
+            if locked:
+                self._replay_spill_locked()
+
+    def _replay_spill_locked(self) -> None:
+        replaying = self._spill_path + ".replay"
+        with self._spill_lock, _file_lock(self._spill_path + ".lock"):
+            # a leftover replay file means a replay was interrupted; finish it
+            if not os.path.exists(replaying):
+                if not os.path.exists(self._spill_path):
+                    return
+                os.replace(self._spill_path, replaying)
+        records = self._read_spill(replaying)
+        logging.info("replaying %d spilled write-behind records", len(records))
+        for start in range(0, len(records), self._batch_size):
+            if not self._flush(records[start : start + self._batch_size], isolate=True):
+                self._spill(records[start + self._batch_size :])
+                break
+        os.remove(replaying)
+
+    def _read_spill(self, path: str) -> List[_Item]:
+        """Returns the records in a spill file. Lines that can't be parsed
+        (e.g. one cut short by a crash) are moved to the .bad file, instead
+        of blocking the rest.
+        """
+        records: List[_Item] = []
+        bad = []
+        with open(path) as spill:
+            for line in spill:
+                if not line.strip():
+                    continue
+                try:
+                    # files spilled by older versions have no attempt count
+                    kind, record, *attempts = json.loads(line)
+                    if kind not in self._handlers or not isinstance(record, dict):
+                        raise ValueError(f"unknown record {kind!r}")
+                    records.append((kind, record, int(attempts[0]) if attempts else 0))
+                except (ValueError, TypeError, IndexError):
+                    bad.append(line if line.endswith("\n") else line + "\n")
+        if bad:
+            self._quarantine(bad, "unreadable spilled records")
+        return records
+
+    def _quarantine(self, lines: List[str], what: str) -> None:
+        """Appends lines to the .bad file next to the spill file, where they
+        are kept for inspection and never retried.
+        """
+        quarantine = self._spill_path + ".bad"
+        logging.error("moved %d %s to %s", len(lines), what, quarantine)
+        with self._spill_lock, _file_lock(self._spill_path + ".lock"), open(
+            quarantine, "a"
+        ) as bad:
+            bad.writelines(lines)
+        self.quarantined += len(lines)